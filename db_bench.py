@@ -0,0 +1,624 @@
+"""
+Синтетическая БД и микробенчмарки DB-хелперов бота.
+
+Генерация (схема - через миграции бота, счётчики и агрегаты - теми же бэкфилл-миграциями):
+
+    python db_bench.py generate --db synth.db --users 1000000 --deals 3000000 --logs 10000000
+
+Распределения: рост аудитории к текущей дате, рефералы с предпочтительным присоединением,
+продавцы и повторные покупатели по закону Ципфа, суммы сделок - логнормальные, статусы сделок -
+как в проде (незавершённые только за последние дни), отзывы смещены к 5 звёздам.
+
+Прогон (на копии БД, исходный файл не меняется):
+
+    python db_bench.py run --db synth.db --duration 1 --only deal --json before.json
+
+Для каждого хелпера печатаются ops/sec и p50/p99, затем EXPLAIN QUERY PLAN всех его запросов
+(полный скан таблицы и временное B-дерево помечаются "!"). Пишущие хелперы работают по цепочке
+состояний: create_deal -> mark_deal_paid -> set_deal_proof -> complete_deal / set_deal_dispute -> ...
+"""
+import os
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synthetic dataset generator and DB helper microbenchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="создать и заполнить БД синтетическими данными")
+    gen.add_argument("--db", default="synth.db", help="файл БД (по умолчанию synth.db)")
+    gen.add_argument("--force", action="store_true", help="перезаписать существующий файл")
+    gen.add_argument("--users", type=int, default=100_000, help="пользователей")
+    gen.add_argument("--deals", type=int, default=300_000, help="сделок")
+    gen.add_argument("--logs", type=int, default=1_000_000, help="строк журнала logs")
+    gen.add_argument("--withdrawals", type=int, default=None, help="заявок на вывод (по умолчанию users / 20)")
+    gen.add_argument("--coupons", type=int, default=40, help="купонов")
+    gen.add_argument("--days", type=int, default=365, help="глубина истории в днях")
+    gen.add_argument("--seller-share", type=float, default=0.02, help="доля продавцов среди пользователей")
+    gen.add_argument("--referral-share", type=float, default=0.3, help="доля пришедших по реферальной ссылке")
+    gen.add_argument("--review-share", type=float, default=0.35, help="доля завершённых сделок с отзывом")
+    gen.add_argument("--coupon-share", type=float, default=0.08, help="доля сделок с купоном")
+    gen.add_argument("--seed", type=int, default=1, help="seed генератора")
+
+    run = sub.add_parser("run", help="микробенчмарки DB-хелперов")
+    run.add_argument("--db", default="synth.db", help="исходная БД (копируется, сама не меняется)")
+    run.add_argument("--in-place", action="store_true", help="работать прямо по --db без копии (пишущие хелперы её изменят)")
+    run.add_argument("--duration", type=float, default=1.0, help="секунд на хелпер")
+    run.add_argument("--max-ops", type=int, default=500, help="максимум вызовов одного хелпера (и размер цепочек записи)")
+    run.add_argument("--only", action="append", default=[], help="подстрока имени хелпера (можно несколько)")
+    run.add_argument("--skip-writes", action="store_true", help="только читающие хелперы")
+    run.add_argument("--json", help="сохранить результаты (ops/sec, перцентили, планы) в файл")
+    run.add_argument("--seed", type=int, default=1, help="seed выбора параметров")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+if args.command == "generate":
+    if os.path.exists(args.db):
+        if not args.force:
+            raise SystemExit(f"{args.db} already exists - pass --force to overwrite it")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+    work_db = args.db
+else:
+    if not os.path.exists(args.db):
+        raise SystemExit(f"{args.db} not found - create it with: python db_bench.py generate --db {args.db}")
+    work_db = args.db
+    if not args.in_place:
+        work_db = os.path.join(tempfile.mkdtemp(prefix="db_bench_"), os.path.basename(args.db))
+        src, dst = sqlite3.connect(args.db), sqlite3.connect(work_db)
+        src.backup(dst)
+        src.close()
+        dst.close()
+
+# Бот читает конфигурацию при импорте: своя БД, без журнала медленных запросов, архив логов - во временный каталог
+os.environ["BOT_TOKEN"] = "123456:DBBENCH"
+os.environ["DB_PATH"] = work_db
+os.environ["SLOW_QUERY_MS"] = "0"
+os.environ["LOG_ARCHIVE_DIR"] = os.path.join(tempfile.gettempdir(), "db_bench_log_archive")
+os.environ["RECORD_UPDATES"] = ""
+os.environ["SHARD_ROLE"] = ""
+
+import aiosqlite
+import robloxxnadfix2 as bot_module
+from robloxxnadfix2 import percentile
+from aiogram import types
+
+ADMIN_ID = 1
+FIRST_USER_ID = 100_000_000
+NOW = time.time()
+
+
+# --- Генерация ---
+def sql_ts(epoch: float) -> str:
+    """Время в формате CURRENT_TIMESTAMP (UTC)."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(epoch))
+
+
+def recent_times(rng: random.Random, n: int, days: int) -> List[float]:
+    """n отсортированных моментов за days дней с ростом плотности к текущей дате."""
+    span = days * 86400
+    return sorted(NOW - span * (1 - rng.random() ** 0.5) for _ in range(n))
+
+
+def zipf_cum_weights(n: int, s: float) -> List[float]:
+    return list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(n)))
+
+
+class Generator:
+    BATCH = 20_000
+    DEAL_STATUSES = (("completed", 78), ("cancelled", 13), ("resolved", 2), ("dispute", 1),
+                     ("pending_proof", 2), ("paid_waiting_proof", 2), ("pending_payment", 2))
+    IN_PROGRESS = ("dispute", "pending_proof", "paid_waiting_proof", "pending_payment")
+    LOG_ACTIONS = (("DEAL_PAYMENT_INIT", 20), ("DEAL_PAID", 15), ("DEAL_PROOF_UPLOAD", 14), ("DEAL_COMPLETED", 13),
+                   ("DEAL_EXPIRED", 5), ("REFERRAL_REG", 5), ("REVIEW_LEFT", 5), ("WITHDRAW_REQUEST", 4),
+                   ("COUPON_ACTIVATE", 4), ("WITHDRAW_COMPLETED", 3), ("AD_CREATE", 2), ("AD_TOGGLE", 2),
+                   ("BALANCE_UPDATE", 1), ("DEAL_DISPUTE_OPEN", 1), ("DEAL_DISPUTE_RESOLVE", 1))
+    METHODS = ("СБП", "СБП, карта", "Карта", "ЮMoney", "Qiwi/ЮMoney")
+    REVIEW_COMMENTS = ("", "", "Всё быстро, спасибо!", "Рекомендую", "Долго ждал выдачу", "Отличный продавец", "Норм")
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        self.rng = random.Random(args.seed)
+        self.user_ids: List[int] = []
+        self.user_created: List[float] = []
+        self.sellers: List[int] = []
+        self.seller_ads: Dict[int, List[tuple]] = defaultdict(list)
+        self.coupons: List[tuple] = []
+
+    def insert(self, sql: str, rows):
+        """Пишет строки пачками по BATCH в отдельных транзакциях."""
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.BATCH:
+                self.db.executemany(sql, batch)
+                self.db.commit()
+                batch.clear()
+        if batch:
+            self.db.executemany(sql, batch)
+            self.db.commit()
+
+    def users(self):
+        rng = self.rng
+        created = recent_times(rng, args.users, args.days)
+        self.user_ids = [FIRST_USER_ID + i for i in range(args.users)]
+        self.user_created = created
+        referred = []  # Пришедшие по ссылке: их рефереры выбираются чаще (богатые богатеют)
+
+        def rows():
+            yield ADMIN_ID, "admin", 0.0, sql_ts(NOW - args.days * 86400), None
+            for i, user_id in enumerate(self.user_ids):
+                referrer = None
+                if i and rng.random() < args.referral_share:
+                    if referred and rng.random() < 0.5:
+                        referrer = rng.choice(referred)
+                    else:
+                        referrer = self.user_ids[rng.randrange(i)]
+                    referred.append(referrer)
+                balance = round(rng.lognormvariate(5, 1), 2) if rng.random() < 0.15 else 0.0
+                username = f"user{i}" if rng.random() < 0.7 else None
+                yield user_id, username, balance, sql_ts(created[i]), referrer
+
+        self.insert("INSERT INTO users(user_id, username, balance, created_at, referrer_id) VALUES(?,?,?,?,?)", rows())
+        # Реферальные бонусы - в ledger, как их начисляет create_user_if_not_exists
+        self.db.execute(
+            "INSERT INTO transactions(user_id, kind, amount_kopecks, counterparty, created_at) "
+            "SELECT referrer_id, 'referral_bonus', ?, user_id, created_at FROM users WHERE referrer_id IS NOT NULL",
+            (int(bot_module.REFERRAL_BONUS_RUB * 100),)
+        )
+        self.db.commit()
+
+    def ads(self):
+        rng = self.rng
+        count = max(1, int(args.users * args.seller_share))
+        self.sellers = rng.sample(self.user_ids, min(count, len(self.user_ids)))
+        rows = []
+        for seller_id in self.sellers:
+            for _ in range(1 + (rng.random() < 0.3) + (rng.random() < 0.1)):
+                rate = round(rng.uniform(0.45, 1.1), 2)
+                min_amount, max_amount = rng.choice((50, 100, 200)), rng.choice((5_000, 10_000, 50_000))
+                rows.append((seller_id, f"Robux по {rate:.2f}", rate, min_amount, max_amount,
+                             rng.choice(self.METHODS), int(rng.random() < 0.6), "Быстрая выдача", sql_ts(NOW - rng.uniform(0, args.days) * 86400)))
+        self.insert(
+            "INSERT INTO ads(user_id, title, rate, min_amount, max_amount, payment_methods, active, description, created_at) "
+            "VALUES(?,?,?,?,?,?,?,?,?)", rows
+        )
+        for ad_id, seller_id, rate, min_amount, max_amount in self.db.execute("SELECT id, user_id, rate, min_amount, max_amount FROM ads"):
+            self.seller_ads[seller_id].append((ad_id, rate, min_amount, max_amount))
+
+    def coupons_table(self):
+        rng = self.rng
+        rows = []
+        for i in range(args.coupons):
+            c_type = "percent" if rng.random() < 0.6 else "fixed"
+            value = rng.choice((5, 10, 15, 20)) if c_type == "percent" else rng.choice((50, 100, 200))
+            rows.append((f"SALE{i}", c_type, value, rng.choice((0, 100, 1000, 5000)), rng.choice((0, 0, 500)),
+                         int(rng.random() < 0.7), sql_ts(NOW - rng.uniform(0, args.days) * 86400)))
+        self.insert("INSERT INTO coupons(code, type, value, uses_limit, min_amount, is_active, created_at) VALUES(?,?,?,?,?,?,?)", rows)
+        self.coupons = self.db.execute("SELECT id, code FROM coupons").fetchall()
+
+    def deals(self):
+        rng = self.rng
+        times = recent_times(rng, args.deals, args.days)
+        seller_weights = zipf_cum_weights(len(self.sellers), 1.1)
+        coupon_weights = zipf_cum_weights(len(self.coupons), 1.0) if self.coupons else None
+        statuses, status_weights = zip(*self.DEAL_STATUSES)
+        coupon_users = set()
+        reviews, coupon_uses = [], []
+
+        def rows():
+            for deal_id, created in enumerate(times, 1):
+                # Покупатель - из уже зарегистрированных; давние пользователи покупают чаще
+                registered = max(1, bisect.bisect_right(self.user_created, created))
+                buyer_id = self.user_ids[int(registered * rng.random() ** 1.5)]
+                seller_id = rng.choices(self.sellers, cum_weights=seller_weights)[0]
+                ad_id, rate, min_amount, max_amount = rng.choice(self.seller_ads[seller_id])
+                amount = min(max_amount, max(min_amount, int(round(rng.lognormvariate(6.3, 0.9), -1))))
+                rub = round(amount * rate, 2)
+                status = rng.choices(statuses, weights=status_weights)[0]
+                if status in self.IN_PROGRESS and NOW - created > 2 * 86400:
+                    status = "completed"  # Зависших сделок старше пары дней в проде нет
+                coupon_id = coupon_code = None
+                if coupon_weights and rng.random() < args.coupon_share:
+                    coupon_id, coupon_code = rng.choices(self.coupons, cum_weights=coupon_weights)[0]
+                    if (coupon_id, buyer_id) in coupon_users:
+                        coupon_id = coupon_code = None
+                    elif status != "cancelled":
+                        coupon_users.add((coupon_id, buyer_id))
+                        use_status = "reserved" if status == "pending_payment" else "used"
+                        coupon_uses.append((coupon_id, buyer_id, deal_id, sql_ts(created), use_status))
+                        rub = round(rub * 0.9, 2)
+                paid = status not in ("pending_payment", "cancelled")
+                proof = f"synthetic-proof-{deal_id}" if paid and status != "paid_waiting_proof" else None
+                completed_at = disputed_at = reason = admin_id = resolved_at = None
+                if status == "completed":
+                    done = created + rng.lognormvariate(3, 1) * 60
+                    completed_at = sql_ts(min(done, NOW))
+                    if rng.random() < args.review_share:
+                        rating = rng.choices((1, 2, 3, 4, 5), weights=(3, 2, 5, 20, 70))[0]
+                        reviews.append((buyer_id, seller_id, deal_id, rating, rng.choice(self.REVIEW_COMMENTS),
+                                        sql_ts(min(done + rng.uniform(60, 86400), NOW))))
+                elif status in ("dispute", "resolved"):
+                    disputed = min(created + rng.uniform(600, 86400), NOW)
+                    disputed_at, reason = sql_ts(disputed), "Продавец не выдаёт Robux"
+                    if status == "resolved":
+                        admin_id, resolved_at = ADMIN_ID, sql_ts(min(disputed + rng.uniform(600, 86400), NOW))
+                yield (deal_id, buyer_id, seller_id, ad_id, amount, rate, rub, f"https://www.roblox.com/users/{buyer_id}/profile",
+                       f"synthetic-{deal_id}", status, proof, sql_ts(created), coupon_id, coupon_code,
+                       reason, admin_id, resolved_at, completed_at, disputed_at)
+
+        self.insert(
+            "INSERT INTO deals(id, buyer_id, seller_id, ad_id, amount, price, rub_amount, roblox_link, payment_id, status, "
+            "proof_file_id, created_at, coupon_id, coupon_code, dispute_reason, dispute_admin_id, dispute_resolved_at, "
+            "completed_at, disputed_at) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows()
+        )
+        self.insert("INSERT INTO reviews(reviewer_id, target_id, deal_id, rating, comment, created_at) VALUES(?,?,?,?,?,?)", reviews)
+        self.insert("INSERT INTO coupon_uses(coupon_id, user_id, deal_id, used_at, status) VALUES(?,?,?,?,?)", coupon_uses)
+
+    def withdrawals(self):
+        rng = self.rng
+        count = args.withdrawals if args.withdrawals is not None else args.users // 20
+
+        def rows():
+            for created in recent_times(rng, count, args.days):
+                user_id = rng.choice(self.sellers) if rng.random() < 0.7 else rng.choice(self.user_ids)
+                amount = round(max(100.0, rng.lognormvariate(7, 0.8)), 2)
+                # Очередь выплат: заявки за последние сутки ещё не выплачены, за трое суток - половина
+                age = NOW - created
+                status = "pending" if age < 86400 or (age < 3 * 86400 and rng.random() < 0.5) else "completed"
+                method = "sbp" if rng.random() < 0.7 else "other"
+                requisites = f"+7999{rng.randrange(10_000_000):07d}"
+                yield (user_id, "withdraw_rub", int(amount * 100), amount, status, method,
+                       bot_module.encrypt_requisites(requisites), "withdraw", sql_ts(created))
+
+        self.insert(
+            "INSERT INTO orders(user_id, type, amount, price, status, method, requisites_enc, provider, created_at) "
+            "VALUES(?,?,?,?,?,?,?,?,?)", rows()
+        )
+
+    def logs(self):
+        rng = self.rng
+        actions, weights = zip(*self.LOG_ACTIONS)
+
+        def rows():
+            for created in recent_times(rng, args.logs, args.days):
+                registered = max(1, bisect.bisect_right(self.user_created, created))
+                user_id = self.user_ids[int(registered * rng.random() ** 1.5)]
+                action = rng.choices(actions, weights=weights)[0]
+                yield user_id, action, f"Deal: {rng.randrange(1, args.deals + 1)}", sql_ts(created)
+
+        self.insert("INSERT INTO logs(user_id, action, details, timestamp) VALUES(?,?,?,?)", rows())
+
+
+# Бэкфиллы бота, пересчитывающие производные таблицы и счётчики из сырых данных
+BACKFILL_MIGRATIONS = (
+    bot_module._migration_transactions,
+    bot_module._migration_daily_stats,
+    bot_module._migration_seller_analytics,
+    bot_module._migration_deals_archive,
+    bot_module._migration_coupon_reservations,
+    bot_module._migration_referral_counters,
+    bot_module._migration_referral_earned,
+)
+
+
+async def generate():
+    started = time.perf_counter()
+    await bot_module.init_db()
+    db = sqlite3.connect(work_db)
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("PRAGMA cache_size = -262144")
+    gen = Generator(db)
+    for step in (gen.users, gen.ads, gen.coupons_table, gen.deals, gen.withdrawals, gen.logs):
+        step_started = time.perf_counter()
+        step()
+        print(f"{step.__name__:<14}{time.perf_counter() - step_started:>8.1f} s")
+    db.close()
+
+    async with bot_module.db_connect() as adb:
+        for step in BACKFILL_MIGRATIONS:
+            await step(adb)
+            await adb.commit()
+    print(f"{'backfills':<14}{'':>8}done")
+
+    db = sqlite3.connect(work_db)
+    for table in ("users", "ads", "deals", "reviews", "coupons", "coupon_uses", "orders", "transactions", "logs", "daily_stats", "seller_daily_stats"):
+        print(f"  {table:<20}{db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]:>12,}")
+    db.close()
+    print(f"Generated {work_db} ({os.path.getsize(work_db) / 2**20:,.0f} MiB) in {time.perf_counter() - started:.1f} s")
+
+
+# --- Микробенчмарки ---
+class Case(NamedTuple):
+    name: str
+    call: Callable[[Any], Awaitable[Any]]
+    write: bool = False
+    source: Optional[str] = None  # Пул, из которого берутся параметры (цепочка записи)
+    output: Optional[str] = None  # Пул, куда кладётся результат вызова
+
+
+class CapturingConnection(bot_module.SlowQueryConnection):
+    """Соединение бота, запоминающее все выполненные запросы (для EXPLAIN QUERY PLAN)."""
+
+    def __init__(self, conn: aiosqlite.Connection, statements: list):
+        super().__init__(conn, float("inf"))  # Журнал медленных запросов не нужен
+        self.statements = statements
+
+    async def execute(self, sql: str, parameters=()):
+        self.statements.append((sql, tuple(parameters)))
+        return await self._conn.execute(sql, parameters)
+
+    async def executemany(self, sql: str, parameters):
+        parameters = list(parameters)
+        self.statements.append((sql, tuple(parameters[0]) if parameters else ()))
+        return await self._conn.executemany(sql, parameters)
+
+
+class Dataset:
+    """Случайные идентификаторы из БД для параметров хелперов."""
+
+    def __init__(self, path: str, rng: random.Random):
+        self.rng = rng
+        db = sqlite3.connect(path)
+
+        def ids(sql: str) -> List[Any]:
+            return [row[0] for row in db.execute(sql)]
+
+        self.users = ids("SELECT user_id FROM users ORDER BY random() LIMIT 2000")
+        self.referrers = ids("SELECT user_id FROM users ORDER BY referral_count DESC LIMIT 200")
+        self.sellers = ids("SELECT seller_id FROM seller_summary ORDER BY random() LIMIT 500") or self.users
+        self.ads = ids("SELECT id FROM ads ORDER BY random() LIMIT 500")
+        self.deals = ids("SELECT id FROM deals ORDER BY random() LIMIT 2000")
+        self.disputes = ids("SELECT id FROM deals WHERE status = 'dispute' LIMIT 500")
+        self.orders = ids("SELECT id FROM orders ORDER BY random() LIMIT 500")
+        self.coupons = ids("SELECT id FROM coupons")
+        self.pending_withdrawals = ids("SELECT id FROM orders WHERE type = 'withdraw_rub' AND status = 'pending' ORDER BY id")
+        self.tx_users = ids("SELECT user_id FROM transactions GROUP BY user_id ORDER BY count(*) DESC LIMIT 200") or self.users
+        # Якорь второй страницы истории: последняя строка первой (как при нажатии «Старее»)
+        self.tx_anchors = [
+            (user_id, (row[1], row[0])) for user_id in self.tx_users
+            for row in db.execute(
+                "SELECT id, created_at FROM transactions WHERE user_id = ? ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?",
+                (user_id, bot_module.HISTORY_PAGE_SIZE - 1)
+            )
+        ]
+        db.close()
+        self.new_ids = itertools.count(9_000_000_000)
+
+    def pick(self, values: list, default: Any = 0) -> Any:
+        return self.rng.choice(values) if values else default
+
+
+def build_cases(data: Dataset) -> List[Case]:
+    m = bot_module
+    pick = data.pick
+
+    async def create_deal(_):
+        ad_id = pick(data.ads)
+        ad = await m.get_ad_data(ad_id)
+        return await m.create_deal(pick(data.users), ad[1], ad_id, 500, ad[3], 500 * ad[3], "https://www.roblox.com/users/1/profile", "bench")
+
+    async def mark_deal_paid(deal_id):
+        return deal_id if await m.mark_deal_paid(deal_id) else None
+
+    async def set_deal_proof(deal_id):
+        await m.set_deal_proof(deal_id, f"bench-proof-{deal_id}")
+        return deal_id
+
+    async def complete_deal(deal_id):
+        return deal_id if await m.complete_deal(deal_id) else None
+
+    async def set_deal_dispute(deal_id):
+        await m.set_deal_dispute(deal_id, "Бенчмарк")
+        return deal_id
+
+    async def take_dispute(deal_id):
+        return deal_id if await m.take_dispute(deal_id, ADMIN_ID) else None
+
+    async def get_dispute_case(_):
+        return await m.get_dispute_case(pick(data.disputes or data.deals))
+
+    async def flush_ad_views(_):
+        # Буфер между сбросами: несколько просмотров разных продавцов
+        for _ in range(20):
+            m.record_ad_view(pick(data.sellers))
+        return await m.flush_ad_views()
+
+    async def create_review(deal_id):
+        deal = await m.get_deal_data(deal_id)
+        await m.create_review(deal[1], deal[2], deal_id, 5, "Бенчмарк")
+
+    cases = [
+        Case("get_config", lambda _: m.get_config("min_withdraw")),
+        Case("get_user_data", lambda _: m.get_user_data(pick(data.users))),
+        Case("get_user_balance", lambda _: m.get_user_balance(pick(data.users))),
+        Case("get_profile_snapshot", lambda _: m.get_profile_snapshot(pick(data.users))),
+        Case("get_profile_snapshot(seller)", lambda _: m.get_profile_snapshot(pick(data.sellers))),
+        Case("get_referral_report", lambda _: m.get_referral_report(pick(data.referrers))),
+        Case("get_all_user_ids", lambda _: m.get_all_user_ids()),
+        Case("get_transactions_page", lambda _: m.get_transactions_page(pick(data.tx_users))),
+        Case("get_transactions_page(older)", lambda _: m.get_transactions_page(*pick(data.tx_anchors, (0, None)))),
+        Case("get_orders_by_user", lambda _: m.get_orders_by_user(pick(data.sellers))),
+        Case("get_order_data", lambda _: m.get_order_data(pick(data.orders))),
+        Case("get_pending_withdrawals", lambda _: m.get_pending_withdrawals()),
+        Case("get_pending_withdrawal_totals", lambda _: m.get_pending_withdrawal_totals()),
+        Case("get_pending_withdrawal_ids", lambda _: m.get_pending_withdrawal_ids()),
+        Case("get_withdrawals_by_ids", lambda _: m.get_withdrawals_by_ids(data.pending_withdrawals[:20])),
+        Case("get_ads_by_user", lambda _: m.get_ads_by_user(pick(data.sellers))),
+        Case("get_active_ads", lambda _: m.get_active_ads()),
+        Case("get_ad_data", lambda _: m.get_ad_data(pick(data.ads))),
+        Case("get_deal_data", lambda _: m.get_deal_data(pick(data.deals))),
+        Case("get_deals_by_user(buyer)", lambda _: m.get_deals_by_user(pick(data.users), False)),
+        Case("get_deals_by_user(seller)", lambda _: m.get_deals_by_user(pick(data.sellers), True)),
+        Case("get_deals_by_user(completed)", lambda _: m.get_deals_by_user(pick(data.sellers), True, status="completed")),
+        Case("get_expired_unpaid_deals", lambda _: m.get_expired_unpaid_deals()),
+        Case("get_dispute_queue", lambda _: m.get_dispute_queue()),
+        Case("get_dispute_queue(min_rub)", lambda _: m.get_dispute_queue(min_rub=m.DISPUTE_BIG_RUB)),
+        Case("get_dispute_case", get_dispute_case),
+        Case("get_user_rating_avg", lambda _: m.get_user_rating_avg(pick(data.sellers))),
+        Case("get_reviews_for_user", lambda _: m.get_reviews_for_user(pick(data.sellers))),
+        Case("load_coupons", lambda _: m.load_coupons()),
+        Case("get_all_coupons", lambda _: m.get_all_coupons()),
+        Case("has_user_used_coupon", lambda _: m.has_user_used_coupon(pick(data.users), pick(data.coupons))),
+        Case("get_stats_by_period", lambda _: m.get_stats_by_period(30)),
+        Case("get_funnel", lambda _: m.get_funnel(30)),
+        Case("get_top_sellers", lambda _: m.get_top_sellers(30)),
+        Case("get_completion_percentiles", lambda _: m.get_completion_percentiles(30)),
+
+        Case("log_event", lambda _: m.log_event(pick(data.users), "BENCH", "db_bench"), write=True),
+        Case("set_config", lambda _: m.set_config("bench_key", str(data.rng.random())), write=True),
+        Case("update_user_balance", lambda _: m.update_user_balance(pick(data.users), round(data.rng.uniform(0, 1000), 2), ADMIN_ID), write=True),
+        Case("create_user_if_not_exists", lambda _: m.create_user_if_not_exists(
+            types.User(id=next(data.new_ids), is_bot=False, first_name="Bench"), pick(data.referrers)), write=True),
+        Case("set_user_active_coupon", lambda _: m.set_user_active_coupon(pick(data.users), None), write=True),
+        Case("create_order", lambda _: m.create_order(pick(data.users), "withdraw_rub", 10000, 100.0), write=True, output="orders"),
+        Case("update_order_status", lambda order_id: m.update_order_status(order_id, "completed"), write=True, source="orders:odd"),
+        Case("create_ad", lambda _: m.create_ad(pick(data.sellers), "Бенчмарк", 0.8, 100, 10000, "СБП", "db_bench"), write=True),
+        Case("toggle_ad_active", lambda _: m.toggle_ad_active(pick(data.ads), data.rng.randint(0, 1)), write=True),
+        Case("flush_ad_views", flush_ad_views, write=True),
+        Case("create_deal", create_deal, write=True, output="pending"),
+        Case("cancel_deal", lambda deal_id: m.cancel_deal(deal_id), write=True, source="pending:odd"),
+        Case("mark_deal_paid", mark_deal_paid, write=True, source="pending:even", output="paid"),
+        Case("set_deal_proof", set_deal_proof, write=True, source="paid", output="proof"),
+        Case("complete_deal", complete_deal, write=True, source="proof:even", output="completed"),
+        Case("create_review", create_review, write=True, source="completed"),
+        Case("set_deal_dispute", set_deal_dispute, write=True, source="proof:odd", output="dispute"),
+        Case("take_dispute", take_dispute, write=True, source="dispute", output="taken"),
+        Case("release_dispute", lambda deal_id: m.release_dispute(deal_id, ADMIN_ID), write=True, source="taken:odd"),
+        Case("resolve_deal_dispute", lambda deal_id: m.resolve_deal_dispute(deal_id, ADMIN_ID, ADMIN_ID, 0.0), write=True, source="taken:even"),
+        Case("complete_withdrawals", lambda order_id: m.complete_withdrawals([order_id], ADMIN_ID), write=True, source="orders:even"),
+        Case("create_or_update_coupon", lambda _: m.create_or_update_coupon(f"BENCH{next(data.new_ids)}", "percent", 5, 0, 0, True), write=True),
+        Case("reconcile_daily_stats", lambda _: m.reconcile_daily_stats(), write=True),
+        Case("archive_old_logs", lambda _: m.archive_old_logs(days=90), write=True),
+        Case("archive_finished_deals", lambda _: m.archive_finished_deals(days=180), write=True),
+    ]
+    return cases
+
+
+def plan_warnings(plan: str) -> bool:
+    """Полный скан таблицы (без индекса) или сортировка во временном B-дереве."""
+    return any(
+        (step.startswith("SCAN ") and " USING " not in step) or "TEMP B-TREE" in step
+        for step in plan.split(" | ")
+    )
+
+
+async def run_case(case: Case, items: Optional[list]) -> dict:
+    """Первый вызов - с записью запросов (для планов), дальше - замер до --duration или --max-ops."""
+    limit = args.max_ops if items is None else min(args.max_ops, len(items))
+    result = {"name": case.name, "write": case.write, "ops": 0, "ops_per_sec": 0.0, "p50_ms": 0.0, "p99_ms": 0.0,
+              "plans": [], "error": None, "outputs": []}
+    if limit == 0:
+        result["error"] = "no input rows"
+        return result
+
+    statements: list = []
+    original_connect = bot_module.db_connect
+    bot_module.db_connect = lambda: CapturingConnection(aiosqlite.connect(work_db), statements)
+    try:
+        value = await case.call(items[0] if items else None)
+        if value is not None:
+            result["outputs"].append(value)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        return result
+    finally:
+        bot_module.db_connect = original_connect
+
+    seen = set()
+    async with aiosqlite.connect(work_db) as db:
+        for sql, params in statements:
+            key = " ".join(sql.split())
+            if key in seen:
+                continue
+            seen.add(key)
+            plan = await bot_module.explain_query(db, sql, params)
+            if plan:
+                result["plans"].append({"sql": key, "plan": plan, "warning": plan_warnings(plan)})
+
+    samples = []
+    started = time.perf_counter()
+    for i in range(1, limit):
+        call_started = time.perf_counter()
+        try:
+            value = await case.call(items[i] if items else None)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            break
+        samples.append(time.perf_counter() - call_started)
+        if value is not None:
+            result["outputs"].append(value)
+        if time.perf_counter() - started >= args.duration:
+            break
+    elapsed = time.perf_counter() - started
+    if samples:
+        result.update(ops=len(samples), ops_per_sec=len(samples) / elapsed,
+                      p50_ms=percentile(samples, 50) * 1000, p99_ms=percentile(samples, 99) * 1000)
+    return result
+
+
+def print_report(results: List[dict]):
+    print(f"\n{'helper':<32}{'ops':>7}{'ops/sec':>11}{'p50 ms':>10}{'p99 ms':>10}  plan")
+    for r in results:
+        flag = "!" if any(p["warning"] for p in r["plans"]) else ""
+        note = r["error"] or ""
+        print(f"{r['name']:<32}{r['ops']:>7}{r['ops_per_sec']:>11.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}  {flag:<2}{note}")
+    print("\nQuery plans ('!' - full table scan or temp B-tree):")
+    for r in results:
+        if not r["plans"]:
+            continue
+        print(f"\n{r['name']}")
+        for p in r["plans"]:
+            sql = p["sql"] if len(p["sql"]) <= 140 else p["sql"][:137] + "..."
+            print(f"  {'!' if p['warning'] else ' '} {sql}\n      {p['plan']}")
+
+
+async def run_benchmarks():
+    rng = random.Random(args.seed)
+    data = Dataset(work_db, rng)
+    cases = build_cases(data)
+    pools: Dict[str, list] = {}
+    if args.skip_writes:
+        cases = [c for c in cases if not c.write]
+    if args.only:
+        cases = [c for c in cases if any(s in c.name for s in args.only)]
+    print(f"Benchmarking {len(cases)} helpers on {work_db} ({os.path.getsize(work_db) / 2**20:,.0f} MiB)")
+
+    results = []
+    for case in cases:
+        items = None
+        if case.source:
+            name, _, part = case.source.partition(":")
+            items = pools.get(name, [])
+            items = items[::2] if part == "even" else items[1::2] if part == "odd" else items
+        result = await run_case(case, items)
+        if case.output:
+            pools[case.output] = result["outputs"]
+        del result["outputs"]
+        results.append(result)
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"db": args.db, "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"\nSaved {args.json}")
+    if not args.in_place:
+        shutil.rmtree(os.path.dirname(work_db), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(generate() if args.command == "generate" else run_benchmarks())
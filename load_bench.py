@@ -0,0 +1,448 @@
+"""
+Нагрузочный прогон бота целиком: Dispatcher + фейковый Bot API + фейковая YooKassa.
+
+    python load_bench.py --users 200 --concurrency 50 --scenarios browse,buy,withdraw,broadcast
+
+Бот работает как в проде (тот же Dispatcher, middleware, aiosqlite), но HTTP-запросы к Bot API уходят
+на локальный aiohttp-сервер (--api-latency - задержка ответа, --blocked - доля "заблокировавших бота").
+Оплата идёт через заглушку yookassa.Payment: покупатель открывает ссылку оплаты на фейковой YooKassa,
+та шлёт payment.succeeded на вебхук бота (build_web_app) по HTTP.
+
+Сценарии (каждый виртуальный пользователь проходит скрипт апдейтов по порядку):
+  browse    - /start, каталог объявлений, карточка объявления, профиль
+  buy       - полная P2P-покупка: сумма, ссылка Roblox, оплата, вебхук, пруф, подтверждение продавцом
+  withdraw  - заявка на вывод
+  broadcast - рассылка администратора всем пользователям БД (--broadcast-users)
+
+По каждому сценарию печатаются p50/p95/p99 латентности апдейта и апдейты/сек. Рабочая БД (--db)
+создаётся заново при каждом запуске.
+"""
+import os
+import argparse
+import asyncio
+import itertools
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end load benchmark of the bot against fake Telegram and YooKassa servers")
+    parser.add_argument("--db", default="bench.db", help="рабочая БД прогона, пересоздаётся (по умолчанию bench.db)")
+    parser.add_argument("--scenarios", default="browse,buy,withdraw,broadcast", help="сценарии через запятую")
+    parser.add_argument("--users", type=int, default=200, help="виртуальных пользователей на сценарий")
+    parser.add_argument("--concurrency", type=int, default=50, help="сколько пользователей действуют одновременно")
+    parser.add_argument("--sellers", type=int, default=20, help="продавцов (по одному объявлению у каждого)")
+    parser.add_argument("--broadcast-users", type=int, default=50000, help="пользователей в БД для рассылки")
+    parser.add_argument("--broadcast-rate", type=float, default=0, help="BULK_SEND_RATE при прогоне, 0 - без ограничения")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка ответа фейкового Bot API, мс")
+    parser.add_argument("--yookassa-latency", type=float, default=0.0,
+                        help="задержка Payment.create/find_one, мс (SDK синхронный - блокирует цикл, как в проде)")
+    parser.add_argument("--blocked", type=float, default=0.0, help="доля массовки рассылки, заблокировавшей бота (0..1)")
+    parser.add_argument("--seed", type=int, default=1, help="seed генератора случайных выборов")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+if os.path.basename(args.db) == "robux_bot.db":
+    raise SystemExit("Refusing to overwrite robux_bot.db - pass a separate --db for the benchmark")
+for suffix in ("", "-wal", "-shm"):
+    if os.path.exists(args.db + suffix):
+        os.remove(args.db + suffix)
+
+# Бот читает конфигурацию при импорте: подменяем токен, БД и лимит рассылки
+os.environ["BOT_TOKEN"] = "123456:BENCH"
+os.environ["DB_PATH"] = args.db
+os.environ["BULK_SEND_RATE"] = str(args.broadcast_rate)
+os.environ["RECORD_UPDATES"] = ""
+os.environ["SHARD_ROLE"] = ""
+os.environ["TG_WEBHOOK"] = "0"
+
+import robloxxnadfix2 as bot_module
+from robloxxnadfix2 import percentile
+from aiogram import types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientSession, web
+
+ADMIN_ID = 1
+SELLER_BASE = 2_000_000
+USER_BASE = 3_000_000
+FILLER_BASE = 10_000_000
+
+
+class FakeTelegramServer:
+    """Локальный Bot API: POST /bot<token>/<method>, считает вызовы по методам.
+    Работает в отдельном потоке со своим циклом, чтобы не отнимать время у цикла бота."""
+
+    def __init__(self, latency: float = 0.0, blocked: float = 0.0):
+        self.latency = latency
+        self.blocked = blocked
+        self.calls: Counter = Counter()
+        self.url = ""
+        self._ids = itertools.count(1)
+        self._ready = threading.Event()
+
+    def is_blocked(self, chat_id: int) -> bool:
+        # Блокируют бота только пользователи массовки: активные участники сценариев его не блокировали
+        return self.blocked > 0 and chat_id >= FILLER_BASE and (chat_id * 2654435761) % 10000 < self.blocked * 10000
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        chat_id = form.get("chat_id", "0")
+        chat_id = int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0
+        name = method.lower()
+        if name == "getme":
+            result: Any = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif name.startswith(("send", "forward")) and self.is_blocked(chat_id):
+            self.calls["(blocked)"] += 1
+            return web.json_response(
+                {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}, status=403
+            )
+        elif name == "copymessage":
+            result = {"message_id": next(self._ids)}
+        elif name.startswith(("send", "edit", "forward")):
+            result = {
+                "message_id": next(self._ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": form.get("text") or form.get("caption"),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def start(self):
+        threading.Thread(target=self._run, name="fake-telegram", daemon=True).start()
+        self._ready.wait()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.url = loop.run_until_complete(start_site(app))
+        self._ready.set()
+        loop.run_forever()
+
+
+class FakePayment:
+    """Ответ yookassa.Payment.create/find_one с нужными боту полями."""
+
+    def __init__(self, data: dict, confirmation_url: str):
+        self.data = data
+        self.id = data["id"]
+        self.status = data["status"]
+        self.confirmation = SimpleNamespace(confirmation_url=confirmation_url)
+
+    def json(self) -> dict:
+        return dict(self.data)
+
+
+class FakeYooKassa:
+    """Заглушка yookassa.Payment + страница оплаты, которая шлёт вебхук payment.succeeded в бота."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.payments: Dict[str, dict] = {}
+        self.by_buyer: Dict[int, str] = {}
+        self.url = ""
+        self.webhook_url = ""
+        self._ids = itertools.count(1)
+        self._ready = threading.Event()
+        self._http: Optional[ClientSession] = None
+
+    def create(self, params: dict, idempotency_key: Optional[str] = None) -> FakePayment:
+        if self.latency:
+            time.sleep(self.latency)
+        payment_id = f"bench-{next(self._ids)}"
+        self.payments[payment_id] = {
+            "id": payment_id, "status": "pending", "paid": False,
+            "amount": params["amount"], "description": params.get("description"), "metadata": params.get("metadata", {}),
+        }
+        self.by_buyer[int(params["metadata"]["buyer_id"])] = payment_id
+        return FakePayment(self.payments[payment_id], f"{self.url}/checkout/{payment_id}")
+
+    def find_one(self, payment_id: str) -> FakePayment:
+        if self.latency:
+            time.sleep(self.latency)
+        return FakePayment(self.payments[payment_id], f"{self.url}/checkout/{payment_id}")
+
+    async def checkout(self, request: web.Request) -> web.Response:
+        payment = self.payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.Response(status=404)
+        payment.update(status="succeeded", paid=True)
+        notification = {"type": "notification", "event": "payment.succeeded", "object": payment}
+        async with self._http.post(self.webhook_url, json=notification) as response:
+            return web.Response(status=response.status)
+
+    def start(self):
+        threading.Thread(target=self._run, name="fake-yookassa", daemon=True).start()
+        self._ready.wait()
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        app = web.Application()
+        app.router.add_post("/checkout/{payment_id}", self.checkout)
+
+        async def setup():
+            self._http = ClientSession()
+            return await start_site(app)
+
+        self.url = loop.run_until_complete(setup())
+        self._ready.set()
+        loop.run_forever()
+
+
+async def start_site(app: web.Application) -> str:
+    """Запускает приложение на свободном порту 127.0.0.1 и возвращает базовый URL."""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return f"http://{host}:{port}"
+
+
+class ScenarioStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.samples: List[float] = []
+        self.errors: Counter = Counter()
+        self.elapsed = 0.0
+        self.notes: List[str] = []
+
+
+class VirtualUser:
+    """Пользователь Telegram: шлёт апдейты в Dispatcher и замеряет время их обработки."""
+
+    _update_ids = itertools.count(1)
+    _message_ids = itertools.count(1)
+
+    def __init__(self, bench: "Bench", stats: ScenarioStats, user_id: int):
+        self.bench = bench
+        self.stats = stats
+        self.user_id = user_id
+        self.sender = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.last_message_id = next(self._message_ids)
+
+    async def feed(self, payload: dict):
+        update = types.Update.model_validate({"update_id": next(self._update_ids), **payload}, context={"bot": self.bench.bot})
+        await self.timed(bot_module.dp.feed_update(self.bench.bot, update), handler_name(payload))
+
+    async def timed(self, call: Awaitable[Any], name: str):
+        start = time.perf_counter()
+        try:
+            await call
+        except Exception as e:
+            self.stats.errors[f"{name}:{type(e).__name__}"] += 1
+        self.stats.samples.append(time.perf_counter() - start)
+
+    async def message(self, text: Optional[str] = None, photo: bool = False):
+        message: Dict[str, Any] = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": self.chat, "from": self.sender}
+        if photo:
+            message["photo"] = [{"file_id": f"proof-{self.user_id}", "file_unique_id": f"p{self.user_id}", "width": 1280, "height": 720}]
+        else:
+            message["text"] = text
+        await self.feed({"message": message})
+
+    async def press(self, data: str):
+        message = {"message_id": self.last_message_id, "date": int(time.time()), "chat": self.chat, "text": "..."}
+        await self.feed({"callback_query": {
+            "id": str(next(self._update_ids)), "chat_instance": str(self.user_id),
+            "from": self.sender, "message": message, "data": data,
+        }})
+
+
+def handler_name(payload: dict) -> str:
+    if "callback_query" in payload:
+        return payload["callback_query"]["data"].partition(":")[0]
+    return "message"
+
+
+class Bench:
+    def __init__(self, bot, api: FakeTelegramServer, yookassa: FakeYooKassa, ads: List[tuple]):
+        self.bot = bot
+        self.api = api
+        self.yookassa = yookassa
+        self.ads = ads
+        self.rng = random.Random(args.seed)
+
+
+# --- Сценарии ---
+async def scenario_browse(bench: Bench, user: VirtualUser):
+    ad_id, _ = bench.rng.choice(bench.ads)
+    await user.message("/start")
+    await user.press("menu_buy")
+    await user.press("buy_list_ads")
+    await user.press(bot_module.BuySelectAdCb(ad_id=ad_id).pack())
+    await user.press("menu_buy")
+    await user.press("menu_profile")
+    await user.press("back_main")
+
+
+async def scenario_buy(bench: Bench, user: VirtualUser):
+    ad_id, seller_id = bench.rng.choice(bench.ads)
+    await user.press("menu_buy")
+    await user.press("buy_list_ads")
+    await user.press(bot_module.BuySelectAdCb(ad_id=ad_id).pack())
+    await user.message("100")
+    await user.message(f"https://www.roblox.com/users/{user.user_id}/profile")
+    await user.press("deal_confirm_pay")
+
+    payment_id = bench.yookassa.by_buyer.get(user.user_id)
+    if payment_id is None:
+        user.stats.errors["deal_confirm_pay:no payment"] += 1
+        return
+    # Покупатель оплачивает на стороне YooKassa, бот получает вебхук
+    async with ClientSession() as http:
+        await user.timed(http.post(f"{bench.yookassa.url}/checkout/{payment_id}"), "yookassa_webhook")
+    deal_id = int(bench.yookassa.payments[payment_id]["metadata"]["deal_id"])
+
+    await user.press(bot_module.DealUploadProofCb(deal_id=deal_id).pack())
+    await user.message(photo=True)
+    seller = VirtualUser(bench, user.stats, seller_id)
+    await seller.press(bot_module.DealCompleteSellerCb(deal_id=deal_id).pack())
+
+
+async def scenario_withdraw(bench: Bench, user: VirtualUser):
+    await user.press("profile_withdraw")
+    await user.message("150")
+    await user.press(bot_module.WithdrawMethodCb(method="sbp").pack())
+    await user.message(f"+7999{user.user_id % 10_000_000:07d}")
+
+
+async def scenario_broadcast(bench: Bench, user: VirtualUser):
+    await user.press("adm_broadcast")
+    await user.message("Нагрузочный тест рассылки")
+    sent_before = bench.api.calls["sendMessage"]
+    start = time.perf_counter()
+    await user.press("broadcast_confirm")
+    elapsed = time.perf_counter() - start
+    sent = bench.api.calls["sendMessage"] - sent_before
+    user.stats.notes.append(f"{sent} sendMessage in {elapsed:.2f} s ({sent / elapsed if elapsed else 0:.0f} msg/s)")
+
+
+SCENARIOS: Dict[str, Callable[[Bench, VirtualUser], Awaitable[None]]] = {
+    "browse": scenario_browse,
+    "buy": scenario_buy,
+    "withdraw": scenario_withdraw,
+    "broadcast": scenario_broadcast,
+}
+
+
+def seed_database(path: str, scenarios: List[str]) -> List[tuple]:
+    """Продавцы с объявлениями, виртуальные пользователи (с балансом для вывода) и массовка для рассылки."""
+    db = sqlite3.connect(path)
+    sellers = [(SELLER_BASE + i, f"seller{i}", 0.0) for i in range(args.sellers)]
+    users = [(USER_BASE + n * 100_000 + i, None, 1000.0) for n in range(len(scenarios)) for i in range(args.users)]
+    db.executemany("INSERT OR IGNORE INTO users(user_id, username, balance) VALUES(?,?,?)",
+                   [(ADMIN_ID, "admin", 0.0)] + sellers + users)
+    filler = max(0, args.broadcast_users - 1 - len(sellers) - len(users)) if "broadcast" in scenarios else 0
+    for start in range(0, filler, 10_000):
+        db.executemany("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?)",
+                       ((FILLER_BASE + i, None) for i in range(start, min(filler, start + 10_000))))
+    rng = random.Random(args.seed)
+    db.executemany(
+        "INSERT INTO ads(user_id, title, rate, min_amount, max_amount, payment_methods, active, description) VALUES(?,?,?,?,?,?,1,?)",
+        [(seller_id, f"Robux от {name}", round(rng.uniform(0.5, 1.2), 2), 10, 10_000, "СБП, карта", "Быстрая выдача")
+         for seller_id, name, _ in sellers]
+    )
+    db.commit()
+    ads = db.execute("SELECT id, user_id FROM ads WHERE active = 1").fetchall()
+    db.close()
+    return ads
+
+
+def print_report(results: List[ScenarioStats], api: FakeTelegramServer):
+    print(f"\n{'scenario':<12}{'updates':>9}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'upd/s':>10}")
+    for stats in results:
+        values = stats.samples or [0.0]
+        rate = len(stats.samples) / stats.elapsed if stats.elapsed else 0
+        print(f"{stats.name:<12}{len(stats.samples):>9}{sum(stats.errors.values()):>8}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{max(values) * 1000:>10.1f}{rate:>10.1f}")
+    for stats in results:
+        for note in stats.notes:
+            print(f"{stats.name}: {note}")
+        if stats.errors:
+            print(f"{stats.name} errors: " + ", ".join(f"{k}={v}" for k, v in stats.errors.most_common()))
+    print("Bot API calls: " + ", ".join(f"{k}={v}" for k, v in api.calls.most_common()))
+
+
+async def run_scenario(bench: Bench, name: str, index: int) -> ScenarioStats:
+    stats = ScenarioStats(name)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    scenario = SCENARIOS[name]
+    user_ids = [ADMIN_ID] if name == "broadcast" else [USER_BASE + index * 100_000 + i for i in range(args.users)]
+
+    async def run(user_id: int):
+        async with semaphore:
+            await scenario(bench, VirtualUser(bench, stats, user_id))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run(user_id) for user_id in user_ids))
+    stats.elapsed = time.perf_counter() - started
+
+    # Проверка, что сценарий действительно дошёл до конца, а не только отработал без исключений
+    marks = ", ".join("?" for _ in user_ids)
+    async with bot_module.db_connect() as db:
+        if name == "buy":
+            cur = await db.execute(f"SELECT COUNT(*) FROM deals WHERE status = 'completed' AND buyer_id IN ({marks})", user_ids)
+            stats.notes.append(f"completed deals: {(await cur.fetchone())[0]}/{len(user_ids)}")
+        elif name == "withdraw":
+            cur = await db.execute(f"SELECT COUNT(*) FROM orders WHERE status = 'pending' AND user_id IN ({marks})", user_ids)
+            stats.notes.append(f"withdraw requests: {(await cur.fetchone())[0]}/{len(user_ids)}")
+    return stats
+
+
+async def bench_main():
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(unknown)} (available: {', '.join(SCENARIOS)})")
+
+    api = FakeTelegramServer(args.api_latency / 1000, args.blocked)
+    api.start()
+    yookassa = FakeYooKassa(args.yookassa_latency / 1000)
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api.url))
+    bot_module.setup_bot_session(session)
+    bot = bot_module.bot
+    bot.session = session
+    bot_module.ADMIN_IDS.add(ADMIN_ID)
+    bot_module.throttling.limit = 0
+    bot_module.Payment = yookassa
+    bot_module.YOOINSTALLED = True
+    bot_module.YOOKASSA_SHOP_ID = bot_module.YOOKASSA_SHOP_ID or "bench"
+    bot_module.YOOKASSA_SECRET_KEY = bot_module.YOOKASSA_SECRET_KEY or "bench"
+
+    # Вебхук YooKassa принимает тот же web-app, что и в проде
+    webhook_url = await start_site(bot_module.build_web_app())
+    yookassa.webhook_url = webhook_url + bot_module.WEBHOOK_PATH
+    yookassa.start()
+
+    await bot_module.init_db()
+    ads = seed_database(args.db, scenarios)
+    bench = Bench(bot, api, yookassa, ads)
+    print(f"Seeded {args.db}: {len(ads)} ads, scenarios: {', '.join(scenarios)}, "
+          f"{args.users} users x concurrency {args.concurrency}")
+
+    results = []
+    for index, name in enumerate(scenarios):
+        print(f"Running {name}...")
+        results.append(await run_scenario(bench, name, index))
+    await session.close()
+    print_report(results, api)
+
+
+if __name__ == "__main__":
+    asyncio.run(bench_main())
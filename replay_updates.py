@@ -0,0 +1,228 @@
+"""
+Воспроизведение записанных апдейтов против бота без Telegram.
+
+Запись включается в боте переменной RECORD_UPDATES=updates.jsonl: каждый входящий апдейт
+(без имён и контактов) и каждый вебхук YooKassa дописываются строкой JSON.
+
+    python replay_updates.py updates.jsonl --db replay.db --from-db robux_bot.db --speed 10 --no-throttle
+
+Апдейты подаются в тот же Dispatcher, что и в проде, но запросы к Bot API уходят в фейковую
+сессию (с опциональной задержкой --api-latency). В конце печатается пропускная способность и
+латентность p50/p95/p99 по обработчикам. Рабочая БД - отдельный файл (--db), боевая не трогается.
+"""
+import os
+import argparse
+import asyncio
+import itertools
+import json
+import sqlite3
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates and YooKassa webhooks against the bot")
+    parser.add_argument("files", nargs="+", help="JSONL-файлы записи (RECORD_UPDATES), можно несколько (шарды)")
+    parser.add_argument("--db", default="replay.db", help="рабочая БД для прогона (по умолчанию replay.db)")
+    parser.add_argument("--from-db", help="скопировать эту БД в --db перед прогоном (например, снапшот из /backup)")
+    parser.add_argument("--speed", type=float, default=1.0, help="1 - как в записи, 10 - в 10 раз быстрее, 0 - без пауз")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько апдейтов обрабатывается одновременно")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка фейкового Bot API, мс")
+    parser.add_argument("--no-throttle", action="store_true", help="отключить анти-спам (нужно при ускоренном прогоне)")
+    parser.add_argument("--admin", type=int, action="append", default=[], help="user_id, считающийся админом при прогоне")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Бот читает конфигурацию при импорте: подменяем токен и БД, запись апдейтов выключаем
+os.environ["BOT_TOKEN"] = "123456:REPLAY"
+os.environ["DB_PATH"] = args.db
+os.environ["RECORD_UPDATES"] = ""
+os.environ["SHARD_ROLE"] = ""
+os.environ["TG_WEBHOOK"] = "0"
+
+if args.from_db:
+    src, dst = sqlite3.connect(args.from_db), sqlite3.connect(args.db)
+    src.backup(dst)
+    src.close()
+    dst.close()
+
+import robloxxnadfix2 as bot_module
+from robloxxnadfix2 import percentile
+from aiogram import BaseMiddleware, types
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message, MessageId, User
+
+
+class FakeTelegramSession(BaseSession):
+    """Сессия Bot API без сети: считает вызовы и возвращает правдоподобные ответы."""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        returning = repr(method.__returning__)
+        if "MessageId" in returning:
+            return MessageId(message_id=next(self._ids))
+        if "Message" in returning:
+            chat_id = getattr(method, "chat_id", None)
+            chat_id = int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0
+            message = Message(
+                message_id=next(self._ids), date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"), text=getattr(method, "text", None)
+            )
+            return [message] if returning.startswith("list") else message
+        if method.__returning__ is User:
+            return User(id=123456, is_bot=True, first_name="Replay")
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+class ReplayTimerMiddleware(BaseMiddleware):
+    """Собирает время каждого обработчика (имя - как в метриках бота)."""
+
+    def __init__(self, samples: Dict[str, List[float]], errors: Counter):
+        self.samples = samples
+        self.errors = errors
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = bot_module.handler_name(data)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors[name] += 1
+            raise
+        finally:
+            self.samples[name].append(time.perf_counter() - start)
+
+
+class FakeRequest:
+    """Минимальная замена aiohttp.web.Request для handle_yookassa_webhook."""
+
+    def __init__(self, body: dict):
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+def load_records(paths: List[str]) -> List[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def record_user_id(record: dict) -> int:
+    """user_id отправителя - апдейты одного пользователя обрабатываются по порядку."""
+    update = record.get("telegram") or {}
+    for key in ("message", "callback_query", "edited_message", "pre_checkout_query", "inline_query"):
+        sender = (update.get(key) or {}).get("from")
+        if sender:
+            return sender["id"]
+    return 0
+
+
+def print_report(total: int, elapsed: float, samples: Dict[str, List[float]], errors: Counter,
+                 failed: Counter, session: FakeTelegramSession):
+    print(f"\nReplayed {total} events in {elapsed:.2f} s ({total / elapsed if elapsed else 0:.1f} events/s), "
+          f"failed: {sum(failed.values())}")
+    print(f"{'handler':<34}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for name, values in sorted(samples.items(), key=lambda kv: -len(kv[1])):
+        print(f"{name:<34}{len(values):>8}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 95) * 1000:>10.1f}"
+              f"{percentile(values, 99) * 1000:>10.1f}{max(values) * 1000:>10.1f}{errors[name]:>8}")
+    if failed:
+        print("Failed events: " + ", ".join(f"{k}={v}" for k, v in failed.most_common()))
+    if session.calls:
+        print("Bot API calls: " + ", ".join(f"{k}={v}" for k, v in session.calls.most_common()))
+
+
+async def replay():
+    records = load_records(args.files)
+    if not records:
+        print("No records to replay.")
+        return
+
+    session = FakeTelegramSession(args.api_latency / 1000)
+    bot_module.setup_bot_session(session)
+    bot = bot_module.bot
+    bot.session = session
+    bot_module.ADMIN_IDS.update(args.admin)
+    if args.no_throttle:
+        bot_module.throttling.limit = 0
+    await bot_module.init_db()
+
+    samples: Dict[str, List[float]] = defaultdict(list)
+    errors: Counter = Counter()
+    failed: Counter = Counter()
+    timer = ReplayTimerMiddleware(samples, errors)
+    bot_module.dp.message.middleware(timer)
+    bot_module.dp.callback_query.middleware(timer)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def run(record: dict):
+        user_id = record_user_id(record)
+        lock = user_locks[user_id] if user_id else None
+        if lock:
+            await lock.acquire()
+        try:
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    if record["kind"] == "telegram":
+                        update = types.Update.model_validate(record["telegram"], context={"bot": bot})
+                        await bot_module.dp.feed_update(bot, update)
+                    elif record["kind"] == "yookassa":
+                        await bot_module.handle_yookassa_webhook(FakeRequest(record["yookassa"]))
+                        samples["yookassa_webhook"].append(time.perf_counter() - start)
+                except Exception as e:
+                    failed[f"{record['kind']}:{type(e).__name__}"] += 1
+                samples["(update total)"].append(time.perf_counter() - start)
+        finally:
+            if lock:
+                lock.release()
+
+    t0 = records[0]["ts"]
+    started = time.monotonic()
+    tasks = []
+    for record in records:
+        if args.speed > 0:
+            delay = (record["ts"] - t0) / args.speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run(record)))
+    await asyncio.gather(*tasks)
+
+    print_report(len(records), time.monotonic() - started, samples, errors, failed, session)
+
+
+if __name__ == "__main__":
+    asyncio.run(replay())
@@ -1,13 +1,27 @@
 import os
+import sys
 import asyncio
 import logging
+import logging.handlers
 import re
+import csv
+import io
+import string
 import time
+import math
 import uuid
 import json
+import gzip
+import sqlite3
+import hashlib
+import hmac
+import functools
+from collections import OrderedDict
 from decimal import Decimal
-from typing import Optional, Tuple, Any, Callable, Dict, Awaitable
+from typing import Optional, Tuple, Any, Callable, Dict, Awaitable, NamedTuple
 from aiogram.filters import Command, CommandStart, CommandObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.dispatcher.event.handler import CallableObject
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 import aiosqlite
 from dotenv import load_dotenv
@@ -16,8 +30,11 @@ from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import StatesGroup, State
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.client.session.base import BaseSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import EditMessageText, EditMessageCaption, EditMessageReplyMarkup, DeleteMessage
 from aiohttp import web
 from datetime import datetime, timedelta
 
@@ -35,17 +52,66 @@ try:
 except ImportError:
     pass
 
+# Шифрование реквизитов выплат (опционально, пакет cryptography)
+CRYPTOINSTALLED = False
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+    CRYPTOINSTALLED = True
+except ImportError:
+    pass
+
 load_dotenv()
 dp = Dispatcher(storage=storage)
 
 # --- Утилиты ---
+# Символы, которые нужно экранировать в MarkdownV2: _ * [ ] ( ) ~ ` > # + - = | { } . ! и сам \
+_MD_ESCAPE = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+_MD_URL_ESCAPE = str.maketrans({")": "\\)", "\\": "\\\\"})
+
+
+class Md(str):
+    """Готовый (уже экранированный) фрагмент MarkdownV2 - повторно не экранируется."""
+
 def escape_markdown_v2(text: str) -> str:
     """Экранирует специальные символы для Telegram's MarkdownV2 parse mode."""
     if text is None:
         return ""
-    # Символы, которые нужно экранировать в MarkdownV2:
-    # _, *, [, ], (, ), ~, `, >, #, +, -, =, |, {, }, ., !
-    return re.sub(r'([_*\[\]()~`>#+\-=|{}.!])', r'\\\1', str(text))
+    if isinstance(text, Md):
+        return text
+    return str(text).translate(_MD_ESCAPE)
+
+def md_bold(text) -> Md:
+    return Md(f"*{escape_markdown_v2(text)}*")
+
+def md_code(text) -> Md:
+    return Md(f"`{escape_markdown_v2(text)}`")
+
+def md_link(text, url: str) -> Md:
+    return Md(f"[{escape_markdown_v2(text)}]({str(url).translate(_MD_URL_ESCAPE)})")
+
+def md_user(user_id: int, label: Optional[str] = None) -> Md:
+    """Упоминание пользователя ссылкой tg://user."""
+    return md_link(label or f"User {user_id}", f"tg://user?id={user_id}")
+
+class MdTemplate:
+    """Шаблон сообщения MarkdownV2: статичный текст экранируется один раз при импорте.
+    В статичном тексте **жирный** и `код` остаются разметкой; поля {name:spec}
+    форматируются и экранируются при рендере (значения Md вставляются как есть)."""
+
+    def __init__(self, source: str):
+        self.parts = []
+        for literal, field, spec, _ in string.Formatter().parse(source):
+            literal = escape_markdown_v2(literal).replace("\\*\\*", "*").replace("\\`", "`")
+            self.parts.append((literal, field, spec or ""))
+
+    def __call__(self, **values) -> Md:
+        out = []
+        for literal, field, spec in self.parts:
+            out.append(literal)
+            if field is not None:
+                value = values[field]
+                out.append(value if isinstance(value, Md) and not spec else escape_markdown_v2(format(value, spec)))
+        return Md("".join(out))
 
 def format_date(dt_str: str) -> str:
     """Форматирует строку даты для вывода."""
@@ -68,7 +134,52 @@ NOTIFY_GROUP_ID = os.getenv("NOTIFY_GROUP_ID")
 WEBHOOK_HOST = os.getenv("WEBHOOK_HOST","")
 WEBHOOK_PATH = "/yookassa_webhook"
 PORT = int(os.getenv("PORT","8080"))
+# Webhook-режим Telegram (вместо polling), обслуживается тем же aiohttp-сервером
+TG_WEBHOOK_ENABLED = os.getenv("TG_WEBHOOK", "0").lower() in ("1", "true", "yes")
+TG_WEBHOOK_PATH = os.getenv("TG_WEBHOOK_PATH", "/tg_webhook")
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET", "")
+# /metrics: с токеном - только с заголовком "Authorization: Bearer <токен>", без токена - только с localhost
+# (за обратным прокси на том же хосте все запросы идут с localhost - тогда задайте токен)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+# Шардирование: фронт-процесс раздаёт апдейты N воркерам по user_id через Unix-сокеты
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_SOCKET_DIR = os.getenv("SHARD_SOCKET_DIR", "/tmp")
+SHARD_ROLE = os.getenv("SHARD_ROLE", "")
+SHARD_INDEX = int(os.getenv("SHARD_INDEX", "0"))
 REFERRAL_BONUS_RUB = 5.0 # Бонус рефереру за привлечение
+REFERRAL_TREE_DEPTH = int(os.getenv("REFERRAL_TREE_DEPTH", "5")) # Глубина отчёта по реферальному дереву (/referrals)
+REFERRAL_TREE_DEPTH_MAX = int(os.getenv("REFERRAL_TREE_DEPTH_MAX", "10")) # Потолок глубины из аргумента /referrals (рекурсивный CTE)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0")) # 0 - журнал медленных запросов выключен
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "slow_queries.log")
+# Ретеншн логов выключен по умолчанию (0 = хранить всё в БД). Чтобы включить, задайте число дней, например
+# LOG_RETENTION_DAYS=90: раз в 6 часов логи старше переносятся пачками в LOG_ARCHIVE_DIR/logs-YYYY-MM.jsonl.gz
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "0"))
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "log_archive")
+LOG_ARCHIVE_BATCH = int(os.getenv("LOG_ARCHIVE_BATCH", "5000"))
+# Архив сделок выключен по умолчанию (0 = не переносить). Включается числом дней, например DEALS_ARCHIVE_DAYS=180:
+# завершённые сделки старше раз в 6 часов переносятся в deals_archive. История покупок/продаж и перцентили
+# времени завершения читают только deals - перенесённые сделки из них пропадут; значение должно быть больше 90 дней
+DEALS_ARCHIVE_DAYS = int(os.getenv("DEALS_ARCHIVE_DAYS", "0"))
+DEALS_ARCHIVE_BATCH = int(os.getenv("DEALS_ARCHIVE_BATCH", "500"))
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7")) # Сколько снапшотов хранить
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "24")) # 0 = только вручную (/backup)
+ANALYTICS_CACHE_TTL = int(os.getenv("ANALYTICS_CACHE_TTL", "300")) # Сек. жизни кэша админ-аналитики
+AD_VIEWS_FLUSH_SEC = int(os.getenv("AD_VIEWS_FLUSH_SEC", "30")) # Просмотры объявлений копятся в памяти и пишутся в БД раз в N сек.
+COUPON_INDEX_TTL = int(os.getenv("COUPON_INDEX_TTL", "60")) # Сек. до перечитывания индекса купонов из БД
+DEAL_PAYMENT_TIMEOUT_MIN = int(os.getenv("DEAL_PAYMENT_TIMEOUT_MIN", "60")) # Неоплаченная сделка старше - отменяется, купон освобождается
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "10")) # Строк на странице истории (транзакции, сделки)
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", "4096")) # Параметризованных клавиатур в памяти (deal_id x статус)
+EDIT_CACHE_SIZE = int(os.getenv("EDIT_CACHE_SIZE", "10000")) # Сколько сообщений помнить для пропуска пустых правок
+DISPUTE_PAGE_SIZE = int(os.getenv("DISPUTE_PAGE_SIZE", "5")) # Споров на странице очереди
+DISPUTE_LOCK_MIN = int(os.getenv("DISPUTE_LOCK_MIN", "30")) # Через сколько минут закрепление спора за админом истекает
+DISPUTE_BIG_RUB = int(os.getenv("DISPUTE_BIG_RUB", "1000")) # Порог фильтра "крупные споры"
+BULK_SEND_RATE = float(os.getenv("BULK_SEND_RATE", "25")) # Сообщений в секунду при массовой отправке (лимит Telegram ~30)
+WITHDRAW_BATCH_MAX = int(os.getenv("WITHDRAW_BATCH_MAX", "200")) # Максимум заявок в одной пакетной выплате
+PAYOUT_ENCRYPTION_KEY = os.getenv("PAYOUT_ENCRYPTION_KEY", "") # Fernet-ключ для реквизитов выплат (пусто - без шифрования)
+RECORD_UPDATES = os.getenv("RECORD_UPDATES", "") # JSONL-файл записи входящих апдейтов и вебхуков YooKassa для replay_updates.py (пусто - выключено)
 
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN not found in environment (.env)")
@@ -78,6 +189,7 @@ logger = logging.getLogger(__name__)
 
 bot = Bot(token=BOT_TOKEN)
 WEBHOOK_URL = f"{WEBHOOK_HOST}{WEBHOOK_PATH}"
+TG_WEBHOOK_URL = f"{WEBHOOK_HOST}{TG_WEBHOOK_PATH}"
 
 # --- Инициализация YooKassa ---
 if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY and YOOINSTALLED:
@@ -90,6 +202,37 @@ if YOOKASSA_SHOP_ID and YOOKASSA_SECRET_KEY and YOOINSTALLED:
 elif (YOOKASSA_SHOP_ID or YOOKASSA_SECRET_KEY) and not YOOINSTALLED:
     logger.warning("YooKassa keys found but yookassa package is missing. Install yookassa to enable payments.")
 
+# --- Шифрование реквизитов выплат ---
+payout_cipher = None
+if PAYOUT_ENCRYPTION_KEY and CRYPTOINSTALLED:
+    try:
+        payout_cipher = Fernet(PAYOUT_ENCRYPTION_KEY.encode())
+    except ValueError:
+        raise RuntimeError("PAYOUT_ENCRYPTION_KEY is not a valid Fernet key")
+elif PAYOUT_ENCRYPTION_KEY:
+    logger.error("PAYOUT_ENCRYPTION_KEY found but cryptography package is missing. Payout requisites are stored UNENCRYPTED in orders.requisites_enc.")
+else:
+    logger.error("PAYOUT_ENCRYPTION_KEY is not set. Payout requisites are stored UNENCRYPTED in orders.requisites_enc.")
+
+ENCRYPTED_PREFIX = "fernet:"
+
+def encrypt_requisites(text: str) -> str:
+    """Значение для orders.requisites_enc: Fernet-токен с префиксом (или текст как есть без ключа)."""
+    if payout_cipher is None:
+        return text
+    return ENCRYPTED_PREFIX + payout_cipher.encrypt(text.encode()).decode()
+
+def decrypt_requisites(value: Optional[str]) -> str:
+    """Обратное к encrypt_requisites; без подходящего ключа - заглушка вместо реквизитов."""
+    if not value or not value.startswith(ENCRYPTED_PREFIX):
+        return value or ""
+    if payout_cipher is None:
+        return "🔒 зашифровано (нет ключа)"
+    try:
+        return payout_cipher.decrypt(value[len(ENCRYPTED_PREFIX):].encode()).decode()
+    except InvalidToken:
+        return "🔒 зашифровано (другой ключ)"
+
 
 # ==========================================
 # 3. Анти-спам Middleware
@@ -122,7 +265,315 @@ class ThrottlingMiddleware(BaseMiddleware):
 
         return await handler(event, data)
 
-dp.update.middleware(ThrottlingMiddleware(limit=0.7))
+throttling = ThrottlingMiddleware(limit=0.7)
+dp.update.middleware(throttling)
+# ==========================================
+
+
+# ==========================================
+# Метрики (формат Prometheus, отдаются на /metrics)
+# ==========================================
+def _prom_label(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+class Metrics:
+    """Простой реестр счётчиков и гистограмм в памяти процесса."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.help: Dict[str, Tuple[str, str]] = {}
+        self.counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = {}
+        self.histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], list]] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self.help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1.0, **labels):
+        series = self.counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        # [счётчики по бакетам..., сумма, количество]
+        row = series.get(key)
+        if row is None:
+            row = series[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def gauge(self, name: str, func: Callable[[], float]):
+        self.gauges[name] = func
+
+    def snapshot(self) -> dict:
+        """Состояние реестра в JSON-виде (фронт шардов собирает его с воркеров)"""
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = float(func())
+            except Exception:
+                continue
+        return {
+            "counters": {name: [[key, value] for key, value in series.items()] for name, series in self.counters.items()},
+            "histograms": {name: [[key, row] for key, row in series.items()] for name, series in self.histograms.items()},
+            "gauges": gauges,
+        }
+
+    def merge(self, snapshot: dict):
+        """Прибавляет снапшот другого процесса: счётчики, гистограммы и гейджи суммируются"""
+        for name, series in snapshot["counters"].items():
+            target = self.counters.setdefault(name, {})
+            for key, value in series:
+                key = tuple(tuple(kv) for kv in key)
+                target[key] = target.get(key, 0.0) + value
+        for name, series in snapshot["histograms"].items():
+            target = self.histograms.setdefault(name, {})
+            for key, row in series:
+                key = tuple(tuple(kv) for kv in key)
+                current = target.get(key)
+                target[key] = [a + b for a, b in zip(current, row)] if current else list(row)
+        for name, value in snapshot["gauges"].items():
+            current = self.gauges.get(name)
+            total = value + (float(current()) if current else 0.0)
+            self.gauges[name] = lambda total=total: total
+
+    @staticmethod
+    def _labels(key, le: Optional[str] = None) -> str:
+        parts = [f'{k}="{_prom_label(v)}"' for k, v in key]
+        if le is not None:
+            parts.append(f'le="{le}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def _header(self, lines: list, name: str, default_kind: str):
+        kind, text = self.help.get(name, (default_kind, ""))
+        if text:
+            lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def render(self) -> str:
+        lines = []
+        for name, series in self.counters.items():
+            self._header(lines, name, "counter")
+            for key, value in series.items():
+                lines.append(f"{name}{self._labels(key)} {value}")
+        for name, series in self.histograms.items():
+            self._header(lines, name, "histogram")
+            for key, row in series.items():
+                for i, bound in enumerate(self.BUCKETS):
+                    lines.append(f"{name}_bucket{self._labels(key, str(bound))} {row[i]}")
+                lines.append(f"{name}_bucket{self._labels(key, '+Inf')} {row[-1]}")
+                lines.append(f"{name}_sum{self._labels(key)} {row[-2]}")
+                lines.append(f"{name}_count{self._labels(key)} {row[-1]}")
+        for name, func in self.gauges.items():
+            try:
+                value = float(func())
+            except Exception:
+                continue
+            self._header(lines, name, "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_duration_seconds", "histogram", "Handler latency by handler name")
+metrics.describe("bot_handler_errors_total", "counter", "Unhandled exceptions by handler name")
+metrics.describe("bot_db_query_duration_seconds", "histogram", "DB helper latency by function name")
+metrics.describe("bot_db_query_errors_total", "counter", "DB helper exceptions by function name")
+metrics.describe("bot_telegram_api_requests_total", "counter", "Telegram Bot API calls by method")
+metrics.describe("bot_telegram_api_errors_total", "counter", "Failed Telegram Bot API calls by method and error")
+metrics.describe("bot_backup_seconds", "histogram", "Duration of online DB snapshots")
+
+def handler_name(data: Dict[str, Any]) -> str:
+    """Имя функции-обработчика апдейта (для callback-запросов его выбирает cb_router)."""
+    route = data.get("cb_route")
+    target = route.handler if route else data.get("handler")
+    return getattr(getattr(target, "callback", None), "__name__", "unknown")
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет время работы каждого обработчика сообщений и callback-запросов."""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        name = handler_name(data)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("bot_handler_duration_seconds", time.perf_counter() - start, handler=name)
+
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+
+# --- Запись апдейтов для воспроизведения (replay_updates.py) ---
+update_recorder = logging.getLogger("update_recorder")
+update_recorder.propagate = False
+if RECORD_UPDATES:
+    # Воркеры шардов пишут каждый в свой файл
+    _record_path = f"{RECORD_UPDATES}.{SHARD_INDEX}" if SHARD_ROLE == "worker" else RECORD_UPDATES
+    _record_handler = logging.handlers.RotatingFileHandler(_record_path, maxBytes=50 * 1024 * 1024, backupCount=5, encoding="utf-8")
+    _record_handler.setFormatter(logging.Formatter("%(message)s"))
+    update_recorder.addHandler(_record_handler)
+    update_recorder.setLevel(logging.INFO)
+
+# Личные поля Telegram-объектов: заменяются (значение) или выбрасываются (None)
+_RECORD_PERSONAL_FIELDS = {"first_name": "User", "last_name": None, "username": None, "phone_number": None,
+                           "vcard": None, "email": None, "bio": None, "contact": None, "location": None, "venue": None}
+# Поля платежа YooKassa, которые нужны обработчику вебхука; остальное (карта, чек, покупатель) не пишется
+_RECORD_YOOKASSA_FIELDS = ("id", "status", "paid", "amount", "metadata", "created_at", "captured_at", "test")
+
+def sanitize_update(obj: Any) -> Any:
+    """Копия апдейта (dict) без личных данных пользователей."""
+    if isinstance(obj, list):
+        return [sanitize_update(v) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for key, value in obj.items():
+        if key in _RECORD_PERSONAL_FIELDS:
+            if _RECORD_PERSONAL_FIELDS[key] is not None:
+                out[key] = _RECORD_PERSONAL_FIELDS[key]
+            continue
+        out[key] = sanitize_update(value)
+    return out
+
+def record_event(kind: str, payload: dict):
+    update_recorder.info(json.dumps({"ts": round(time.time(), 3), "kind": kind, kind: payload}, ensure_ascii=False))
+
+def record_yookassa_webhook(body: dict):
+    obj = body.get("object") or {}
+    record_event("yookassa", {"event": body.get("event"), "object": {k: obj[k] for k in _RECORD_YOOKASSA_FIELDS if k in obj}})
+
+class UpdateRecorderMiddleware(BaseMiddleware):
+    """Пишет входящие апдейты в RECORD_UPDATES: без имён и контактов, текст бота в callback-сообщениях
+    и ввод платёжных реквизитов вырезаются."""
+
+    async def __call__(
+        self,
+        handler: Callable[[types.TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: types.TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        try:
+            raw = sanitize_update(event.model_dump(mode="json", exclude_none=True, by_alias=True))
+            callback_message = raw.get("callback_query", {}).get("message")
+            if callback_message:
+                callback_message["text"] = ""
+                callback_message.pop("entities", None)
+                callback_message.pop("caption", None)
+            message = raw.get("message")
+            if message and message.get("text") and data.get("raw_state") == WithdrawStates.details.state:
+                message["text"] = "X" * len(message["text"])
+            record_event("telegram", raw)
+        except Exception as e:
+            logger.warning(f"Update recording failed: {e}")
+        return await handler(event, data)
+
+if RECORD_UPDATES:
+    # Снаружи FSM-middleware диспетчера: в data уже есть raw_state
+    dp.update.outer_middleware(UpdateRecorderMiddleware())
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Считает реальные запросы к Telegram Bot API и ошибки."""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        metrics.inc("bot_telegram_api_requests_total", method=name)
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("bot_telegram_api_errors_total", method=name, error=type(e).__name__)
+            raise
+
+def db_timed(func):
+    """Записывает время выполнения DB-хелпера в метрики."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc("bot_db_query_errors_total", query=name)
+            raise
+        finally:
+            metrics.observe("bot_db_query_duration_seconds", time.perf_counter() - start, query=name)
+    return wrapper
+# ==========================================
+
+
+# ==========================================
+# Кэш отрисованных сообщений (пропуск пустых правок)
+# ==========================================
+class EditDedupMiddleware(BaseRequestMiddleware):
+    """Не отправляет edit_message_text, если текст и клавиатура не изменились."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.cache: "OrderedDict[Tuple[Any, int], bytes]" = OrderedDict()
+
+    @staticmethod
+    def _digest(method: EditMessageText) -> bytes:
+        markup = method.reply_markup.model_dump_json(exclude_none=True) if method.reply_markup else ""
+        raw = f"{method.text}\x00{method.parse_mode}\x00{markup}"
+        return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).digest()
+
+    def _remember(self, key: Tuple[Any, int], digest: bytes):
+        self.cache[key] = digest
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if isinstance(method, (EditMessageCaption, EditMessageReplyMarkup, DeleteMessage)):
+            # Сообщение меняется в обход кэша - забываем его
+            if method.chat_id is not None and method.message_id is not None:
+                self.cache.pop((method.chat_id, method.message_id), None)
+            return await make_request(bot, method)
+
+        if not isinstance(method, EditMessageText) or method.chat_id is None or method.message_id is None:
+            return await make_request(bot, method)
+
+        key = (method.chat_id, method.message_id)
+        digest = self._digest(method)
+        if self.cache.get(key) == digest:
+            self.cache.move_to_end(key)
+            metrics.inc("bot_edit_dedup_skipped_total")
+            return True # Результат правки без изменений (уже развёрнутый, как у make_request)
+
+        try:
+            response = await make_request(bot, method)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self._remember(key, digest)
+            else:
+                self.cache.pop(key, None)
+            raise
+        self._remember(key, digest)
+        return response
+
+edit_dedup = EditDedupMiddleware(max_size=EDIT_CACHE_SIZE)
+metrics.describe("bot_edit_dedup_skipped_total", "counter", "Edits answered locally by the rendered-message cache")
+
+def setup_bot_session(session: BaseSession):
+    """Подключает общие middleware к HTTP-сессии бота."""
+    session.middleware(edit_dedup)
+    # Внутренний слой: считаем только запросы, реально ушедшие в API
+    session.middleware(ApiMetricsMiddleware())
+
+setup_bot_session(bot.session)
 # ==========================================
 
 
@@ -197,7 +648,162 @@ async def setup_yookassa_webhook():
         logger.error(f"❌ Ошибка при настройке Webhook YooKassa: {e}")  
 
 
+# --- Callback Data ---
+class WithdrawMethodCb(CallbackData, prefix="withdraw_method"):
+    method: str
+
+class AdmViewDisputeCb(CallbackData, prefix="adm_view_dispute"):
+    deal_id: int
+
+class AdmShowProofCb(CallbackData, prefix="adm_show_proof"):
+    deal_id: int
+
+class AdmResolveDisputeCb(CallbackData, prefix="adm_resolve_dispute"):
+    deal_id: int
+    winner_id: int
+    amount: float
+
+class AdmTakeDisputeCb(CallbackData, prefix="adm_take_dispute"):
+    deal_id: int
+    take: bool     # True - взять в работу, False - отпустить
+
+class DisputeQueueCb(CallbackData, prefix="dq"):
+    anchor: int = 0       # id спора-якоря (0 = начало очереди)
+    forward: bool = True  # True - споры после якоря (более свежие), False - до него
+    mine: bool = False    # Только закреплённые за мной
+    min_rub: int = 0      # Фильтр по сумме сделки
+    seller_id: int = 0    # Фильтр по продавцу
+
+class AdmCompleteWithdrawCb(CallbackData, prefix="adm_complete_withdraw"):
+    order_id: int
+
+class AdmWithdrawSelectCb(CallbackData, prefix="adm_wd_sel"):
+    order_id: int
+
+class AdmWithdrawMethodCb(CallbackData, prefix="adm_wd_method"):
+    method: str    # "" - все методы
+
+class StatsPeriodCb(CallbackData, prefix="stats_period"):
+    days: int
+
+class HistoryPageCb(CallbackData, prefix="hist"):
+    kind: str      # tx | buy | sell
+    at: str        # created_at строки-якоря без разделителей (pack_keyset_at; "" = первая страница)
+    anchor: int    # id строки-якоря
+    older: bool    # True - строки старше якоря, False - новее
+
+class AnalyticsPeriodCb(CallbackData, prefix="analytics"):
+    days: int
+
+class CouponTypeCb(CallbackData, prefix="coupon_type"):
+    c_type: str
+
+class CouponViewCb(CallbackData, prefix="coupon_view"):
+    coupon_id: int
+
+class CouponToggleCb(CallbackData, prefix="coupon_toggle"):
+    coupon_id: int
+    new_status: int
+
+class CouponDeleteCb(CallbackData, prefix="coupon_delete"):
+    coupon_id: int
+
+class AdToggleCb(CallbackData, prefix="ad_toggle"):
+    ad_id: int
+    new_status: int
+
+class AdDeleteCb(CallbackData, prefix="ad_delete"):
+    ad_id: int
+
+class BuySelectAdCb(CallbackData, prefix="buy_select_ad"):
+    ad_id: int
+
+class DealCheckPaymentCb(CallbackData, prefix="deal_check_payment"):
+    deal_id: int
+    payment_id: str
+
+class DealUploadProofCb(CallbackData, prefix="deal_upload_proof"):
+    deal_id: int
+
+class DealDisputeCb(CallbackData, prefix="deal_dispute"):
+    deal_id: int
+
+class DealCompleteSellerCb(CallbackData, prefix="deal_complete_seller"):
+    deal_id: int
+
+class DealCompleteSellerDisputeCb(CallbackData, prefix="deal_complete_seller_dispute"):
+    deal_id: int
+
+class DealReviewCb(CallbackData, prefix="deal_review"):
+    deal_id: int
+
+class ReviewRatingCb(CallbackData, prefix="review_rating"):
+    rating: int
+
+
+class CallbackRoute(NamedTuple):
+    factory: Optional[type]
+    handler: CallableObject
+    state: Optional[State]
+
+class CallbackRouter:
+    """Диспетчер callback-запросов: поиск обработчика по части callback_data до ':' за O(1)."""
+
+    def __init__(self):
+        self.routes: Dict[str, CallbackRoute] = {}
+
+    def route(self, key: Any, state: Optional[State] = None):
+        """key - CallbackData-фабрика или точная строка callback_data без параметров."""
+        if isinstance(key, str):
+            prefix, factory = key, None
+        else:
+            prefix, factory = key.__prefix__, key
+
+        def decorator(func):
+            if prefix in self.routes:
+                raise ValueError(f"Callback prefix {prefix!r} already registered")
+            self.routes[prefix] = CallbackRoute(factory, CallableObject(callback=func), state)
+            return func
+        return decorator
+
+    def filter(self, call: types.CallbackQuery, raw_state: Optional[str] = None):
+        if not call.data:
+            return False
+        route = self.routes.get(call.data.partition(":")[0])
+        if route is None:
+            return False
+        if route.state is not None and raw_state != route.state.state:
+            return False
+        return {"cb_route": route}
+
+    async def dispatch(self, call: types.CallbackQuery, cb_route: CallbackRoute, **data):
+        if cb_route.factory is not None:
+            try:
+                data["callback_data"] = cb_route.factory.unpack(call.data)
+            except (TypeError, ValueError) as e:
+                logger.warning(f"Bad callback data {call.data!r}: {type(e).__name__}")
+                return await call.answer("Некорректные данные.", show_alert=True)
+        return await cb_route.handler.call(call, **data)
+
+cb_router = CallbackRouter()
+dp.callback_query.register(cb_router.dispatch, cb_router.filter)
+
 # --- Клавиатуры ---
+# Клавиатуры собираются один раз и переиспользуются между апдейтами.
+# Готовую разметку НЕЛЬЗЯ изменять на месте - она общая для всех вызовов.
+STATIC_KEYBOARDS: list = []
+
+def static_kb(func):
+    """Постоянная клавиатура (без аргументов или с флагом): строится при импорте, дальше - из кэша."""
+    cached = functools.lru_cache(maxsize=None)(func)
+    STATIC_KEYBOARDS.append(cached)
+    return cached
+
+def cached_kb(func):
+    """Клавиатура, зависящая от id/статуса: ограниченный LRU-кэш на KEYBOARD_CACHE_SIZE вариантов."""
+    return functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)(func)
+
+@static_kb
 def main_menu_kb(is_admin_user: bool = False):
     kb = [
         [
@@ -212,6 +818,7 @@ def main_menu_kb(is_admin_user: bool = False):
         kb[1].append(InlineKeyboardButton(text="⚙️ Админ панель", callback_data="menu_admin"))
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+@static_kb
 def sell_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📋 Мои объявления", callback_data="sell_my_ads")],
@@ -222,22 +829,27 @@ def sell_menu_kb():
         [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back_main")]
     ])
 
-def back_main_kb(is_admin_user: bool = False):
+@static_kb
+def back_main_kb():
     return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="◀️ Главное меню", callback_data="back_main")]])
 
+@static_kb
 def back_admin_kb():
     return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="◀️ Назад в Админ-панель", callback_data="back_admin")]])
 
-def profile_kb(user_id: int):
+@static_kb
+def profile_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💸 Вывод RUB", callback_data="profile_withdraw")],
         [InlineKeyboardButton(text="💳 Мои транзакции", callback_data="profile_tx")],
+        [InlineKeyboardButton(text="🛒 Мои покупки", callback_data=HistoryPageCb(kind="buy", at="", anchor=0, older=True).pack())],
         # ИЗМЕНЕНО: Теперь кнопка вызывает меню, а не открывает ссылку
         [InlineKeyboardButton(text="💌 Реф. программа", callback_data="profile_referral")], 
         [InlineKeyboardButton(text="✉️ Написать в поддержку", callback_data="support")], 
         [InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")]
     ])
 
+@static_kb
 def admin_main_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📦 Споры", callback_data="adm_deals_dispute"), InlineKeyboardButton(text="📊 Статистика", callback_data="adm_stats")],
@@ -246,6 +858,7 @@ def admin_main_kb():
         [InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")]
     ])
 
+@static_kb
 def buy_menu_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🔍 Просмотреть объявления", callback_data="buy_list_ads")],
@@ -253,14 +866,24 @@ def buy_menu_kb():
         [InlineKeyboardButton(text="◀️ Главное меню", callback_data="back_main")]
     ])
 
+@static_kb
 def admin_stats_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="7 дней", callback_data="stats_period:7"), InlineKeyboardButton(text="14 дней", callback_data="stats_period:14")],
-        [InlineKeyboardButton(text="21 день", callback_data="stats_period:21"), InlineKeyboardButton(text="Месяц (30 дн.)", callback_data="stats_period:30")],
-        [InlineKeyboardButton(text="Год (365 дн.)", callback_data="stats_period:365")],
+        [InlineKeyboardButton(text="7 дней", callback_data=StatsPeriodCb(days=7).pack()), InlineKeyboardButton(text="14 дней", callback_data=StatsPeriodCb(days=14).pack())],
+        [InlineKeyboardButton(text="21 день", callback_data=StatsPeriodCb(days=21).pack()), InlineKeyboardButton(text="Месяц (30 дн.)", callback_data=StatsPeriodCb(days=30).pack())],
+        [InlineKeyboardButton(text="Год (365 дн.)", callback_data=StatsPeriodCb(days=365).pack())],
+        [InlineKeyboardButton(text="📈 Аналитика (воронка, продавцы)", callback_data=AnalyticsPeriodCb(days=30).pack())],
         [InlineKeyboardButton(text="◀️ Назад в Админ-панель", callback_data="back_admin")]
     ])
 
+@static_kb
+def admin_analytics_kb():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=AnalyticsPeriodCb(days=d).pack()) for label, d in (("7 дней", 7), ("30 дней", 30), ("90 дней", 90))],
+        [InlineKeyboardButton(text="◀️ Назад к статистике", callback_data="adm_stats")]
+    ])
+
+@static_kb
 def admin_coupons_kb():
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="➕ Создать новый купон", callback_data="coupon_create")],
@@ -268,35 +891,196 @@ def admin_coupons_kb():
         [InlineKeyboardButton(text="◀️ Назад в Админ-панель", callback_data="back_admin")]
     ])
 
+@cached_kb
 def deal_actions_buyer_kb(deal_id: int, status: str):
     kb = InlineKeyboardBuilder()
     if status == 'paid_waiting_proof':
-        kb.row(InlineKeyboardButton(text="⚠️ Открыть спор", callback_data=f"deal_dispute:{deal_id}"))
+        kb.row(InlineKeyboardButton(text="⚠️ Открыть спор", callback_data=DealDisputeCb(deal_id=deal_id).pack()))
     if status == 'completed':
-        kb.row(InlineKeyboardButton(text="⭐ Оставить отзыв", callback_data=f"deal_review:{deal_id}"))
+        kb.row(InlineKeyboardButton(text="⭐ Оставить отзыв", callback_data=DealReviewCb(deal_id=deal_id).pack()))
     kb.row(InlineKeyboardButton(text="◀️ Назад", callback_data="back_main"))
     return kb.as_markup()
 
+@cached_kb
 def deal_actions_seller_kb(deal_id: int, status: str):
     kb = InlineKeyboardBuilder()
     if status == 'pending_proof':
-        kb.row(InlineKeyboardButton(text="✅ Подтвердить выдачу", callback_data=f"deal_complete_seller:{deal_id}"))
+        kb.row(InlineKeyboardButton(text="✅ Подтвердить выдачу", callback_data=DealCompleteSellerCb(deal_id=deal_id).pack()))
     if status == 'dispute':
-        kb.row(InlineKeyboardButton(text="✅ Подтвердить выдачу (Спор)", callback_data=f"deal_complete_seller_dispute:{deal_id}"))
+        kb.row(InlineKeyboardButton(text="✅ Подтвердить выдачу (Спор)", callback_data=DealCompleteSellerDisputeCb(deal_id=deal_id).pack()))
     kb.row(InlineKeyboardButton(text="◀️ Назад", callback_data="back_main"))
     return kb.as_markup()
 
+@cached_kb
 def deal_proof_kb(deal_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📸 Загрузить скриншот оплаты", callback_data=f"deal_upload_proof:{deal_id}")],
+        [InlineKeyboardButton(text="📸 Загрузить скриншот оплаты", callback_data=DealUploadProofCb(deal_id=deal_id).pack())],
         [InlineKeyboardButton(text="❌ Отмена", callback_data="back_main")]
     ])
 
+@cached_kb
+def cancel_kb(callback_data: str):
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data=callback_data)]])
+
+for _kb in STATIC_KEYBOARDS:
+    _kb()
+main_menu_kb(False)
+main_menu_kb(True)
+
+# --- Журнал медленных запросов ---
+slow_query_logger = logging.getLogger("slow_queries")
+slow_query_logger.propagate = False
+if SLOW_QUERY_MS > 0:
+    _slow_handler = logging.handlers.RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=5 * 1024 * 1024, backupCount=3, encoding="utf-8")
+    _slow_handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+    slow_query_logger.addHandler(_slow_handler)
+    slow_query_logger.setLevel(logging.INFO)
+
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+async def explain_query(db, sql: str, parameters=()) -> str:
+    """Возвращает EXPLAIN QUERY PLAN запроса одной строкой (или пустую строку)."""
+    if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return ""
+    try:
+        cur = await db.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)
+        return " | ".join(row[3] for row in await cur.fetchall())
+    except Exception as e:
+        return f"<explain failed: {e}>"
+
+class SlowQueryCursor:
+    """Курсор SlowQueryConnection: досчитывает время запроса до конца выборки (fetch*)."""
+
+    def __init__(self, owner: "SlowQueryConnection", cursor: aiosqlite.Cursor, sql: str, parameters, caller: str, elapsed: float):
+        self._owner = owner
+        self._cursor = cursor
+        self._sql = sql
+        self._parameters = parameters
+        self._caller = caller
+        self.elapsed = elapsed
+        self.done = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __aiter__(self):
+        return self._fetch_chunked()
+
+    async def _fetch_chunked(self):
+        while True:
+            rows = await self.fetchmany(self._cursor.iter_chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+    async def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return await fn(*args)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    async def fetchone(self):
+        row = await self._timed(self._cursor.fetchone)
+        if row is None:
+            await self.finish()
+        return row
+
+    async def fetchmany(self, size: Optional[int] = None):
+        rows = await self._timed(self._cursor.fetchmany, *(() if size is None else (size,)))
+        if not rows:
+            await self.finish()
+        return rows
+
+    async def fetchall(self):
+        rows = await self._timed(self._cursor.fetchall)
+        await self.finish()
+        return rows
+
+    async def finish(self):
+        """Выборка закончена (или брошена): итоговое время уходит в журнал медленных запросов."""
+        if not self.done:
+            self.done = True
+            await self._owner._report(self._caller, self._sql, self._parameters, self.elapsed)
+
+
+class SlowQueryConnection:
+    """Обёртка над соединением aiosqlite: пишет в журнал запросы дольше SLOW_QUERY_MS вместе с планом.
+    Время считается вместе с выборкой строк: SELECT выполняется пошагово внутри fetch*, а не в execute."""
+
+    def __init__(self, conn: aiosqlite.Connection, threshold_ms: float):
+        self._conn = conn
+        self._threshold = threshold_ms / 1000.0
+        self._cursors: list = [] # Курсоры, чья выборка ещё не закончена
+
+    async def __aenter__(self):
+        await self._conn.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._finish_cursors()
+        return await self._conn.__aexit__(exc_type, exc, tb)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    async def _finish_cursors(self):
+        # Недочитанный курсор (fetchone по одной строке) закрываем перед следующим запросом или выходом
+        cursors, self._cursors = self._cursors, []
+        for cursor in cursors:
+            await cursor.finish()
+
+    async def _report(self, caller: str, sql: str, parameters, elapsed: float):
+        if elapsed >= self._threshold:
+            plan = await explain_query(self._conn, sql, parameters)
+            slow_query_logger.info(
+                f"{elapsed * 1000:.1f} ms in {caller}: {' '.join(sql.split())} | params={parameters!r} | plan: {plan}"
+            )
+
+    async def execute(self, sql: str, parameters=()):
+        caller = sys._getframe(1).f_code.co_name
+        await self._finish_cursors()
+        start = time.perf_counter()
+        cursor = await self._conn.execute(sql, parameters)
+        wrapped = SlowQueryCursor(self, cursor, sql, parameters, caller, time.perf_counter() - start)
+        if cursor.description is None:
+            # Запрос без строк результата (UPDATE/INSERT без RETURNING) уже выполнен целиком
+            await wrapped.finish()
+        else:
+            self._cursors.append(wrapped)
+        return wrapped
+
+    async def executemany(self, sql: str, parameters):
+        caller = sys._getframe(1).f_code.co_name
+        await self._finish_cursors()
+        parameters = list(parameters)
+        start = time.perf_counter()
+        cursor = await self._conn.executemany(sql, parameters)
+        # План и params в журнале - по первому набору параметров
+        await self._report(caller, sql, parameters[0] if parameters else (), time.perf_counter() - start)
+        return cursor
+
+    async def executescript(self, sql_script: str):
+        caller = sys._getframe(1).f_code.co_name
+        await self._finish_cursors()
+        start = time.perf_counter()
+        cursor = await self._conn.executescript(sql_script)
+        await self._report(caller, sql_script, (), time.perf_counter() - start)
+        return cursor
+
+def db_connect():
+    """Открывает соединение с БД (с журналом медленных запросов, если он включён)."""
+    if SLOW_QUERY_MS > 0:
+        return SlowQueryConnection(aiosqlite.connect(DB_PATH), SLOW_QUERY_MS)
+    return aiosqlite.connect(DB_PATH)
+
 # --- DB Helpers ---
+@db_timed
 async def log_event(user_id: int, action: str, details: str = ""):
     """Записывает событие в таблицу logs"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_connect() as db:
             await db.execute(
                 "INSERT INTO logs (user_id, action, details) VALUES (?, ?, ?)",
                 (user_id, action, details)
@@ -305,155 +1089,485 @@ async def log_event(user_id: int, action: str, details: str = ""):
     except Exception as e:
         print(f"[LOG ERROR] {e}")
 
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        
-        # 1. Основные таблицы (Пользователи)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            balance REAL DEFAULT 0, 
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            referrer_id INTEGER DEFAULT NULL,
-            active_coupon_id INTEGER DEFAULT NULL
-        )
-        """)
+# Виды операций в transactions -> подпись в истории
+TX_KINDS = {
+    "deal_payment": "ПОКУПКА R",
+    "deal_sale": "ПРОДАЖА R",
+    "withdraw": "ВЫВОД RUB",
+    "admin_adjust": "КОРРЕКТИРОВКА",
+    "referral_bonus": "РЕФЕРАЛ БОНУС",
+}
+
+async def add_transaction(db, user_id: int, kind: str, amount_rub: float, counterparty: Optional[int] = None,
+                          deal_id: Optional[int] = None, order_id: Optional[int] = None):
+    """Пишет операцию в transactions внутри уже открытой транзакции (сумма со знаком, в копейках)"""
+    await db.execute(
+        "INSERT INTO transactions(user_id, kind, amount_kopecks, counterparty, deal_id, order_id) VALUES(?, ?, ?, ?, ?, ?)",
+        (user_id, kind, int(round(amount_rub * 100)), counterparty, deal_id, order_id)
+    )
 
-        # 2. Логи (Добавил event_type сразу в создание таблицы для новых БД)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            action TEXT,
-            details TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            event_type TEXT
-        )
-        """)
-        
-        # Миграция для старых БД (если таблица logs уже была создана без event_type)
-        try:
-            await db.execute("ALTER TABLE logs ADD COLUMN event_type TEXT")
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_logs_user ON logs(user_id)")
-        except aiosqlite.OperationalError as e:
-            if "duplicate column name" not in str(e):
-                logger.error(f"Error adding column 'event_type': {e}")
+def pack_keyset_at(created_at: str) -> str:
+    """created_at для callback_data: только цифры (':' - разделитель CallbackData)."""
+    date, _, frac = created_at.partition(".")
+    return re.sub(r"\D", "", date) + frac
+
+def unpack_keyset_at(at: str) -> str:
+    """Обратное к pack_keyset_at: 'ГГГГ-ММ-ДД чч:мм:сс[.доли]'."""
+    created_at = f"{at[:4]}-{at[4:6]}-{at[6:8]} {at[8:10]}:{at[10:12]}:{at[12:14]}"
+    return f"{created_at}.{at[14:]}" if len(at) > 14 else created_at
+
+def keyset_cursor(row) -> Tuple[str, int]:
+    """Курсор (created_at, id) строки страницы fetch_keyset_page."""
+    return row[-1], row[0]
+
+async def fetch_keyset_page(db, table: str, columns: str, where: str, params: tuple,
+                            cursor: Optional[Tuple[str, int]] = None, older: bool = True,
+                            limit: int = HISTORY_PAGE_SIZE):
+    """Keyset-страница по (created_at, id) относительно курсора строки-якоря.
+    Курсор передаётся значениями, а не id: строка-якорь могла уйти в архив.
+    Возвращает (rows от новых к старым, есть_старее, есть_новее); первый столбец columns - id, последний - created_at."""
+    op, order = ("<", "DESC") if older else (">", "ASC")
+    sql = f"SELECT {columns} FROM {table} WHERE {where}"
+    if cursor:
+        sql += f" AND (created_at, id) {op} (?, ?)"
+        params = (*params, *cursor)
+    sql += f" ORDER BY created_at {order}, id {order} LIMIT ?"
+    cur = await db.execute(sql, (*params, limit + 1))
+    rows = await cur.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if older:
+        return rows, more, bool(cursor)
+    return rows[::-1], True, more
+
+async def _migration_baseline(db):
+    """Базовая схема: все таблицы и начальные значения конфига"""
+    # 1. Основные таблицы (Пользователи)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        balance REAL DEFAULT 0, 
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        referrer_id INTEGER DEFAULT NULL,
+        active_coupon_id INTEGER DEFAULT NULL
+    )
+    """)
+
+    # 2. Логи (Добавил event_type сразу в создание таблицы для новых БД)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        action TEXT,
+        details TEXT,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        event_type TEXT
+    )
+    """)
+    
+    # Старые БД: таблица logs могла быть создана без event_type
+    cur = await db.execute("PRAGMA table_info(logs)")
+    if "event_type" not in {row[1] for row in await cur.fetchall()}:
+        await db.execute("ALTER TABLE logs ADD COLUMN event_type TEXT")
+
+    # 3. Заказы (финансы)
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        type TEXT,
+        amount INTEGER,
+        price REAL,
+        status TEXT,
+        details TEXT,
+        payment_id TEXT,
+        provider TEXT DEFAULT 'manual',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
 
-        # 3. Заказы (финансы)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            type TEXT,
-            amount INTEGER,
-            price REAL,
-            status TEXT,
-            details TEXT,
-            payment_id TEXT,
-            provider TEXT DEFAULT 'manual',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
+    # 4. Конфигурация
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS config (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+
+    # 5. Объявления
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS ads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        title TEXT,
+        rate REAL,               
+        min_amount INTEGER,
+        max_amount INTEGER,
+        payment_methods TEXT,    
+        active INTEGER DEFAULT 1,
+        description TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # 6. Сделки P2P
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS deals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        buyer_id INTEGER,
+        seller_id INTEGER,
+        ad_id INTEGER,
+        amount INTEGER,
+        price REAL,
+        rub_amount REAL,
+        roblox_link TEXT,
+        payment_id TEXT,
+        status TEXT,
+        proof_file_id TEXT DEFAULT NULL, 
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        coupon_id INTEGER DEFAULT NULL,
+        coupon_code TEXT DEFAULT NULL,
+        dispute_reason TEXT DEFAULT NULL,
+        dispute_admin_id INTEGER DEFAULT NULL,
+        dispute_resolved_at DATETIME DEFAULT NULL
+    )
+    """)
+
+    # 7. Отзывы
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS reviews (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reviewer_id INTEGER,
+        target_id INTEGER,
+        deal_id INTEGER UNIQUE,
+        rating INTEGER,
+        comment TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    # 8. Купоны
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS coupons (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT UNIQUE,
+        type TEXT,
+        value REAL,
+        uses_limit INTEGER DEFAULT 0,
+        min_amount INTEGER DEFAULT 0,
+        is_active BOOLEAN DEFAULT 1,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS coupon_uses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        coupon_id INTEGER,
+        user_id INTEGER,
+        deal_id INTEGER,
+        used_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
 
-        # 4. Конфигурация
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS config (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-        """)
+    # 9. Установка начальных значений конфига (если их нет)
+    cur = await db.execute("SELECT value FROM config WHERE key = ?", ("price_per_1000",))
+    if not await cur.fetchone():
+        await db.execute("INSERT INTO config(key, value) VALUES(?, ?)", ("price_per_1000", "300.00"))
+        
+    cur = await db.execute("SELECT value FROM config WHERE key = ?", ("min_withdraw",))
+    if not await cur.fetchone():
+        await db.execute("INSERT INTO config(key, value) VALUES(?, ?)", ("min_withdraw", "100.00"))
+
+
+async def _migration_hot_indexes(db):
+    """Индексы под горячие запросы (статистика, вебхук, логи, купоны, рефералы)"""
+    for ddl in (
+        "CREATE INDEX IF NOT EXISTS idx_logs_user ON logs(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_logs_user_ts ON logs(user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_deals_status_created ON deals(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_deals_payment ON deals(payment_id)",
+        "CREATE INDEX IF NOT EXISTS idx_deals_buyer ON deals(buyer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_deals_seller ON deals(seller_id)",
+        "CREATE INDEX IF NOT EXISTS idx_ads_user ON ads(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_ads_active ON ads(active)",
+        "CREATE INDEX IF NOT EXISTS idx_reviews_target ON reviews(target_id)",
+        "CREATE INDEX IF NOT EXISTS idx_coupon_uses_coupon_user ON coupon_uses(coupon_id, user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referrer_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_type_status_created ON orders(type, status, created_at)",
+    ):
+        await db.execute(ddl)
+
+
+async def _migration_daily_stats(db):
+    """Таблица дневных агрегатов для админ-статистики + заполнение из истории"""
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS daily_stats (
+        day TEXT PRIMARY KEY,
+        new_users INTEGER DEFAULT 0,
+        robux_paid INTEGER DEFAULT 0,
+        rub_paid REAL DEFAULT 0
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_created ON users(created_at)")
+    await rebuild_daily_stats(db)
+
+
+async def _migration_seller_analytics(db):
+    """Воронка по продавцам по дням + время завершения сделок"""
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS seller_daily_stats (
+        day TEXT,
+        seller_id INTEGER,
+        views INTEGER DEFAULT 0,
+        created INTEGER DEFAULT 0,
+        paid INTEGER DEFAULT 0,
+        proof INTEGER DEFAULT 0,
+        completed INTEGER DEFAULT 0,
+        rub_completed REAL DEFAULT 0,
+        PRIMARY KEY (day, seller_id)
+    )
+    """)
+    cur = await db.execute("PRAGMA table_info(deals)")
+    if "completed_at" not in {row[1] for row in await cur.fetchall()}:
+        await db.execute("ALTER TABLE deals ADD COLUMN completed_at DATETIME DEFAULT NULL")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deals_completed_at ON deals(completed_at)")
+    # История: все этапы относим ко дню создания сделки (моментов оплаты/завершения раньше не хранили)
+    await db.execute(f"""
+        INSERT OR REPLACE INTO seller_daily_stats(day, seller_id, created, paid, proof, completed, rub_completed)
+        SELECT date(created_at), seller_id,
+               COUNT(*),
+               SUM(status IN {PAID_DEAL_STATUSES_SQL}),
+               SUM(proof_file_id IS NOT NULL),
+               SUM(status = 'completed'),
+               COALESCE(SUM(CASE WHEN status = 'completed' THEN rub_amount END), 0)
+        FROM deals GROUP BY date(created_at), seller_id
+    """)
+
+
+async def _migration_log_retention(db):
+    """Индекс по времени для ретеншна логов + auto_vacuum=INCREMENTAL (разовый VACUUM)"""
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs(timestamp)")
+    cur = await db.execute("PRAGMA auto_vacuum")
+    if (await cur.fetchone())[0] != 2:
+        await db.commit()
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("VACUUM")
+
+
+async def _migration_transactions(db):
+    """Типизированная история денежных операций + заполнение из orders/deals"""
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        amount_kopecks INTEGER NOT NULL,
+        counterparty INTEGER DEFAULT NULL,
+        deal_id INTEGER DEFAULT NULL,
+        order_id INTEGER DEFAULT NULL,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at, id)")
+    await db.execute("""
+        INSERT INTO transactions(user_id, kind, amount_kopecks, order_id, created_at)
+        SELECT user_id, 'withdraw', -CAST(ROUND(price * 100) AS INTEGER), id, created_at
+        FROM orders WHERE type = 'withdraw_rub'
+    """)
+    await db.execute(f"""
+        INSERT INTO transactions(user_id, kind, amount_kopecks, counterparty, deal_id, created_at)
+        SELECT buyer_id, 'deal_payment', -CAST(ROUND(rub_amount * 100) AS INTEGER), seller_id, id, created_at
+        FROM deals WHERE status IN {PAID_DEAL_STATUSES_SQL}
+    """)
+    await db.execute("""
+        INSERT INTO transactions(user_id, kind, amount_kopecks, counterparty, deal_id, created_at)
+        SELECT seller_id, 'deal_sale', CAST(ROUND(rub_amount * 100) AS INTEGER), buyer_id, id, COALESCE(completed_at, created_at)
+        FROM deals WHERE status = 'completed'
+    """)
+
+
+async def _migration_history_indexes(db):
+    """Составные индексы под keyset-пагинацию историй (user, created_at, id)"""
+    await db.execute("DROP INDEX IF EXISTS idx_deals_buyer")
+    await db.execute("DROP INDEX IF EXISTS idx_deals_seller")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deals_buyer_created ON deals(buyer_id, created_at, id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deals_seller_status_created ON deals(seller_id, status, created_at, id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at, id)")
+
+
+async def _migration_deals_archive(db):
+    """Холодный архив завершённых сделок + сводные счётчики продавцов"""
+    # Та же структура колонок, что у deals (без ограничений); id уникален через индекс
+    await db.execute("CREATE TABLE IF NOT EXISTS deals_archive AS SELECT * FROM deals WHERE 0")
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_deals_archive_id ON deals_archive(id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deals_archive_seller ON deals_archive(seller_id, created_at)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deals_archive_buyer ON deals_archive(buyer_id, created_at)")
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS seller_summary (
+        seller_id INTEGER PRIMARY KEY,
+        completed_count INTEGER DEFAULT 0,
+        completed_rub REAL DEFAULT 0
+    )
+    """)
+    await db.execute("""
+        INSERT OR REPLACE INTO seller_summary(seller_id, completed_count, completed_rub)
+        SELECT seller_id, COUNT(*), COALESCE(SUM(rub_amount), 0) FROM deals
+        WHERE status = 'completed' GROUP BY seller_id
+    """)
+
+
+async def _migration_coupon_reservations(db):
+    """Счётчик использований в coupons + статус брони в coupon_uses (reserved/used)"""
+    cur = await db.execute("PRAGMA table_info(coupons)")
+    if "uses_count" not in {row[1] for row in await cur.fetchall()}:
+        await db.execute("ALTER TABLE coupons ADD COLUMN uses_count INTEGER DEFAULT 0")
+    cur = await db.execute("PRAGMA table_info(coupon_uses)")
+    if "status" not in {row[1] for row in await cur.fetchall()}:
+        await db.execute("ALTER TABLE coupon_uses ADD COLUMN status TEXT DEFAULT 'used'")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_coupon_uses_deal ON coupon_uses(deal_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_coupon_uses_user_coupon ON coupon_uses(user_id, coupon_id)")
+    await db.execute("UPDATE coupons SET uses_count = (SELECT COUNT(*) FROM coupon_uses u WHERE u.coupon_id = coupons.id)")
+
+
+async def _migration_referral_counters(db):
+    """Счётчик рефералов в users (поддерживается в create_user_if_not_exists)"""
+    cur = await db.execute("PRAGMA table_info(users)")
+    if "referral_count" not in {row[1] for row in await cur.fetchall()}:
+        await db.execute("ALTER TABLE users ADD COLUMN referral_count INTEGER DEFAULT 0")
+    await db.execute(
+        "UPDATE users SET referral_count = (SELECT COUNT(*) FROM users r WHERE r.referrer_id = users.user_id)"
+    )
 
-        # 5. Объявления
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS ads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            title TEXT,
-            rate REAL,               
-            min_amount INTEGER,
-            max_amount INTEGER,
-            payment_methods TEXT,    
-            active INTEGER DEFAULT 1,
-            description TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
 
-        # 6. Сделки P2P
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS deals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            buyer_id INTEGER,
-            seller_id INTEGER,
-            ad_id INTEGER,
-            amount INTEGER,
-            price REAL,
-            rub_amount REAL,
-            roblox_link TEXT,
-            payment_id TEXT,
-            status TEXT,
-            proof_file_id TEXT DEFAULT NULL, 
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            coupon_id INTEGER DEFAULT NULL,
-            coupon_code TEXT DEFAULT NULL,
-            dispute_reason TEXT DEFAULT NULL,
-            dispute_admin_id INTEGER DEFAULT NULL,
-            dispute_resolved_at DATETIME DEFAULT NULL
-        )
-        """)
+async def _migration_referral_earned(db):
+    """Начисленные реферальные бонусы в users (из transactions.referral_bonus)"""
+    cur = await db.execute("PRAGMA table_info(users)")
+    if "referral_earned" not in {row[1] for row in await cur.fetchall()}:
+        await db.execute("ALTER TABLE users ADD COLUMN referral_earned REAL DEFAULT 0")
+    await db.execute("""
+        UPDATE users SET referral_earned = COALESCE((
+            SELECT SUM(amount_kopecks) / 100.0 FROM transactions t
+            WHERE t.user_id = users.user_id AND t.kind = 'referral_bonus'
+        ), 0)
+    """)
+
+
+async def _migration_dispute_queue(db):
+    """Очередь споров: время открытия, закрепление за админом + частичный индекс по SLA"""
+    for table in ("deals", "deals_archive"):
+        cur = await db.execute(f"PRAGMA table_info({table})")
+        cols = {row[1] for row in await cur.fetchall()}
+        for name, ddl in (("disputed_at", "DATETIME DEFAULT NULL"),
+                          ("dispute_assignee_id", "INTEGER DEFAULT NULL"),
+                          ("dispute_assigned_at", "DATETIME DEFAULT NULL")):
+            if name not in cols:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}")
+    await db.execute("UPDATE deals SET disputed_at = created_at WHERE status = 'dispute' AND disputed_at IS NULL")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_deals_dispute_queue ON deals(status, disputed_at, id) WHERE status = 'dispute'")
+
+
+async def _migration_withdraw_requisites(db):
+    """Метод и (зашифрованные) реквизиты вывода в отдельных колонках orders вместо строки в details"""
+    cur = await db.execute("PRAGMA table_info(orders)")
+    cols = {row[1] for row in await cur.fetchall()}
+    for name in ("method", "requisites_enc"):
+        if name not in cols:
+            await db.execute(f"ALTER TABLE orders ADD COLUMN {name} TEXT DEFAULT NULL")
+    # Исходные строки details сохраняем до очистки - на случай ошибки разбора
+    await db.execute("""
+    CREATE TABLE IF NOT EXISTS orders_details_backup (
+        order_id INTEGER PRIMARY KEY,
+        details TEXT,
+        saved_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )""")
+    await db.execute("""
+    INSERT OR IGNORE INTO orders_details_backup(order_id, details)
+    SELECT id, details FROM orders WHERE type = 'withdraw_rub' AND method IS NULL
+    """)
+    cur = await db.execute("SELECT id, details FROM orders WHERE type = 'withdraw_rub' AND method IS NULL")
+    expected = {}
+    rows = []
+    for order_id, details in await cur.fetchall():
+        match = re.search(r"Method: (\w+), Details: (.*)", details or "", re.DOTALL)
+        method, requisites = match.groups() if match else ("unknown", details or "")
+        # Старые реквизиты хранились с MarkdownV2-экранированием
+        requisites = re.sub(r"\\(.)", r"\1", requisites)
+        if match:
+            expected[order_id] = (method.lower(), requisites)
+        rows.append((method.lower(), encrypt_requisites(requisites), order_id))
+    await db.executemany("UPDATE orders SET method = ?, requisites_enc = ? WHERE id = ?", rows)
+    # details очищаем только там, где строка разобрана и новые колонки читаются обратно в то же значение
+    verified = []
+    for order_id, (method, requisites) in expected.items():
+        cur = await db.execute("SELECT method, requisites_enc FROM orders WHERE id = ?", (order_id,))
+        row = await cur.fetchone()
+        if row and row[0] == method and decrypt_requisites(row[1]) == requisites:
+            verified.append((order_id,))
+    await db.executemany("UPDATE orders SET details = NULL WHERE id = ?", verified)
+    if len(verified) < len(rows):
+        logger.warning(f"Withdraw requisites migration kept details for {len(rows) - len(verified)} unparsed orders")
+
+
+# Упорядоченный список миграций: (версия, название, шаг). Новые — только в конец.
+MIGRATIONS = [
+    (1, "baseline", _migration_baseline),
+    (2, "hot query indexes", _migration_hot_indexes),
+    (3, "daily stats rollup", _migration_daily_stats),
+    (4, "seller analytics", _migration_seller_analytics),
+    (5, "log retention", _migration_log_retention),
+    (6, "transactions ledger", _migration_transactions),
+    (7, "history paging indexes", _migration_history_indexes),
+    (8, "deals archive", _migration_deals_archive),
+    (9, "coupon reservations", _migration_coupon_reservations),
+    (10, "referral counters", _migration_referral_counters),
+    (11, "referral bonus ledger", _migration_referral_earned),
+    (12, "dispute queue", _migration_dispute_queue),
+    (13, "withdraw requisites", _migration_withdraw_requisites),
+]
+
+
+async def get_schema_version(db) -> int:
+    try:
+        cur = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except aiosqlite.OperationalError:
+        return 0
+    return (await cur.fetchone())[0]
 
-        # 7. Отзывы
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS reviews (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            reviewer_id INTEGER,
-            target_id INTEGER,
-            deal_id INTEGER UNIQUE,
-            rating INTEGER,
-            comment TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
 
-        # 8. Купоны
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS coupons (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT UNIQUE,
-            type TEXT,
-            value REAL,
-            uses_limit INTEGER DEFAULT 0,
-            min_amount INTEGER DEFAULT 0,
-            is_active BOOLEAN DEFAULT 1,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
+async def init_db():
+    """Применяет недостающие миграции; при актуальной схеме DDL не выполняется"""
+    async with db_connect() as db:
+        # WAL: читатели (в т.ч. снапшот VACUUM INTO) не блокируют писателей. Режим хранится в файле БД,
+        # но ставим его при каждом старте - БД могли восстановить из снапшота или создать заново
+        cur = await db.execute("PRAGMA journal_mode = WAL")
+        mode = (await cur.fetchone())[0]
+        if mode != "wal":
+            logger.warning(f"DB journal_mode is {mode}, not WAL: backups will block writers")
+        current = await get_schema_version(db)
+        pending = [m for m in MIGRATIONS if m[0] > current]
+        if not pending:
+            logger.info(f"DB schema is up to date (v{current})")
+            return
 
         await db.execute("""
-        CREATE TABLE IF NOT EXISTS coupon_uses (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            coupon_id INTEGER,
-            user_id INTEGER,
-            deal_id INTEGER,
-            used_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
         """)
-
-        # 9. Установка начальных значений конфига (если их нет)
-        cur = await db.execute("SELECT value FROM config WHERE key = ?", ("price_per_1000",))
-        if not await cur.fetchone():
-            await db.execute("INSERT INTO config(key, value) VALUES(?, ?)", ("price_per_1000", "300.00"))
-            
-        cur = await db.execute("SELECT value FROM config WHERE key = ?", ("min_withdraw",))
-        if not await cur.fetchone():
-            await db.execute("INSERT INTO config(key, value) VALUES(?, ?)", ("min_withdraw", "100.00"))
-
-        await db.commit()
+        for version, name, step in pending:
+            await step(db)
+            await db.execute("INSERT INTO schema_version(version, name) VALUES(?, ?)", (version, name))
+            await db.commit()
+            logger.info(f"Applied DB migration {version}: {name}")
 
 # --- DB Config Functions ---
+@db_timed
 async def get_config(key:str)->Optional[str]:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT value FROM config WHERE key = ?", (key,))
         row = await cur.fetchone()
         return row[0] if row else None
@@ -461,42 +1575,31 @@ async def get_config(key:str)->Optional[str]:
     
 async def get_coupon_data(coupon_id: Optional[int]) -> CouponData:
     """
-    Получает данные купона из базы данных по его ID.
+    Получает данные купона по его ID (из in-memory индекса купонов).
 
     :param coupon_id: ID купона. Может быть None.
-    :return: Кортеж с данными купона или None, если купон не найден 
-             или переданный coupon_id был None.
+    :return: Кортеж (id, code, type, value, uses_limit, min_amount, is_active)
+             или None, если купон не найден или переданный coupon_id был None.
     """
     if coupon_id is None:
         return None
-        
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Используем тройные кавычки для многострочного SQL-запроса
-        query = """
-            SELECT 
-                id, code, type, value, uses_limit, min_amount, is_active 
-            FROM 
-                coupons 
-            WHERE 
-                id = ?
-        """
-        
-        cur = await db.execute(query, (coupon_id,))
-        return await cur.fetchone()
+    return await coupon_index.get_by_id(coupon_id)
 
 # -------------------------------------------------------------------
 # Функция set_config выглядела правильно, 
 # но я даю ее в контексте для завершенности
 # -------------------------------------------------------------------
 
+@db_timed
 async def set_config(key:str, value:str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         await db.execute("REPLACE INTO config(key,value) VALUES(?,?)", (key,value))
         await db.commit()
 # --- DB User Functions ---
+@db_timed
 async def get_user_data(user_id:int):
     """Возвращает данные пользователя по ID."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT username, balance, created_at, referrer_id, active_coupon_id FROM users WHERE user_id = ?", (user_id,))
         return await cur.fetchone()
 
@@ -505,87 +1608,242 @@ async def get_user_balance(user_id:int) -> float:
     data = await get_user_data(user_id)
     return float(data[1]) if data and data[1] is not None else 0.0
 
-async def update_user_balance(user_id:int, new_balance:float):
-    """Обновляет баланс пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def update_user_balance(user_id:int, new_balance:float, admin_id: Optional[int] = None):
+    """Обновляет баланс пользователя (разница пишется в transactions как admin_adjust)."""
+    async with db_connect() as db:
+        # Блокировка записи до чтения: иначе параллельное списание между SELECT и UPDATE исказит delta в transactions
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+        row = await cur.fetchone()
         await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
+        delta = round(new_balance - (row[0] if row else 0), 2)
+        if delta:
+            await add_transaction(db, user_id, "admin_adjust", delta, counterparty=admin_id)
         await db.commit()
         await log_event(user_id, "BALANCE_UPDATE", f"New balance: {new_balance:.2f}")
 
+@db_timed
 async def create_user_if_not_exists(user: types.User, referrer_id: Optional[int] = None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Регистрирует пользователя; рефереру (если он есть в базе) - счётчик и бонус в той же транзакции."""
+    async with db_connect() as db:
         cur = await db.execute("SELECT user_id FROM users WHERE user_id = ?", (user.id,))
         if not await cur.fetchone():
             referrer_id = referrer_id if referrer_id and referrer_id != user.id else None
+            if referrer_id:
+                cur = await db.execute(
+                    "UPDATE users SET referral_count = referral_count + 1, balance = balance + ?, "
+                    "referral_earned = referral_earned + ? WHERE user_id = ?",
+                    (REFERRAL_BONUS_RUB, REFERRAL_BONUS_RUB, referrer_id)
+                )
+                if cur.rowcount:
+                    await add_transaction(db, referrer_id, "referral_bonus", REFERRAL_BONUS_RUB, counterparty=user.id)
+                else:
+                    referrer_id = None # Несуществующий реферер - не связываем
             await db.execute("INSERT INTO users(user_id, username, referrer_id) VALUES(?, ?, ?)",
                              (user.id, user.username, referrer_id))
+            await db.execute(
+                "INSERT INTO daily_stats(day, new_users) VALUES(date('now'), 1) "
+                "ON CONFLICT(day) DO UPDATE SET new_users = new_users + 1"
+            )
             await db.commit()
             if referrer_id:
                 await log_event(user.id, "REFERRAL_REG", f"Referrer: {referrer_id}")
                 return True # Новый пользователь по реф. ссылке
         return False # Уже существует или не по реф. ссылке
 
+@db_timed
 async def get_all_user_ids():
     """Возвращает список всех user_id."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT user_id FROM users")
         return [row[0] for row in await cur.fetchall()]
 
-async def get_referral_stats(user_id: int):
-    """Возвращает количество рефералов и заработок."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Количество рефералов
-        cur_ref = await db.execute("SELECT COUNT(*) FROM users WHERE referrer_id = ?", (user_id,))
-        ref_count = (await cur_ref.fetchone())[0]
-
-        # Общий заработок с рефералов (фиксированная сумма за привлечение)
-        rub_earned = ref_count * REFERRAL_BONUS_RUB
+class ProfileSnapshot(NamedTuple):
+    username: Optional[str]
+    balance: float
+    referral_count: int
+    referral_earned: float
+    sales_count: int
+    sales_rub: float
+    rating_avg: float
+    review_count: int
+
+@db_timed
+async def get_profile_snapshot(user_id: int) -> ProfileSnapshot:
+    """Данные для экранов профиля одним запросом: баланс, рефералы, продажи, рейтинг."""
+    async with db_connect() as db:
+        cur = await db.execute("""
+            SELECT u.username, u.balance, u.referral_count, u.referral_earned,
+                   s.completed_count, s.completed_rub,
+                   (SELECT AVG(rating) FROM reviews WHERE target_id = u.user_id),
+                   (SELECT COUNT(*) FROM reviews WHERE target_id = u.user_id)
+            FROM users u
+            LEFT JOIN seller_summary s ON s.seller_id = u.user_id
+            WHERE u.user_id = ?
+        """, (user_id,))
+        row = await cur.fetchone()
+    if not row:
+        return ProfileSnapshot(None, 0.0, 0, 0.0, 0, 0.0, 0.0, 0)
+    username, balance, ref_count, ref_earned, sales_count, sales_rub, rating_avg, review_count = row
+    return ProfileSnapshot(
+        username=username,
+        balance=float(balance or 0),
+        referral_count=ref_count or 0,
+        referral_earned=float(ref_earned or 0),
+        sales_count=sales_count or 0,
+        sales_rub=float(sales_rub or 0),
+        rating_avg=float(rating_avg) if rating_avg else 0.0,
+        review_count=review_count,
+    )
 
-        return ref_count, rub_earned
+# Рефералы всех уровней от user_id: каждый шаг - поиск по idx_users_referrer
+REFERRAL_TREE_CTE = """
+    WITH RECURSIVE tree(user_id, depth) AS (
+        SELECT user_id, 1 FROM users WHERE referrer_id = ?
+        UNION ALL
+        SELECT u.user_id, t.depth + 1 FROM users u
+        JOIN tree t ON u.referrer_id = t.user_id
+        WHERE t.depth < ?
+    )
+"""
+
+@db_timed
+async def get_referral_report(user_id: int, max_depth: int = REFERRAL_TREE_DEPTH):
+    """Отчёт по кампании реферера по уровням: [(depth, пользователей, покупателей, оборот_руб)]."""
+    async with db_connect() as db:
+        cur = await db.execute(REFERRAL_TREE_CTE + """
+            , spent(user_id, depth, kopecks) AS (
+                SELECT t.user_id, t.depth,
+                       (SELECT -SUM(amount_kopecks) FROM transactions x
+                        WHERE x.user_id = t.user_id AND x.kind = 'deal_payment')
+                FROM tree t
+            )
+            SELECT depth, COUNT(*), COUNT(kopecks), COALESCE(SUM(kopecks), 0) / 100.0
+            FROM spent GROUP BY depth ORDER BY depth
+        """, (user_id, max_depth))
+        return await cur.fetchall()
 
+@db_timed
 async def set_user_active_coupon(user_id: int, coupon_id: Optional[int]):
     """Устанавливает активный купон для пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         await db.execute("UPDATE users SET active_coupon_id = ? WHERE user_id = ?", (coupon_id, user_id))
         await db.commit()
 
 # --- DB Order Functions (Withdraws) ---
+@db_timed
 async def create_order(user_id:int, typ:str, amount:int, price:float, details:str='', provider:str='manual')->int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("INSERT INTO orders(user_id,type,amount,price,status,details,provider) VALUES(?,?,?,?,?,?,?)",
                                (user_id, typ, amount, price, 'pending', details, provider))
         await db.commit()
         return cur.lastrowid
 
+@db_timed
 async def update_order_status(order_id:int, status:str, payment_id:Optional[str]=None):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         if payment_id:
             await db.execute("UPDATE orders SET status=?, payment_id=? WHERE id=?", (status, payment_id, order_id))
         else:
             await db.execute("UPDATE orders SET status=? WHERE id=?", (status, order_id))
         await db.commit()
 
-async def get_orders_by_user(user_id:int, limit:int=100):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, type, amount, price, status, details, created_at FROM orders WHERE user_id = ? ORDER BY created_at DESC LIMIT ?", (user_id, limit))
-        return await cur.fetchall()
+@db_timed
+async def get_orders_by_user(user_id:int, limit:int=HISTORY_PAGE_SIZE, cursor:Optional[Tuple[str, int]]=None, older:bool=True):
+    """Keyset-страница заявок пользователя: (rows, есть_старее, есть_новее)."""
+    async with db_connect() as db:
+        return await fetch_keyset_page(
+            db, "orders", "id, type, amount, price, status, method, created_at",
+            "user_id = ?", (user_id,), cursor, older, limit
+        )
+
+@db_timed
+async def get_pending_withdrawals(limit:int=30, method:str=""):
+    """Возвращает ожидающие выводы: [(id, user_id, price, method, requisites, created_at)] (реквизиты расшифрованы)."""
+    where, params = "type = 'withdraw_rub' AND status = 'pending'", ()
+    if method:
+        where += " AND method = ?"
+        params = (method,)
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"SELECT id, user_id, price, method, requisites_enc, created_at FROM orders WHERE {where} ORDER BY created_at DESC LIMIT ?",
+            (*params, limit)
+        )
+        return [(*row[:4], decrypt_requisites(row[4]), row[5]) for row in await cur.fetchall()]
 
-async def get_pending_withdrawals(limit:int=30):
-    """Возвращает ожидающие выводы."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id,user_id,price,details,created_at FROM orders WHERE type = 'withdraw_rub' AND status = 'pending' ORDER BY created_at DESC LIMIT ?", (limit,))
+@db_timed
+async def get_pending_withdrawal_totals():
+    """Ожидающие выводы по методам: [(method, кол-во, сумма)]."""
+    async with db_connect() as db:
+        cur = await db.execute(
+            "SELECT method, COUNT(*), SUM(price) FROM orders WHERE type = 'withdraw_rub' AND status = 'pending' "
+            "GROUP BY method ORDER BY method"
+        )
         return await cur.fetchall()
-        
+
+@db_timed
+async def get_pending_withdrawal_ids(limit: int = WITHDRAW_BATCH_MAX, method: str = "") -> list:
+    """id ожидающих выводов, старые первыми (для пакетной выплаты)."""
+    where, params = "type = 'withdraw_rub' AND status = 'pending'", ()
+    if method:
+        where += " AND method = ?"
+        params = (method,)
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"SELECT id FROM orders WHERE {where} ORDER BY created_at, id LIMIT ?",
+            (*params, limit)
+        )
+        return [row[0] for row in await cur.fetchall()]
+
+@db_timed
+async def get_withdrawals_by_ids(order_ids: list):
+    """Ожидающие заявки на вывод по списку id, сгруппированные по методу:
+    [(id, user_id, price, method, requisites, created_at)] (реквизиты расшифрованы)."""
+    if not order_ids:
+        return []
+    marks = ", ".join("?" for _ in order_ids)
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"SELECT id, user_id, price, method, requisites_enc, created_at FROM orders "
+            f"WHERE id IN ({marks}) AND type = 'withdraw_rub' AND status = 'pending' ORDER BY method, id",
+            order_ids
+        )
+        return [(*row[:4], decrypt_requisites(row[4]), row[5]) for row in await cur.fetchall()]
+
+@db_timed
+async def complete_withdrawals(order_ids: list, admin_id: int) -> list:
+    """Помечает заявки выполненными одной транзакцией (только те, что ещё pending).
+    Возвращает [(order_id, user_id, сумма)] реально закрытых заявок."""
+    if not order_ids:
+        return []
+    marks = ", ".join("?" for _ in order_ids)
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"UPDATE orders SET status = 'completed' WHERE id IN ({marks}) "
+            "AND type = 'withdraw_rub' AND status = 'pending' RETURNING id, user_id, price",
+            order_ids
+        )
+        done = sorted(await cur.fetchall())
+        await db.executemany(
+            "INSERT INTO logs (user_id, action, details) VALUES (?, 'WITHDRAW_COMPLETED', ?)",
+            [(user_id, f"Order: {order_id}, Admin: {admin_id}") for order_id, user_id, _ in done]
+        )
+        await db.commit()
+        return done
+
+@db_timed
 async def get_order_data(order_id: int):
     """Возвращает данные о заказе/выводе."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT id,user_id,type,amount,price,status,details,created_at FROM orders WHERE id = ?", (order_id,))
         return await cur.fetchone()
 
 # --- DB Ad Functions ---
+@db_timed
 async def create_ad(user_id: int, title: str, rate: float, min_amount: int, max_amount: int, methods: str, description: str) -> int:
     """Создает новое объявление о продаже."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute(
             "INSERT INTO ads (user_id, title, rate, min_amount, max_amount, payment_methods, description) VALUES (?, ?, ?, ?, ?, ?, ?)",
             (user_id, title, rate, min_amount, max_amount, methods, description)
@@ -593,104 +1851,281 @@ async def create_ad(user_id: int, title: str, rate: float, min_amount: int, max_
         await db.commit()
         return cur.lastrowid
 
+@db_timed
 async def get_ads_by_user(user_id: int):
     """Возвращает объявления пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT id, user_id, title, rate, min_amount, max_amount, payment_methods, active, description FROM ads WHERE user_id = ? ORDER BY active DESC, created_at DESC", (user_id,))
         return await cur.fetchall()
 
+@db_timed
 async def get_active_ads():
     """Возвращает все активные объявления."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT id, user_id, title, rate, min_amount, max_amount, payment_methods, active, description FROM ads WHERE active = 1 ORDER BY created_at DESC")
         return await cur.fetchall()
 
+@db_timed
 async def get_ad_data(ad_id: int):
     """Возвращает данные объявления."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT id, user_id, title, rate, min_amount, max_amount, payment_methods, active, description FROM ads WHERE id = ?", (ad_id,))
         return await cur.fetchone()
 
+@db_timed
 async def toggle_ad_active(ad_id: int, active_status: int):
     """Переключает статус активности объявления (0 или 1)."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         await db.execute("UPDATE ads SET active = ? WHERE id = ?", (active_status, ad_id))
         await db.commit()
 
 # --- DB P2P Deals Functions ---
-async def create_deal(buyer_id: int, seller_id: int, ad_id: int, amount: int, price: float, rub_amount: float, roblox_link: str, payment_id: str, coupon_id: Optional[int] = None, coupon_code: Optional[str] = None) -> int:
-    """Создает новую P2P сделку в статусе 'pending_payment'."""
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def create_deal(buyer_id: int, seller_id: int, ad_id: int, amount: int, price: float, rub_amount: float, roblox_link: str, payment_id: str, coupon_id: Optional[int] = None, coupon_code: Optional[str] = None) -> Optional[int]:
+    """Создает новую P2P сделку в статусе 'pending_payment' (с бронью купона).
+    Возвращает None, если купон забронировать не удалось (лимит/повтор/выключен)."""
+    async with db_connect() as db:
         cur = await db.execute(
             "INSERT INTO deals (buyer_id, seller_id, ad_id, amount, price, rub_amount, roblox_link, payment_id, status, coupon_id, coupon_code) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
             (buyer_id, seller_id, ad_id, amount, price, rub_amount, roblox_link, payment_id, 'pending_payment', coupon_id, coupon_code)
         )
+        deal_id = cur.lastrowid
+        if coupon_id and not await reserve_coupon(db, coupon_id, buyer_id, deal_id):
+            await db.rollback()
+            return None
+        await bump_seller_stats(db, seller_id, created=1)
         await db.commit()
-        return cur.lastrowid
+    if coupon_id:
+        coupon_index.adjust(coupon_id, 1)
+    return deal_id
+
+@db_timed
+async def cancel_deal(deal_id: int, delete: bool = False) -> bool:
+    """Отменяет неоплаченную сделку (или удаляет черновик при delete=True) и снимает бронь купона."""
+    async with db_connect() as db:
+        if delete:
+            cur = await db.execute("DELETE FROM deals WHERE id = ? AND status = 'pending_payment'", (deal_id,))
+        else:
+            cur = await db.execute("UPDATE deals SET status = 'cancelled' WHERE id = ? AND status = 'pending_payment'", (deal_id,))
+        if cur.rowcount != 1:
+            return False
+        coupon_id = await release_coupon(db, deal_id)
+        await db.commit()
+    if coupon_id:
+        coupon_index.adjust(coupon_id, -1)
+    return True
+
+@db_timed
+async def get_expired_unpaid_deals(minutes: int = DEAL_PAYMENT_TIMEOUT_MIN):
+    """[(id, buyer_id, payment_id)] сделок, не оплаченных дольше minutes минут."""
+    async with db_connect() as db:
+        cur = await db.execute(
+            "SELECT id, buyer_id, payment_id FROM deals WHERE status = 'pending_payment' AND created_at < datetime('now', ?)",
+            (f"-{minutes} minutes",)
+        )
+        return await cur.fetchall()
 
-async def update_deal_status(deal_id: int, status: str):
-    """Обновляет статус сделки P2P."""
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def mark_deal_paid(deal_id: int) -> bool:
+    """Переводит сделку pending_payment -> paid_waiting_proof и учитывает её в daily_stats.
+    Возвращает False, если сделка уже была обработана (повторный webhook/проверка)."""
+    async with db_connect() as db:
+        cur = await db.execute(
+            "UPDATE deals SET status = 'paid_waiting_proof' WHERE id = ? AND status = 'pending_payment'",
+            (deal_id,)
+        )
+        if cur.rowcount != 1:
+            return False
+        await db.execute("""
+            INSERT INTO daily_stats(day, robux_paid, rub_paid)
+            SELECT date(created_at), amount, rub_amount FROM deals WHERE id = ?
+            ON CONFLICT(day) DO UPDATE SET
+                robux_paid = robux_paid + excluded.robux_paid,
+                rub_paid = rub_paid + excluded.rub_paid
+        """, (deal_id,))
+        cur = await db.execute("SELECT buyer_id, seller_id, rub_amount FROM deals WHERE id = ?", (deal_id,))
+        buyer_id, seller_id, rub_amount = await cur.fetchone()
+        await bump_seller_stats(db, seller_id, paid=1)
         await db.execute(
-            "UPDATE deals SET status = ? WHERE id = ?", 
-            (status, deal_id)
+            "UPDATE coupon_uses SET status = 'used', used_at = CURRENT_TIMESTAMP WHERE deal_id = ? AND status = 'reserved'",
+            (deal_id,)
         )
+        await add_transaction(db, buyer_id, "deal_payment", -(rub_amount or 0), counterparty=seller_id, deal_id=deal_id)
         await db.commit()
+        return True
 
+@db_timed
 async def set_deal_proof(deal_id: int, file_id: str):
     """Сохраняет file_id скриншота оплаты."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
+        cur = await db.execute("SELECT seller_id, status FROM deals WHERE id = ?", (deal_id,))
+        row = await cur.fetchone()
         await db.execute(
             "UPDATE deals SET proof_file_id = ?, status = 'pending_proof' WHERE id = ?",
             (file_id, deal_id)
         )
+        if row and row[1] == 'paid_waiting_proof': # Повторная загрузка пруфа не считается
+            await bump_seller_stats(db, row[0], proof=1)
         await db.commit()
 
-async def get_deal_data(deal_id: int):
-    """Возвращает данные о сделке P2P."""
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def complete_deal(deal_id: int) -> bool:
+    """Завершает сделку (pending_proof/dispute -> completed), фиксирует completed_at и счётчики продавца."""
+    async with db_connect() as db:
         cur = await db.execute(
-            "SELECT id, buyer_id, seller_id, ad_id, amount, rub_amount, roblox_link, payment_id, status, proof_file_id, created_at, coupon_id, coupon_code, dispute_reason, dispute_admin_id FROM deals WHERE id = ?", 
+            "UPDATE deals SET status = 'completed', completed_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status IN ('pending_proof', 'dispute')",
             (deal_id,)
         )
-        return await cur.fetchone()
+        if cur.rowcount != 1:
+            return False
+        cur = await db.execute("SELECT buyer_id, seller_id, rub_amount FROM deals WHERE id = ?", (deal_id,))
+        buyer_id, seller_id, rub_amount = await cur.fetchone()
+        await bump_seller_stats(db, seller_id, completed=1, rub_completed=rub_amount or 0)
+        await db.execute(
+            "INSERT INTO seller_summary(seller_id, completed_count, completed_rub) VALUES(?, 1, ?) "
+            "ON CONFLICT(seller_id) DO UPDATE SET completed_count = completed_count + 1, "
+            "completed_rub = completed_rub + excluded.completed_rub",
+            (seller_id, rub_amount or 0)
+        )
+        await add_transaction(db, seller_id, "deal_sale", rub_amount or 0, counterparty=buyer_id, deal_id=deal_id)
+        await db.commit()
+        return True
+
+@db_timed
+async def get_deal_data(deal_id: int):
+    """Возвращает данные о сделке P2P (если её нет в deals - ищет в deals_archive)."""
+    cols = "id, buyer_id, seller_id, ad_id, amount, rub_amount, roblox_link, payment_id, status, proof_file_id, created_at, coupon_id, coupon_code, dispute_reason, dispute_admin_id"
+    async with db_connect() as db:
+        cur = await db.execute(f"SELECT {cols} FROM deals WHERE id = ?", (deal_id,))
+        row = await cur.fetchone()
+        if row is None:
+            cur = await db.execute(f"SELECT {cols} FROM deals_archive WHERE id = ?", (deal_id,))
+            row = await cur.fetchone()
+        return row
+
+@db_timed
+async def get_deals_by_user(user_id: int, is_seller: bool, limit: int = HISTORY_PAGE_SIZE,
+                            cursor: Optional[Tuple[str, int]] = None, older: bool = True, status: Optional[str] = None):
+    """Keyset-страница сделок покупателя или продавца: (rows, есть_старее, есть_новее).
+    Только горячая таблица deals: сделки, перенесённые в deals_archive (DEALS_ARCHIVE_DAYS), в истории не видны."""
+    where = f"{'seller_id' if is_seller else 'buyer_id'} = ?"
+    params = (user_id,)
+    if status:
+        where += " AND status = ?"
+        params += (status,)
+    async with db_connect() as db:
+        return await fetch_keyset_page(
+            db, "deals", "id, amount, rub_amount, status, buyer_id, seller_id, created_at",
+            where, params, cursor, older, limit
+        )
 
-async def get_deals_by_user(user_id: int, is_seller: bool, limit: int = 20):
-    """Возвращает сделки для покупателя или продавца."""
-    role_col = 'seller_id' if is_seller else 'buyer_id'
-    async with aiosqlite.connect(DB_PATH) as db:
+class DisputeCase(NamedTuple):
+    deal_id: int
+    buyer_id: int
+    seller_id: int
+    amount: int
+    rub_amount: float
+    roblox_link: Optional[str]
+    status: str
+    proof_file_id: Optional[str]
+    disputed_at: Optional[str]
+    reason: Optional[str]
+    assignee_id: Optional[int]  # None, если спор свободен или закрепление истекло
+
+DISPUTE_LOCK_SQL = f"dispute_assigned_at > datetime('now', '-{DISPUTE_LOCK_MIN} minutes')"
+DISPUTE_COLS = (
+    "id, buyer_id, seller_id, amount, rub_amount, roblox_link, status, proof_file_id, disputed_at, dispute_reason, "
+    f"CASE WHEN {DISPUTE_LOCK_SQL} THEN dispute_assignee_id END"
+)
+
+@db_timed
+async def get_dispute_queue(anchor: int = 0, forward: bool = True, mine_id: int = 0, min_rub: int = 0,
+                            seller_id: int = 0, limit: int = DISPUTE_PAGE_SIZE):
+    """Страница очереди споров по SLA (давние первыми), keyset по (disputed_at, id).
+    Возвращает (споры, есть_раньше, есть_дальше)."""
+    where, params = "status = 'dispute'", []
+    if mine_id:
+        where += f" AND dispute_assignee_id = ? AND {DISPUTE_LOCK_SQL}"
+        params.append(mine_id)
+    if min_rub:
+        where += " AND rub_amount >= ?"
+        params.append(min_rub)
+    if seller_id:
+        where += " AND seller_id = ?"
+        params.append(seller_id)
+    op, order = (">", "ASC") if forward else ("<", "DESC")
+    if anchor:
+        where += f" AND (disputed_at, id) {op} (SELECT disputed_at, id FROM deals WHERE id = ?)"
+        params.append(anchor)
+    async with db_connect() as db:
         cur = await db.execute(
-            f"SELECT id, amount, rub_amount, status, created_at, buyer_id, seller_id FROM deals WHERE {role_col} = ? ORDER BY created_at DESC LIMIT ?",
-            (user_id, limit)
+            f"SELECT {DISPUTE_COLS} FROM deals WHERE {where} ORDER BY disputed_at {order}, id {order} LIMIT ?",
+            (*params, limit + 1)
         )
-        return await cur.fetchall()
+        rows = await cur.fetchall()
+    more = len(rows) > limit
+    cases = [DisputeCase(*row) for row in rows[:limit]]
+    if forward:
+        return cases, bool(anchor), more
+    return cases[::-1], more, True
+
+@db_timed
+async def get_dispute_case(deal_id: int) -> Optional[DisputeCase]:
+    """Карточка спора (поиск по PK, без кэша: статус и закрепление должны быть актуальными)."""
+    async with db_connect() as db:
+        cur = await db.execute(f"SELECT {DISPUTE_COLS} FROM deals WHERE id = ?", (deal_id,))
+        row = await cur.fetchone()
+    return DisputeCase(*row) if row else None
 
-async def get_dispute_deals():
-    """Возвращает сделки в статусе 'dispute'."""
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def take_dispute(deal_id: int, admin_id: int) -> bool:
+    """Закрепляет спор за админом, если он свободен (или закрепление истекло). True - спор наш."""
+    async with db_connect() as db:
         cur = await db.execute(
-            "SELECT id, buyer_id, seller_id, amount, rub_amount, created_at, dispute_reason, proof_file_id FROM deals WHERE status = 'dispute' ORDER BY created_at ASC"
+            "UPDATE deals SET dispute_assignee_id = ?, dispute_assigned_at = CURRENT_TIMESTAMP "
+            f"WHERE id = ? AND status = 'dispute' AND (dispute_assignee_id IS NULL OR dispute_assignee_id = ? OR NOT {DISPUTE_LOCK_SQL})",
+            (admin_id, deal_id, admin_id)
         )
-        return await cur.fetchall()
+        await db.commit()
+    return cur.rowcount > 0
 
+@db_timed
+async def release_dispute(deal_id: int, admin_id: int) -> bool:
+    """Снимает закрепление спора (только своё)."""
+    async with db_connect() as db:
+        cur = await db.execute(
+            "UPDATE deals SET dispute_assignee_id = NULL, dispute_assigned_at = NULL "
+            "WHERE id = ? AND dispute_assignee_id = ?",
+            (deal_id, admin_id)
+        )
+        await db.commit()
+    return cur.rowcount > 0
+
+@db_timed
 async def set_deal_dispute(deal_id: int, reason: str):
-    """Переводит сделку в статус спора."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Переводит сделку в статус спора (в конец очереди, без закрепления)."""
+    async with db_connect() as db:
         await db.execute(
-            "UPDATE deals SET status = 'dispute', dispute_reason = ? WHERE id = ?",
+            "UPDATE deals SET status = 'dispute', dispute_reason = ?, disputed_at = CURRENT_TIMESTAMP, "
+            "dispute_assignee_id = NULL, dispute_assigned_at = NULL WHERE id = ?",
             (reason, deal_id)
         )
         await db.commit()
 
-async def resolve_deal_dispute(deal_id: int, winner_id: int, admin_id: int, amount: float):
-    """Разрешает спор, переводит средства победителю."""
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def resolve_deal_dispute(deal_id: int, winner_id: int, admin_id: int, amount: float) -> bool:
+    """Разрешает спор, переводит средства победителю. False - спор уже закрыт или закреплён за другим админом."""
+    async with db_connect() as db:
         # Устанавливаем статус и админа
-        await db.execute(
-            "UPDATE deals SET status = 'resolved', dispute_admin_id = ?, dispute_resolved_at = CURRENT_TIMESTAMP WHERE id = ?",
-            (admin_id, deal_id)
+        cur = await db.execute(
+            "UPDATE deals SET status = 'resolved', dispute_admin_id = ?, dispute_resolved_at = CURRENT_TIMESTAMP "
+            f"WHERE id = ? AND status = 'dispute' AND (dispute_assignee_id IS NULL OR dispute_assignee_id = ? OR NOT {DISPUTE_LOCK_SQL})",
+            (admin_id, deal_id, admin_id)
         )
         await db.commit()
+        if not cur.rowcount:
+            return False
 
         # Добавляем сумму победителю
         # Здесь логика немного сложнее: если победитель - продавец, ему зачисляется rub_amount. Если покупатель - ему возвращается rub_amount.
@@ -707,20 +2142,23 @@ async def resolve_deal_dispute(deal_id: int, winner_id: int, admin_id: int, amou
         # Пока просто залогируем и переведем в resolved.
 
         await log_event(admin_id, "DEAL_DISPUTE_RESOLVE", f"Deal #{deal_id} resolved by admin {admin_id}. Winner: {winner_id}. Amount: {amount:.2f} RUB")
-        
+        return True
+
 # --- DB Review Functions ---
+@db_timed
 async def create_review(reviewer_id: int, target_id: int, deal_id: int, rating: int, comment: str):
     """Создает новый отзыв."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         await db.execute(
             "INSERT INTO reviews (reviewer_id, target_id, deal_id, rating, comment) VALUES (?, ?, ?, ?, ?)",
             (reviewer_id, target_id, deal_id, rating, comment)
         )
         await db.commit()
 
+@db_timed
 async def get_user_rating_avg(user_id: int) -> Tuple[float, int]:
     """Возвращает средний рейтинг и количество отзывов."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute(
             "SELECT AVG(rating), COUNT(id) FROM reviews WHERE target_id = ?",
             (user_id,)
@@ -728,29 +2166,21 @@ async def get_user_rating_avg(user_id: int) -> Tuple[float, int]:
         avg, count = await cur.fetchone()
         return float(avg) if avg else 0.0, count
 
+@db_timed
 async def get_reviews_for_user(user_id: int, limit: int = 5):
     """Возвращает последние отзывы для пользователя."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute(
             "SELECT reviewer_id, rating, comment, created_at FROM reviews WHERE target_id = ? ORDER BY created_at DESC LIMIT ?",
             (user_id, limit)
         )
         return await cur.fetchall()
 
-async def get_user_sales_stats(user_id: int) -> Tuple[int, float]:
-    """Возвращает количество завершенных продаж и общий заработок."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT COUNT(id), COALESCE(SUM(rub_amount), 0) FROM deals WHERE seller_id = ? AND status = 'completed'",
-            (user_id,)
-        )
-        count, rub_amount = await cur.fetchone()
-        return count, float(rub_amount)
-
 # --- DB Coupon Functions ---
+@db_timed
 async def create_or_update_coupon(code: str, type: str, value: float, uses_limit: int, min_amount: int, is_active: bool, coupon_id: Optional[int] = None) -> int:
     """Создает или обновляет купон."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         code = code.upper()
         if coupon_id:
             await db.execute(
@@ -765,76 +2195,490 @@ async def create_or_update_coupon(code: str, type: str, value: float, uses_limit
             )
             cid = cur.lastrowid
         await db.commit()
-        return cid
+    coupon_index.invalidate()
+    return cid
 
-async def get_coupon(code: str):
-    """Возвращает купон по коду."""
-    async with aiosqlite.connect(DB_PATH) as db:
+@db_timed
+async def load_coupons():
+    """Все купоны со счётчиком использований (для индекса купонов)."""
+    async with db_connect() as db:
         cur = await db.execute(
-            "SELECT id, code, type, value, uses_limit, min_amount, is_active FROM coupons WHERE code = ?",
-            (code.upper(),)
+            "SELECT id, code, type, value, uses_limit, min_amount, is_active, uses_count FROM coupons"
         )
-        return await cur.fetchone()
+        return await cur.fetchall()
+
+
+class CouponIndex:
+    """In-memory индекс купонов по коду и id + кэш счётчика использований.
+    Служит для чтения и предпроверок; лимит окончательно проверяет reserve_coupon в БД."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.by_code: Dict[str, tuple] = {}
+        self.by_id: Dict[int, tuple] = {}
+        self.uses: Dict[int, int] = {}
+        self.loaded_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.loaded_at = 0.0
+
+    async def _ensure(self):
+        if time.monotonic() - self.loaded_at < self.ttl:
+            return
+        async with self._lock:
+            if time.monotonic() - self.loaded_at < self.ttl:
+                return
+            by_code, by_id, uses = {}, {}, {}
+            for *coupon, uses_count in await load_coupons():
+                coupon = tuple(coupon)
+                by_code[coupon[1]] = coupon
+                by_id[coupon[0]] = coupon
+                uses[coupon[0]] = uses_count or 0
+            self.by_code, self.by_id, self.uses = by_code, by_id, uses
+            self.loaded_at = time.monotonic()
+
+    async def get_by_code(self, code: str) -> CouponData:
+        await self._ensure()
+        return self.by_code.get(code.upper())
+
+    async def get_by_id(self, coupon_id: int) -> CouponData:
+        await self._ensure()
+        return self.by_id.get(coupon_id)
 
+    async def uses_count(self, coupon_id: int) -> int:
+        await self._ensure()
+        return self.uses.get(coupon_id, 0)
+
+    def adjust(self, coupon_id: int, delta: int):
+        """Локально сдвигает счётчик после брони/освобождения, не дожидаясь перечитывания."""
+        if coupon_id in self.uses:
+            self.uses[coupon_id] = max(0, self.uses[coupon_id] + delta)
+
+
+coupon_index = CouponIndex(COUPON_INDEX_TTL)
+
+
+async def get_coupon(code: str):
+    """Возвращает купон по коду."""
+    return await coupon_index.get_by_code(code)
+
+@db_timed
 async def get_all_coupons():
     """Возвращает все купоны."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute(
             "SELECT id, code, type, value, uses_limit, min_amount, is_active FROM coupons ORDER BY created_at DESC"
         )
         return await cur.fetchall()
 
 async def get_coupon_use_count(coupon_id: int):
-    """Возвращает количество использований купона."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT COUNT(*) FROM coupon_uses WHERE coupon_id = ?",
-            (coupon_id,)
-        )
-        return (await cur.fetchone())[0]
+    """Возвращает количество использований купона (включая забронированные неоплаченными сделками)."""
+    return await coupon_index.uses_count(coupon_id)
+
+async def reserve_coupon(db, coupon_id: int, user_id: int, deal_id: int) -> bool:
+    """Бронирует слот купона одним условным UPDATE (активен, лимит не исчерпан, пользователь ещё не использовал).
+    Вызывается внутри транзакции создания сделки."""
+    cur = await db.execute(
+        "UPDATE coupons SET uses_count = uses_count + 1 "
+        "WHERE id = ? AND is_active = 1 AND (uses_limit = 0 OR uses_count < uses_limit) "
+        "AND NOT EXISTS (SELECT 1 FROM coupon_uses WHERE coupon_id = ? AND user_id = ?)",
+        (coupon_id, coupon_id, user_id)
+    )
+    if cur.rowcount != 1:
+        return False
+    await db.execute(
+        "INSERT INTO coupon_uses (coupon_id, user_id, deal_id, status) VALUES (?, ?, ?, 'reserved')",
+        (coupon_id, user_id, deal_id)
+    )
+    return True
 
-async def log_coupon_use(coupon_id: int, user_id: int, deal_id: int):
-    """Логирует использование купона."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO coupon_uses (coupon_id, user_id, deal_id) VALUES (?, ?, ?)",
-            (coupon_id, user_id, deal_id)
-        )
-        await db.commit()
+async def release_coupon(db, deal_id: int) -> Optional[int]:
+    """Снимает бронь купона по неоплаченной сделке; возвращает coupon_id или None."""
+    cur = await db.execute("SELECT coupon_id FROM coupon_uses WHERE deal_id = ? AND status = 'reserved'", (deal_id,))
+    row = await cur.fetchone()
+    if not row:
+        return None
+    await db.execute("DELETE FROM coupon_uses WHERE deal_id = ? AND status = 'reserved'", (deal_id,))
+    await db.execute("UPDATE coupons SET uses_count = MAX(uses_count - 1, 0) WHERE id = ?", (row[0],))
+    return row[0]
 
+@db_timed
 async def has_user_used_coupon(user_id: int, coupon_id: int):
-    """Проверяет, использовал ли пользователь купон ранее."""
-    async with aiosqlite.connect(DB_PATH) as db:
+    """Проверяет, использовал (или забронировал) ли пользователь купон ранее."""
+    async with db_connect() as db:
         cur = await db.execute(
-            "SELECT COUNT(*) FROM coupon_uses WHERE user_id = ? AND coupon_id = ?",
+            "SELECT 1 FROM coupon_uses WHERE user_id = ? AND coupon_id = ? LIMIT 1",
             (user_id, coupon_id)
         )
-        return (await cur.fetchone())[0] > 0
+        return await cur.fetchone() is not None
     
 
 # --- DB Stats Function ---
+# Сделка попадает в статистику с момента оплаты (все статусы после pending_payment)
+PAID_DEAL_STATUSES_SQL = "('paid_waiting_proof', 'pending_proof', 'completed', 'dispute', 'resolved')"
+DAILY_STATS_RECONCILE_DAYS = 2
+
+
+async def rebuild_daily_stats(db, since: Optional[str] = None):
+    """Пересчитывает daily_stats одним проходом GROUP BY (целиком или начиная с дня since)"""
+    since = since or "0000-00-00"
+    await db.execute("DELETE FROM daily_stats WHERE day >= ?", (since,))
+    await db.execute(f"""
+        INSERT INTO daily_stats(day, new_users, robux_paid, rub_paid)
+        SELECT day, SUM(new_users), SUM(robux), SUM(rub) FROM (
+            SELECT date(created_at) AS day, 1 AS new_users, 0 AS robux, 0 AS rub
+            FROM users WHERE created_at >= ?
+            UNION ALL
+            SELECT date(created_at), 0, amount, rub_amount
+            FROM deals WHERE status IN {PAID_DEAL_STATUSES_SQL} AND created_at >= ?
+        )
+        GROUP BY day
+    """, (since, since))
+
+
+@db_timed
+async def reconcile_daily_stats(days: int = DAILY_STATS_RECONCILE_DAYS):
+    """Сверяет последние дни rollup-таблицы с сырыми данными"""
+    async with db_connect() as db:
+        cur = await db.execute("SELECT date('now', ?)", (f"-{days} days",))
+        since = (await cur.fetchone())[0]
+        await rebuild_daily_stats(db, since)
+        await db.commit()
+
+
+@db_timed
 async def get_stats_by_period(days: int):
     """
-    Возвращает статистику за указанный период (в днях).
+    Возвращает статистику за указанный период (в днях, включая сегодня) из daily_stats.
     :return: (new_users, total_robux_purchased, total_rub_turnover)
     """
-    date_from = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM users WHERE created_at >= ?", (date_from,))
-        new_users = (await cur.fetchone())[0]
+    async with db_connect() as db:
+        cur = await db.execute(
+            "SELECT COALESCE(SUM(new_users), 0), COALESCE(SUM(robux_paid), 0), COALESCE(SUM(rub_paid), 0) "
+            "FROM daily_stats WHERE day > date('now', ?)",
+            (f"-{days} days",)
+        )
+        new_users, robux_purchased, rub_turnover = await cur.fetchone()
+        return new_users, robux_purchased, float(rub_turnover)
 
-        cur = await db.execute("SELECT COALESCE(SUM(amount), 0) FROM deals WHERE status IN ('paid_waiting_proof', 'pending_proof', 'completed', 'dispute', 'resolved') AND created_at >= ?", (date_from,))
-        robux_purchased = (await cur.fetchone())[0]
 
-        cur = await db.execute("SELECT COALESCE(SUM(rub_amount), 0) FROM deals WHERE status IN ('paid_waiting_proof', 'pending_proof', 'completed', 'dispute', 'resolved') AND created_at >= ?", (date_from,))
-        rub_turnover = (await cur.fetchone())[0]
+async def daily_stats_loop():
+    """Периодическая сверка daily_stats (страховка от пропущенных инкрементов)"""
+    while True:
+        await asyncio.sleep(3600)
+        try:
+            await reconcile_daily_stats()
+        except Exception as e:
+            logger.error(f"Daily stats reconcile failed: {e}")
+
+
+# --- Аналитика (воронка, продавцы, время завершения) ---
+# Этапы воронки = колонки seller_daily_stats
+FUNNEL_STAGES = ("views", "created", "paid", "proof", "completed")
+
+_analytics_cache: Dict[Tuple[str, int], Tuple[float, Any]] = {}
+_pending_ad_views: Dict[int, int] = {} # seller_id -> просмотры, ещё не записанные в seller_daily_stats
+
+
+async def bump_seller_stats(db, seller_id: int, **deltas):
+    """Инкремент счётчиков продавца за сегодня (внутри уже открытой транзакции)"""
+    cols = [c for c in deltas if c in FUNNEL_STAGES or c == "rub_completed"]
+    await db.execute(
+        f"INSERT INTO seller_daily_stats(day, seller_id, {', '.join(cols)}) "
+        f"VALUES(date('now'), ?, {', '.join('?' for _ in cols)}) "
+        f"ON CONFLICT(day, seller_id) DO UPDATE SET {', '.join(f'{c} = {c} + excluded.{c}' for c in cols)}",
+        (seller_id, *(deltas[c] for c in cols))
+    )
+
+
+def record_ad_view(seller_id: int):
+    """Учитывает просмотр объявления в памяти; в БД пишет flush_ad_views"""
+    _pending_ad_views[seller_id] = _pending_ad_views.get(seller_id, 0) + 1
+
+
+@db_timed
+async def flush_ad_views() -> int:
+    """Пишет накопленные просмотры одной транзакцией; возвращает число продавцов"""
+    views = dict(_pending_ad_views)
+    _pending_ad_views.clear()
+    if not views:
+        return 0
+    try:
+        async with db_connect() as db:
+            for seller_id, count in views.items():
+                await bump_seller_stats(db, seller_id, views=count)
+            await db.commit()
+    except Exception:
+        # Не теряем просмотры: вернём их в буфер до следующей попытки
+        for seller_id, count in views.items():
+            _pending_ad_views[seller_id] = _pending_ad_views.get(seller_id, 0) + count
+        raise
+    return len(views)
+
+
+async def ad_views_flush_loop():
+    """Периодическая запись буфера просмотров (AD_VIEWS_FLUSH_SEC)"""
+    while True:
+        await asyncio.sleep(AD_VIEWS_FLUSH_SEC)
+        try:
+            await flush_ad_views()
+        except Exception as e:
+            logger.error(f"Ad views flush failed: {e}")
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по ближайшему рангу, q - в процентах (0-100)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+@db_timed
+async def get_funnel(days: int) -> Tuple[int, ...]:
+    """(views, created, paid, proof, completed, rub_completed) за последние days дней"""
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"SELECT {', '.join(f'COALESCE(SUM({c}), 0)' for c in FUNNEL_STAGES)}, COALESCE(SUM(rub_completed), 0) "
+            "FROM seller_daily_stats WHERE day > date('now', ?)",
+            (f"-{days} days",)
+        )
+        return await cur.fetchone()
+
+
+@db_timed
+async def get_top_sellers(days: int, limit: int = 10):
+    """[(seller_id, username, created, completed, rub_completed)] по обороту за период"""
+    async with db_connect() as db:
+        cur = await db.execute(
+            "SELECT s.seller_id, u.username, SUM(s.created), SUM(s.completed), SUM(s.rub_completed) "
+            "FROM seller_daily_stats s LEFT JOIN users u ON u.user_id = s.seller_id "
+            "WHERE s.day > date('now', ?) GROUP BY s.seller_id "
+            "ORDER BY SUM(s.rub_completed) DESC, SUM(s.completed) DESC LIMIT ?",
+            (f"-{days} days", limit)
+        )
+        return await cur.fetchall()
+
+
+@db_timed
+async def get_completion_percentiles(days: int) -> Tuple[int, float, float, float]:
+    """(n, p50, p90, p99) времени от создания до завершения сделки, в минутах (только deals, без deals_archive)"""
+    async with db_connect() as db:
+        cur = await db.execute(
+            "SELECT (julianday(completed_at) - julianday(created_at)) * 1440 FROM deals "
+            "WHERE completed_at > datetime('now', ?)",
+            (f"-{days} days",)
+        )
+        minutes = [row[0] for row in await cur.fetchall()]
+    return len(minutes), percentile(minutes, 50), percentile(minutes, 90), percentile(minutes, 99)
+
+
+async def get_analytics(days: int) -> Tuple[Any, Any, Any]:
+    """Воронка, топ продавцов и перцентили с TTL-кэшем (ANALYTICS_CACHE_TTL)"""
+    key = ("analytics", days)
+    hit = _analytics_cache.get(key)
+    if hit and hit[0] > time.monotonic():
+        return hit[1]
+    value = (await get_funnel(days), await get_top_sellers(days), await get_completion_percentiles(days))
+    _analytics_cache[key] = (time.monotonic() + ANALYTICS_CACHE_TTL, value)
+    return value
+
+# --- Ретеншн логов: архив по месяцам + incremental_vacuum ---
+def _append_log_archive(rows: list):
+    """Дописывает строки логов в gzip-архивы LOG_ARCHIVE_DIR/logs-YYYY-MM.jsonl.gz"""
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    by_month: Dict[str, list] = {}
+    for row_id, user_id, action, details, ts, event_type in rows:
+        by_month.setdefault(str(ts)[:7], []).append(json.dumps({
+            "id": row_id, "user_id": user_id, "action": action,
+            "details": details, "timestamp": ts, "event_type": event_type,
+        }, ensure_ascii=False))
+    for month, lines in by_month.items():
+        # gzip допускает дозапись отдельными members - файл читается как один поток
+        with gzip.open(os.path.join(LOG_ARCHIVE_DIR, f"logs-{month}.jsonl.gz"), "at", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+@db_timed
+async def archive_old_logs(days: int = LOG_RETENTION_DAYS, batch: int = LOG_ARCHIVE_BATCH) -> int:
+    """Переносит одну пачку логов старше days дней в архив. Возвращает число перенесённых строк."""
+    if days <= 0:
+        return 0 # Ретеншн выключен
+    async with db_connect() as db:
+        cur = await db.execute(
+            "SELECT id, user_id, action, details, timestamp, event_type FROM logs "
+            "WHERE timestamp < datetime('now', ?) ORDER BY timestamp LIMIT ?",
+            (f"-{days} days", batch)
+        )
+        rows = await cur.fetchall()
+        if not rows:
+            return 0
+        # Сначала архив, потом удаление: при сбое строка может попасть в архив дважды, но не потеряется
+        await asyncio.to_thread(_append_log_archive, rows)
+        ids = [row[0] for row in rows]
+        await db.executemany("DELETE FROM logs WHERE id = ?", [(i,) for i in ids])
+        await db.commit()
+        # execute() делает один шаг прагмы (= одна страница), executescript прогоняет до конца
+        await db.executescript("PRAGMA incremental_vacuum;")
+        return len(rows)
+
+
+async def log_retention_loop():
+    """Фоновый перенос старых логов пачками, чтобы не держать БД заблокированной"""
+    while True:
+        try:
+            moved = 0
+            while True:
+                n = await archive_old_logs()
+                moved += n
+                if n < LOG_ARCHIVE_BATCH:
+                    break
+                await asyncio.sleep(1)
+            if moved:
+                logger.info(f"Archived {moved} log rows older than {LOG_RETENTION_DAYS} days")
+        except Exception as e:
+            logger.error(f"Log retention failed: {e}")
+        await asyncio.sleep(6 * 3600)
+
+
+# --- Архив завершённых сделок ---
+FINISHED_DEAL_STATUSES_SQL = "('completed', 'cancelled', 'resolved')"
+
+
+async def _sync_deals_archive_columns(db) -> list:
+    """Добавляет в deals_archive колонки deals, которых там нет (миграция забыла архив); возвращает колонки deals"""
+    cur = await db.execute("PRAGMA table_info(deals)")
+    deal_cols = [(row[1], row[2]) for row in await cur.fetchall()]
+    cur = await db.execute("PRAGMA table_info(deals_archive)")
+    archive_cols = {row[1] for row in await cur.fetchall()}
+    for name, col_type in deal_cols:
+        if name not in archive_cols:
+            # Без DEFAULT и ограничений: архив хранит уже заполненные строки
+            logger.warning(f"deals_archive lacks column {name}, adding it")
+            await db.execute(f"ALTER TABLE deals_archive ADD COLUMN {name} {col_type}")
+    return [name for name, _ in deal_cols]
+
+
+@db_timed
+async def archive_finished_deals(days: int = DEALS_ARCHIVE_DAYS, batch: int = DEALS_ARCHIVE_BATCH) -> int:
+    """Переносит одну пачку завершённых сделок старше days дней в deals_archive."""
+    if days <= 0:
+        return 0 # Архив выключен
+    async with db_connect() as db:
+        cur = await db.execute(
+            f"SELECT id FROM deals WHERE status IN {FINISHED_DEAL_STATUSES_SQL} "
+            "AND created_at < datetime('now', ?) LIMIT ?",
+            (f"-{days} days", batch)
+        )
+        ids = [row[0] for row in await cur.fetchall()]
+        if not ids:
+            return 0
+        cols = ", ".join(await _sync_deals_archive_columns(db))
+        marks = ", ".join("?" for _ in ids)
+        await db.execute(f"INSERT OR REPLACE INTO deals_archive({cols}) SELECT {cols} FROM deals WHERE id IN ({marks})", ids)
+        await db.execute(f"DELETE FROM deals WHERE id IN ({marks})", ids)
+        await db.commit()
+        await db.executescript("PRAGMA incremental_vacuum;")
+        return len(ids)
+
+
+async def deals_archive_loop():
+    """Фоновый перенос старых завершённых сделок пачками"""
+    while True:
+        try:
+            moved = 0
+            while True:
+                n = await archive_finished_deals()
+                moved += n
+                if n < DEALS_ARCHIVE_BATCH:
+                    break
+                await asyncio.sleep(1)
+            if moved:
+                logger.info(f"Archived {moved} finished deals older than {DEALS_ARCHIVE_DAYS} days")
+        except Exception as e:
+            logger.error(f"Deals archive failed: {e}")
+        await asyncio.sleep(6 * 3600)
+
+
+# --- Резервные копии БД (online backup API) ---
+_backup_lock = asyncio.Lock()
+
+
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _run_backup(target: str) -> str:
+    """Копирует DB_PATH в target через VACUUM INTO; возвращает sha256 снапшота"""
+    tmp = target + ".part"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    # VACUUM INTO читает БД в одной транзакции: снапшот согласован, а в WAL (включается в init_db) обработчики
+    # продолжают писать. Пошаговый backup() перезапускался бы с начала после каждой записи и мог не завершиться.
+    src = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        src.execute("VACUUM INTO ?", (tmp,))
+    finally:
+        src.close()
+    dst = sqlite3.connect(tmp)
+    try:
+        if dst.execute("PRAGMA quick_check").fetchone()[0] != "ok":
+            raise RuntimeError("backup quick_check failed")
+    finally:
+        dst.close()
+    os.replace(tmp, target)
+    digest = _sha256_file(target)
+    with open(target + ".sha256", "w") as f:
+        f.write(f"{digest}  {os.path.basename(target)}\n") # Формат sha256sum -c
+    return digest
+
+
+def _rotate_backups(keep: int = BACKUP_KEEP):
+    snapshots = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("robux_bot-") and f.endswith(".db"))
+    for name in snapshots[:-keep] if keep > 0 else []:
+        for path in (name, name + ".sha256"):
+            try:
+                os.remove(os.path.join(BACKUP_DIR, path))
+            except FileNotFoundError:
+                pass
+
+
+async def make_backup() -> Tuple[str, int, str]:
+    """Делает снапшот БД без остановки бота: (путь, размер в байтах, sha256)"""
+    async with _backup_lock:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        # _backup_lock действует в пределах процесса; pid в имени разводит снапшоты воркеров и фронта
+        target = os.path.join(BACKUP_DIR, f"robux_bot-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.db")
+        started = time.monotonic()
+        digest = await asyncio.to_thread(_run_backup, target)
+        await asyncio.to_thread(_rotate_backups)
+        size = os.path.getsize(target)
+        metrics.observe("bot_backup_seconds", time.monotonic() - started)
+        logger.info(f"💾 DB backup written: {target} ({size} bytes, sha256 {digest[:12]})")
+        return target, size, digest
+
+
+async def backup_loop():
+    """Периодические снапшоты раз в BACKUP_INTERVAL_HOURS"""
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            await make_backup()
+        except Exception as e:
+            logger.error(f"DB backup failed: {e}")
+
 
-        return new_users, robux_purchased, float(rub_turnover)
-        
 # --- YooKassa Webhook Handler ---
 async def handle_yookassa_webhook(request):
     try:
         data = await request.json()
+        if RECORD_UPDATES:
+            record_yookassa_webhook(data)
         if data['event'] == 'payment.succeeded':
             payment_id = data['object']['id']
             metadata = data['object'].get('metadata', {})
@@ -878,25 +2722,16 @@ async def handle_yookassa_success(deal_id: int, yoo_payment: dict):
     ) = deal_row
 
     # Обработка успешно оплаченной сделки
-    if status == 'pending_payment':
+    if status == 'pending_payment' and await mark_deal_paid(deal_id):
 
-        # 1. Обновляем статус
-        await update_deal_status(deal_id, 'paid_waiting_proof')
+        # 1. Статус обновлён (и учтён в daily_stats) в mark_deal_paid
 
-        # 2. Логируем купон (если был)
+        # 2. Бронь купона подтверждена в mark_deal_paid, снимаем его с пользователя
         if coupon_id:
-            await log_coupon_use(coupon_id, buyer_id, deal_id)
             await set_user_active_coupon(buyer_id, None)
 
         # 3. Уведомление продавцу
-        seller_msg = (
-            f"🔔 **Новая P2P сделка! №{deal_id}**\n"
-            f"Покупатель: [User {escape_markdown_v2(str(buyer_id))}](tg://user?id={buyer_id})"
-            f"Вы получите: **{rub_amount:,.2f} ₽**\n"
-            f"Аккаунт получателя: {escape_markdown_v2(roblox_link)}\n"
-            f"Покупатель: [User {buyer_id}](tg://user?id={buyer_id})\n"
-            "**Ожидаем скриншот оплаты от покупателя.**"
-        )
+        seller_msg = MSG_DEAL_PAID_SELLER(deal_id=deal_id, buyer=md_user(buyer_id), rub=rub_amount, roblox_link=roblox_link)
         try:
             await bot.send_message(
                 seller_id,
@@ -908,11 +2743,7 @@ async def handle_yookassa_success(deal_id: int, yoo_payment: dict):
             logger.warning(f"Seller {seller_id} blocked bot.")
 
         # 4. Уведомление покупателю
-        buyer_msg = (
-            f"✅ **Оплата по сделке №{deal_id} прошла успешно!**\n"
-            f"Сумма: **{rub_amount:,.2f} ₽**\n"
-            "**Теперь загрузите скриншот оплаты, чтобы продавец мог выдать Robux.**"
-        )
+        buyer_msg = MSG_DEAL_PAID_BUYER(deal_id=deal_id, rub=rub_amount)
         try:
             await bot.send_message(
                 buyer_id,
@@ -924,14 +2755,10 @@ async def handle_yookassa_success(deal_id: int, yoo_payment: dict):
             logger.warning(f"Buyer {buyer_id} blocked bot.")
 
         # 5. Уведомление админам
-        admin_msg = (
-            f"💳 **Оплачен P2P платёж №{deal_id}**\n"
-            f"Сумма: {rub_amount:,.2f} ₽\n"
-            f"Robux: {amount:,.0f} R\n"
-            f"Продавец: [Seller {seller_id}](tg://user?id={seller_id})\n"
-            f"Покупатель: [Buyer {buyer_id}](tg://user?id={buyer_id})\n"
-            f"Аккаунт: {escape_markdown_v2(roblox_link)}"
-            f"Купон: {coupon_code or 'Нет'}"
+        admin_msg = MSG_DEAL_PAID_ADMIN(
+            deal_id=deal_id, rub=rub_amount, amount=amount,
+            seller=md_user(seller_id, f"Seller {seller_id}"), buyer=md_user(buyer_id, f"Buyer {buyer_id}"),
+            roblox_link=roblox_link, coupon=coupon_code or "Нет"
         )
         for admin in ADMIN_IDS:
             try:
@@ -943,13 +2770,120 @@ async def handle_yookassa_success(deal_id: int, yoo_payment: dict):
         await log_event(buyer_id, "DEAL_PAID", f"Deal: {deal_id}, Rub: {rub_amount}")
 
 
+# --- Telegram Webhook: очередь апдейтов и пул обработчиков ---
+class UpdateIntake:
+    """Ограниченная очередь входящих апдейтов с дедупликацией по update_id."""
+
+    def __init__(self, workers: int = 8, queue_size: int = 1000, dedup_size: int = 10000,
+                 handler: Optional[Callable[[types.Update], Awaitable[Any]]] = None):
+        self.workers = max(1, workers)
+        self.handler = handler # По умолчанию апдейт уходит в dp.feed_update
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dedup_size = dedup_size
+        self.seen: "OrderedDict[int, None]" = OrderedDict()
+        self.tasks: list = []
+
+    def submit(self, update: types.Update) -> bool:
+        """Ставит апдейт в очередь. False - очередь переполнена (Telegram повторит запрос)."""
+        if update.update_id in self.seen:
+            return True # Повторная доставка - уже приняли
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        self.seen[update.update_id] = None
+        if len(self.seen) > self.dedup_size:
+            self.seen.popitem(last=False)
+        return True
+
+    async def _worker(self, bot: Bot):
+        while True:
+            update = await self.queue.get()
+            try:
+                if self.handler:
+                    await self.handler(update)
+                else:
+                    await dp.feed_update(bot, update)
+            except Exception:
+                logger.exception(f"Error while handling update {update.update_id}")
+            finally:
+                self.queue.task_done()
+
+    def start(self, bot: Bot):
+        for _ in range(self.workers):
+            self.tasks.append(asyncio.create_task(self._worker(bot)))
+        logger.info(f"Update intake started: {self.workers} workers, queue {self.queue.maxsize}")
+
+    async def stop(self, timeout: float = 10.0):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Update intake stopped with {self.queue.qsize()} updates in queue")
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
+
+update_intake = UpdateIntake(workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE)
+metrics.gauge("bot_update_queue_size", lambda: update_intake.queue.qsize())
+
+async def handle_telegram_webhook(request):
+    if TG_WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != TG_WEBHOOK_SECRET:
+        return web.Response(status=401)
+    try:
+        data = await request.json()
+        update = types.Update.model_validate(data, context={"bot": bot})
+    except Exception as e:
+        logger.error(f"Bad Telegram update payload: {e}")
+        return web.Response(status=400)
+
+    if not update_intake.submit(update):
+        return web.Response(text="Busy", status=503)
+    return web.Response(text="OK", status=200)
+
+async def fetch_shard_metrics(index: int) -> dict:
+    reader, writer = await asyncio.open_unix_connection(shard_metrics_path(index))
+    try:
+        return json.loads(await reader.read())
+    finally:
+        writer.close()
+
+async def render_metrics() -> str:
+    """Метрики процесса; на фронте шардов - сумма по фронту и всем воркерам (апдейты обрабатывают они)."""
+    if SHARD_WORKERS <= 1 or SHARD_ROLE == "worker":
+        return metrics.render()
+    merged = Metrics()
+    merged.help = metrics.help
+    merged.merge(metrics.snapshot())
+    for index in range(SHARD_WORKERS):
+        try:
+            merged.merge(await asyncio.wait_for(fetch_shard_metrics(index), 2))
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            logger.warning(f"Metrics of shard worker {index} unavailable: {e}")
+    return merged.render()
+
+async def handle_metrics(request):
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "").encode("utf-8")
+        if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}".encode("utf-8")):
+            return web.Response(status=401)
+    elif request.remote not in ("127.0.0.1", "::1"):
+        return web.Response(status=403)
+    return web.Response(text=await render_metrics(), content_type="text/plain", charset="utf-8")
+
 # --- Webhook Server Setup (for aiohttp) ---
+def build_web_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_yookassa_webhook)
+    app.router.add_get("/metrics", handle_metrics)
+    if TG_WEBHOOK_ENABLED:
+        app.router.add_post(TG_WEBHOOK_PATH, handle_telegram_webhook)
+    return app
+
 async def start_webhook_server():
     if not WEBHOOK_HOST:
         return
     
-    app = web.Application()
-    app.router.add_post(WEBHOOK_PATH, handle_yookassa_webhook)
+    app = build_web_app()
     
     runner = web.AppRunner(app)
     await runner.setup()
@@ -960,6 +2894,166 @@ async def start_webhook_server():
     except Exception as e:
         logger.error(f"Failed to start webhook server: {e}")
 
+# --- Массовая отправка сообщений ---
+class BulkResult(NamedTuple):
+    sent: int
+    blocked: int
+    failed: int
+
+async def send_bulk(bot: Bot, messages: list, parse_mode: Optional[str] = "MarkdownV2",
+                    rate: float = BULK_SEND_RATE, progress: Optional[Callable[[int, int], Awaitable[Any]]] = None) -> BulkResult:
+    """Отправляет [(chat_id, text)] не быстрее rate сообщений в секунду.
+    На TelegramRetryAfter ждёт указанное время и повторяет; progress(done, total) - каждые 50 сообщений."""
+    interval = 1 / rate if rate > 0 else 0
+    sent = blocked = failed = 0
+    next_at = time.monotonic()
+    for done, (chat_id, text) in enumerate(messages, 1):
+        for _ in range(3):
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at = max(next_at, time.monotonic()) + interval
+            try:
+                await bot.send_message(chat_id, text, parse_mode=parse_mode)
+                sent += 1
+            except TelegramRetryAfter as e:
+                next_at = time.monotonic() + e.retry_after
+                continue
+            except TelegramForbiddenError:
+                blocked += 1
+            except Exception as e:
+                logger.warning(f"Bulk send to {chat_id} failed: {e}")
+                failed += 1
+            break
+        else:
+            failed += 1
+        if progress and done % 50 == 0:
+            await progress(done, len(messages))
+    return BulkResult(sent, blocked, failed)
+
+# --- Тексты сообщений (MarkdownV2) ---
+MSG_MAIN_MENU = MdTemplate("🏠 **Главное меню**\nВыберите действие:")
+MSG_WITHDRAW_COMPLETED = MdTemplate(
+    "✅ **Ваша заявка на вывод #{order_id} выполнена!**\n"
+    "Сумма: **{amount:,.2f} ₽**\n"
+    "Проверьте свои реквизиты."
+)
+MSG_DEAL_PAID_SELLER = MdTemplate(
+    "🔔 **Новая P2P сделка! №{deal_id}**\n"
+    "Покупатель: {buyer}\n"
+    "Вы получите: **{rub:,.2f} ₽**\n"
+    "Аккаунт получателя: {roblox_link}\n"
+    "**Ожидаем скриншот оплаты от покупателя.**"
+)
+MSG_DEAL_PAID_BUYER = MdTemplate(
+    "✅ **Оплата по сделке №{deal_id} прошла успешно!**\n"
+    "Сумма: **{rub:,.2f} ₽**\n"
+    "**Теперь загрузите скриншот оплаты, чтобы продавец мог выдать Robux.**"
+)
+MSG_DEAL_PAID_ADMIN = MdTemplate(
+    "💳 **Оплачен P2P платёж №{deal_id}**\n"
+    "Сумма: {rub:,.2f} ₽\n"
+    "Robux: {amount:,.0f} R\n"
+    "Продавец: {seller}\n"
+    "Покупатель: {buyer}\n"
+    "Аккаунт: {roblox_link}\n"
+    "Купон: {coupon}"
+)
+MSG_DEAL_PAYMENT = MdTemplate(
+    "**Оплата сделки P2P №{deal_id}**\n"
+    "Сумма: **{rub:,.2f} ₽**\n"
+    "Нажмите на кнопку ниже, чтобы перейти к оплате. У вас есть {minutes} минут."
+)
+MSG_DEAL_CHECK_PAID = MdTemplate(
+    "✅ **Сделка P2P №{deal_id} оплачена!**\n"
+    "Ожидайте выдачи робуксов продавцом. Вам нужно загрузить скриншот оплаты."
+)
+MSG_DEAL_CHECK_FAILED = MdTemplate(
+    "❌ Платеж по сделке №{deal_id} имеет статус: **{status}**\n"
+    "Попробуйте создать новую сделку."
+)
+MSG_PROOF_REQUEST = MdTemplate(
+    "📸 **Загрузка скриншота оплаты по сделке #{deal_id}**\n\n"
+    "Отправьте мне **одним сообщением** скриншот (фото) или документ, подтверждающий оплату."
+)
+MSG_PROOF_UPLOADED_BUYER = MdTemplate(
+    "✅ **Скриншот по сделке #{deal_id} загружен!**\n\n"
+    "Продавец уведомлен. Ожидайте выдачи Robux."
+)
+MSG_PROOF_UPLOADED_SELLER = MdTemplate(
+    "🔔 **Покупатель загрузил скриншот!**\n"
+    "Сделка P2P №{deal_id} (Покупатель: {buyer})\n"
+    "Аккаунт: {roblox_link}\n\n"
+    "**Ваше действие:** Проверьте оплату и выдайте Robux."
+)
+MSG_DEAL_COMPLETED_SELLER = MdTemplate("✅ **Сделка #{deal_id} успешно завершена!**\nСпасибо за работу.")
+MSG_DEAL_COMPLETED_BUYER = MdTemplate(
+    "✅ **Сделка P2P №{deal_id} завершена!**\n"
+    "Продавец подтвердил выдачу Robux.\n\n"
+    "Пожалуйста, **оставьте отзыв** о продавце, нажав на кнопку ниже."
+)
+MSG_DEAL_COMPLETED_ADMIN = MdTemplate("🎉 **Сделка #{deal_id} (P2P) завершена!** Продавец {seller} подтвердил выдачу.")
+MSG_STATS_PERIOD = MdTemplate(
+    "📊 **Статистика за последние {days} дней**\n"
+    "───────────────────────────\n"
+    "👤 Новых пользователей: **{new_users:,}**\n"
+    "📦 Robux куплено: **{robux:,.0f} R**\n"
+    "💰 Оборот (RUB): **{rub:,.2f} ₽**"
+)
+MSG_PROFILE = MdTemplate(
+    "👤 **Ваш профиль**\n"
+    "Баланс: **{balance:,.2f} ₽**\n"
+    "ID: `{uid}`\n"
+    "Рефералы: **{referral_count}**\n"
+    "Реф. заработок: **{referral_earned:,.2f} ₽**"
+)
+MSG_WITHDRAW_TOO_LOW = MdTemplate(
+    "❌ **Вывод средств**\n\n"
+    "Минимальная сумма вывода: **{min_withdraw:,.2f} ₽**\n"
+    "Ваш баланс: **{balance:,.2f} ₽**\n\n"
+    "Недостаточно средств."
+)
+MSG_WITHDRAW_START = MdTemplate(
+    "💸 **Вывод средств**\n\n"
+    "Ваш баланс: **{balance:,.2f} ₽**\n"
+    "Введите сумму в рублях для вывода (мин. {min_withdraw:,.2f} ₽):"
+)
+MSG_WITHDRAW_NOT_ENOUGH = MdTemplate("Недостаточно средств. Ваш баланс: {balance:,.2f} ₽")
+MSG_WITHDRAW_MIN = MdTemplate("Минимальная сумма вывода: {min_withdraw:,.2f} ₽")
+MSG_WITHDRAW_AMOUNT = MdTemplate("Сумма: **{amount:,.2f} ₽**\n\nВыберите способ вывода:")
+MSG_WITHDRAW_DETAILS = MdTemplate("Введите номер телефона или реквизиты для выбранного метода вывода (например, `+79991234567`):")
+MSG_WITHDRAW_INSUFFICIENT = MdTemplate(
+    "❌ **Ошибка вывода**\n"
+    "Ваш актуальный баланс: **{balance:,.2f} ₽**\n"
+    "Вы пытаетесь вывести: **{amount:,.2f} ₽**\n"
+    "Недостаточно средств."
+)
+MSG_WITHDRAW_ACCEPTED = MdTemplate(
+    "✅ **Заявка на вывод принята!**\n"
+    "Сумма: **{amount:,.2f} ₽**\n"
+    "Ваш новый баланс: **{new_balance:,.2f} ₽**\n"
+    "Ожидайте обработки администратором."
+)
+MSG_WITHDRAW_ADMIN = MdTemplate(
+    "🔔 **Новый вывод средств ожидает обработки!**\n"
+    "ID заявки: `#{order_id}`\n"
+    "Пользователь: {user}\n"
+    "Сумма: **{amount:,.2f} ₽**\n"
+    "Метод: {method}\n"
+    "Реквизиты: {requisites}"
+)
+MSG_SELLER_PROFILE = MdTemplate(
+    "👤 **Ваша анкета продавца**\n"
+    "───────────────────────────\n"
+    "Username: {username}\n"
+    "ID: `{uid}`\n"
+    "⭐ Рейтинг: {rating} из 5\n"
+    "📝 Всего отзывов: **{review_count}**\n"
+    "📦 Всего завершенных продаж: **{sales_count}**\n"
+    "💰 Общий заработок (RUB): **{sales_rub:,.2f} ₽**"
+)
+
+
 # --- Handlers ---
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
@@ -995,11 +3089,19 @@ async def cmd_start(message: types.Message, command: CommandObject, state: FSMCo
             except ValueError: pass
 
     is_new = await create_user_if_not_exists(message.from_user, referrer_id)
-    
-    # (Логика рефералов остается тут...)
+
+    # Бонус уже начислен в create_user_if_not_exists - только уведомляем реферера
     if is_new and referrer_id:
-        # ... ваш код начисления бонуса ...
-        pass
+        bonus_esc = escape_markdown_v2(f"{REFERRAL_BONUS_RUB:,.2f}")
+        try:
+            await bot.send_message(
+                referrer_id,
+                f"🤝 По вашей ссылке зарегистрировался новый пользователь\\!\n"
+                f"На баланс начислено *{bonus_esc} ₽*",
+                parse_mode="MarkdownV2"
+            )
+        except Exception:
+            pass
 
     # Если пользователь вернулся после оплаты:
     if deal_check_id:
@@ -1016,7 +3118,7 @@ async def cmd_start(message: types.Message, command: CommandObject, state: FSMCo
                  await message.answer(
                      f"🔎 **Проверка сделки \\#{deal_check_id}**",
                      reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="🔄 Проверить статус оплаты", callback_data=f"deal_check_payment:{deal_check_id}:{payment_id}")]
+                        [InlineKeyboardButton(text="🔄 Проверить статус оплаты", callback_data=DealCheckPaymentCb(deal_id=deal_check_id, payment_id=payment_id).pack())]
                      ]),
                      parse_mode="MarkdownV2"
                  )
@@ -1038,17 +3140,17 @@ async def cmd_start(message: types.Message, command: CommandObject, state: FSMCo
 async def cmd_menu(message: types.Message, state: FSMContext):
     await state.clear()
     uid = message.from_user.id
-    await message.answer("🏠 **Главное меню**\nВыберите действие:", reply_markup=main_menu_kb(is_admin(uid)), parse_mode="MarkdownV2")
+    await message.answer(MSG_MAIN_MENU(), reply_markup=main_menu_kb(is_admin(uid)), parse_mode="MarkdownV2")
 
-@dp.callback_query(F.data == "back_main")
-@dp.callback_query(F.data == "menu")
+@cb_router.route("back_main")
+@cb_router.route("menu")
 async def back_main_handler(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
     uid = call.from_user.id
     await call.answer()
     try:
         await call.message.edit_text(
-            "🏠 **Главное меню**\nВыберите действие:",
+            MSG_MAIN_MENU(),
             reply_markup=main_menu_kb(is_admin(uid)),
             parse_mode="MarkdownV2"
         )
@@ -1056,7 +3158,10 @@ async def back_main_handler(call: types.CallbackQuery, state: FSMContext):
         pass # Сообщение не изменилось
 
 # --- Main Menu Handlers ---
-@dp.callback_query(lambda c: c.data and c.data.startswith("menu_"))
+@cb_router.route("menu_buy")
+@cb_router.route("menu_sell")
+@cb_router.route("menu_profile")
+@cb_router.route("menu_admin")
 async def menu_handlers(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
     uid = call.from_user.id
@@ -1093,17 +3198,12 @@ async def menu_handlers(call: types.CallbackQuery, state: FSMContext):
         return
 
     if action == "profile":
-        bal = await get_user_balance(uid)
-        ref_count, ref_earned = await get_referral_stats(uid)
-        
-        text = (
-            f"👤 **Ваш профиль**\n"
-            f"Баланс: **{bal:,.2f} ₽**\n"
-            f"ID: `{uid}`\n"
-            f"Рефералы: **{ref_count}**\n"
-            f"Реф\\. заработок: **{ref_earned:,.2f} ₽**"
+        snap = await get_profile_snapshot(uid)
+
+        text = MSG_PROFILE(
+            balance=snap.balance, uid=uid, referral_count=snap.referral_count, referral_earned=snap.referral_earned
         )
-        await call.message.edit_text(text, reply_markup=profile_kb(uid), parse_mode="MarkdownV2")
+        await call.message.edit_text(text, reply_markup=profile_kb(), parse_mode="MarkdownV2")
         await call.answer()
         return
 
@@ -1114,7 +3214,7 @@ async def menu_handlers(call: types.CallbackQuery, state: FSMContext):
             await call.answer("Доступ запрещен\\.", show_alert=True)
         return
 
-@dp.callback_query(F.data == "support")
+@cb_router.route("support")
 async def support_handler(callback: types.CallbackQuery, bot: Bot):
     await callback.answer()
     if not SUPPORT_ADMIN_ID:
@@ -1125,23 +3225,23 @@ async def support_handler(callback: types.CallbackQuery, bot: Bot):
         f"Для связи с администратором, пожалуйста, перейдите по ссылке: "
         f"[Поддержка](tg://user?id={SUPPORT_ADMIN_ID})\n"
         f"Ваш ID будет автоматически передан администратору\\.",
-        reply_markup=back_main_kb(is_admin(callback.from_user.id)),
+        reply_markup=back_main_kb(),
         parse_mode="MarkdownV2"
     )
 
 # --- Profile Handlers ---
-@dp.callback_query(F.data == "profile_referral")
+@cb_router.route("profile_referral")
 async def profile_referral_cb(call: types.CallbackQuery):
     await call.answer()
     uid = call.from_user.id
     
-    ref_count, ref_earned = await get_referral_stats(uid)
+    snap = await get_profile_snapshot(uid)
     
     bot_username = os.getenv('BOT_USERNAME', 'MyBot')
     ref_link = f"https://t.me/{bot_username}?start=ref_{uid}"
     
     ref_link_esc = escape_markdown_v2(ref_link)
-    ref_earned_esc = escape_markdown_v2(f"{ref_earned:,.2f}")
+    ref_earned_esc = escape_markdown_v2(f"{snap.referral_earned:,.2f}")
     bonus_esc = escape_markdown_v2(f"{REFERRAL_BONUS_RUB}")
     
     text = (
@@ -1149,7 +3249,7 @@ async def profile_referral_cb(call: types.CallbackQuery):
         f"Приглашайте друзей и получайте **{bonus_esc} ₽** на баланс "
         f"за каждого нового пользователя\\!\n\n"
         f"📊 **Ваша статистика:**\n"
-        f"👥 Приглашено людей: **{ref_count}**\n"
+        f"👥 Приглашено людей: **{snap.referral_count}**\n"
         f"💰 Всего заработано: **{ref_earned_esc} ₽**\n\n"
         f"🔗 **Ваша ссылка для приглашения:**\n"
         f"`{ref_link_esc}`"
@@ -1169,94 +3269,112 @@ def format_number(n):
     except:
         return str(n)
 
-def status_icon(event_type):
-    if event_type in ["BUY_ROBUX", "REFILL_BALANCE", "REFERRAL_BONUS"]:
-        return "🟢"
-    if event_type == "WITHDRAW_RUB":
-        return "🟡"
-    return "🔴"
-
-async def inline_profile_menu(user_id: int):
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="menu_profile")]
-    ])
-
-async def get_latest_transactions(user_id: int, limit: int = 10):
-    async with aiosqlite.connect(DB_PATH) as db:
-        query = """
-            SELECT event_type, details, timestamp 
-            FROM logs 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        """
-        cursor = await db.execute(query, (user_id, limit))
-        return await cursor.fetchall()
-
-@dp.callback_query(F.data == "profile_tx")
-async def profile_tx_cb(call: types.CallbackQuery):
-    await call.answer("Загрузка ваших транзакций\\.\\.\\.", show_alert=False)
-    uid = call.from_user.id
-
-    transactions = await get_latest_transactions(uid, limit=10)
-
-    text = ["**💳 Ваши последние транзакции**\n"]
-
-    if not transactions:
-        text.append("У вас пока нет транзакций\\.")
-    else:
-        for event_type, details, created_at in transactions:
-
-            readable_details = {}
-            if details:
-                try:
-                    readable_details = json.loads(details) 
-                except:
-                    readable_details = {"raw": details}
-
-            try:
-                tx_date = datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S").strftime("%d\\.%m\\.%Y %H:%M")
-            except ValueError:
-                tx_date = escape_markdown_v2(created_at)
-            
-            tx_date_esc = escape_markdown_v2(tx_date)
-            icon = status_icon(event_type)
-            line = f"{icon} \\-\\- {tx_date_esc}: "
-
-            if event_type == "BUY_ROBUX":
-                amount = escape_markdown_v2(format_number(readable_details.get("robux_amount", "N/A")))
-                price = escape_markdown_v2(format_number(readable_details.get("rub_price", "N/A")))
-                line += f"**ПОКУПКА R**: {amount} R за {price} ₽"
-
-            elif event_type == "WITHDRAW_RUB":
-                amount = escape_markdown_v2(format_number(readable_details.get("rub_amount", "N/A")))
-                line += f"**ВЫВОД RUB**: \\-{amount} ₽"
-
-            elif event_type == "REFILL_BALANCE":
-                amount = escape_markdown_v2(format_number(readable_details.get("rub_amount", "N/A")))
-                line += f"**ПОПОЛНЕНИЕ БАЛАНСА**: \\+{amount} ₽"
-
-            elif event_type == "REFERRAL_BONUS":
-                bonus = escape_markdown_v2(format_number(readable_details.get("bonus_amount", "N/A")))
-                ref_user = readable_details.get("ref_user_id", "N/A")
-                line += f"**РЕФЕРАЛ БОНУС**: \\+{bonus} ₽ \\(от {ref_user}\\)"
+def status_icon(amount_kopecks: int):
+    return "🟢" if amount_kopecks > 0 else "🔴"
+
+@db_timed
+async def get_transactions_page(user_id: int, cursor: Optional[Tuple[str, int]] = None, older: bool = True,
+                                limit: int = HISTORY_PAGE_SIZE):
+    """Keyset-страница операций: rows (id, kind, amount_kopecks, counterparty, deal_id, order_id, created_at)."""
+    async with db_connect() as db:
+        return await fetch_keyset_page(
+            db, "transactions", "id, kind, amount_kopecks, counterparty, deal_id, order_id, created_at",
+            "user_id = ?", (user_id,), cursor, older, limit
+        )
 
-            else:
-                details_esc = escape_markdown_v2(str(readable_details.get("raw", details)))
-                line += f"{escape_markdown_v2(event_type)}: {details_esc}"
+def tx_history_lines(rows) -> list:
+    lines = []
+    for _, kind, amount_kopecks, counterparty, deal_id, order_id, created_at in rows:
+        sign = "+" if amount_kopecks > 0 else "-"
+        line = (
+            f"{status_icon(amount_kopecks)} {escape_markdown_v2(format_date(created_at))}: "
+            f"*{escape_markdown_v2(TX_KINDS.get(kind, kind))}*: "
+            f"{escape_markdown_v2(f'{sign}{abs(amount_kopecks) / 100:,.2f}')} ₽"
+        )
+        if deal_id:
+            line += f" \\(сделка \\#{deal_id}\\)"
+        elif order_id:
+            line += f" \\(заявка \\#{order_id}\\)"
+        lines.append(line)
+    return lines
+
+def buy_history_lines(rows) -> list:
+    lines = []
+    for d_id, amount, rub_amount, status, buyer_id, seller_id, created_at in rows:
+        lines.append(
+            f"*Сделка \\#{d_id}* {escape_markdown_v2(f'({format_date(created_at)})')}\n"
+            f"{escape_markdown_v2(f'{amount:,.0f} R за {rub_amount:,.2f} ₽ | {status}')}"
+        )
+    return lines
+
+def sell_history_lines(rows) -> list:
+    lines = []
+    for d_id, amount, rub_amount, status, buyer_id, seller_id, created_at in rows:
+        lines.append(
+            f"*Сделка \\#{d_id}* {escape_markdown_v2(f'({format_date(created_at)})')}\n"
+            f"Продано: *{escape_markdown_v2(f'{amount:,.0f}')} R* \\| Заработок: *{escape_markdown_v2(f'{rub_amount:,.2f}')} ₽*\n"
+            f"Покупатель: [User {buyer_id}](tg://user?id={buyer_id})"
+        )
+    return lines
+
+# kind -> (заголовок, загрузка страницы, рендер строк, текст "пусто", callback кнопки "Назад")
+HISTORY_SCREENS = {
+    "tx": ("💳 Ваши транзакции",
+           get_transactions_page,
+           tx_history_lines, "У вас пока нет транзакций", "menu_profile"),
+    "buy": ("🛒 Ваши покупки (P2P)",
+            lambda uid, cursor, older: get_deals_by_user(uid, False, cursor=cursor, older=older),
+            buy_history_lines, "У вас пока нет покупок", "menu_profile"),
+    "sell": ("📜 Ваша история продаж (P2P)",
+             lambda uid, cursor, older: get_deals_by_user(uid, True, cursor=cursor, older=older, status='completed'),
+             sell_history_lines, "У вас пока нет продаж", "menu_sell"),
+}
+
+def history_page_cb_data(kind: str, row, older: bool) -> str:
+    created_at, row_id = keyset_cursor(row)
+    return HistoryPageCb(kind=kind, at=pack_keyset_at(created_at), anchor=row_id, older=older).pack()
+
+def history_nav_kb(kind: str, rows, has_older: bool, has_newer: bool, back_cb: str):
+    kb = InlineKeyboardBuilder()
+    nav = []
+    if rows and has_newer:
+        nav.append(InlineKeyboardButton(text="◀️ Новее", callback_data=history_page_cb_data(kind, rows[0], False)))
+    if rows and has_older:
+        nav.append(InlineKeyboardButton(text="Старее ▶️", callback_data=history_page_cb_data(kind, rows[-1], True)))
+    if nav:
+        kb.row(*nav)
+    kb.row(InlineKeyboardButton(text="◀️ Назад", callback_data=back_cb))
+    return kb.as_markup()
 
-            text.append(line)
+async def show_history(call: types.CallbackQuery, kind: str, cursor: Optional[Tuple[str, int]] = None, older: bool = True):
+    """Отрисовывает страницу истории (транзакции / покупки / продажи) с кнопками Новее/Старее."""
+    title, fetch_page, render, empty_text, back_cb = HISTORY_SCREENS[kind]
+    rows, has_older, has_newer = await fetch_page(call.from_user.id, cursor, older)
 
-    kb = inline_profile_menu(uid)
+    text = [f"*{escape_markdown_v2(title)}*\n"]
+    text += render(rows) if rows else [f"{escape_markdown_v2(empty_text)}\\."]
 
     await call.message.edit_text(
         "\n".join(text),
-        reply_markup=kb,
+        reply_markup=history_nav_kb(kind, rows, has_older, has_newer, back_cb),
         parse_mode="MarkdownV2"
     )
 
+@cb_router.route("profile_tx")
+async def profile_tx_cb(call: types.CallbackQuery):
+    await call.answer("Загрузка ваших транзакций...", show_alert=False)
+    await show_history(call, "tx")
+
+@cb_router.route(HistoryPageCb)
+async def history_page_cb(call: types.CallbackQuery, callback_data: HistoryPageCb):
+    if callback_data.kind not in HISTORY_SCREENS:
+        return await call.answer("Некорректные данные.")
+    await call.answer()
+    cursor = (unpack_keyset_at(callback_data.at), callback_data.anchor) if callback_data.at else None
+    await show_history(call, callback_data.kind, cursor, callback_data.older)
+
 # --- Withdraw Flow ---
-@dp.callback_query(F.data == "profile_withdraw")
+@cb_router.route("profile_withdraw")
 async def withdraw_start(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
     uid = call.from_user.id
@@ -1266,20 +3384,15 @@ async def withdraw_start(call: types.CallbackQuery, state: FSMContext):
 
     if balance < min_withdraw:
         return await call.message.edit_text(
-            f"❌ **Вывод средств**\n\n"
-            f"Минимальная сумма вывода: **{min_withdraw:,.2f} ₽**\n"
-            f"Ваш баланс: **{balance:,.2f} ₽**\n\n"
-            f"Недостаточно средств\\.",
-            reply_markup=profile_kb(uid),
-           parse_mode="MarkdownV2"
+            MSG_WITHDRAW_TOO_LOW(min_withdraw=min_withdraw, balance=balance),
+            reply_markup=profile_kb(),
+            parse_mode="MarkdownV2"
         )
     
     await state.update_data(balance=balance, min_withdraw=min_withdraw)
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_main")]])
+    kb = cancel_kb("back_main")
     await call.message.edit_text(
-        f"💸 **Вывод средств**\n\n"
-        f"Ваш баланс: **{balance:,.2f} ₽**\n"
-        f"Введите сумму в рублях для вывода \\(мин\\. {min_withdraw:,.2f} ₽\\):",
+        MSG_WITHDRAW_START(balance=balance, min_withdraw=min_withdraw),
         reply_markup=kb,
         parse_mode="MarkdownV2"
     )
@@ -1297,42 +3410,40 @@ async def withdraw_amount_rub(message: types.Message, state: FSMContext):
         if amount <= 0:
             raise ValueError
     except ValueError:
-        return await message.reply("Некорректное значение\\. Введите положительное число\\.")
+        return await message.reply("Некорректное значение. Введите положительное число.")
     
     if amount > balance:
-        return await message.reply(f"Недостаточно средств\\. Ваш баланс: {balance:,.2f} ₽", parse_mode="MarkdownV2")
+        return await message.reply(MSG_WITHDRAW_NOT_ENOUGH(balance=balance), parse_mode="MarkdownV2")
 
     if amount < min_withdraw:
-        return await message.reply(f"Минимальная сумма вывода: {min_withdraw:,.2f} ₽", parse_mode="MarkdownV2")
+        return await message.reply(MSG_WITHDRAW_MIN(min_withdraw=min_withdraw), parse_mode="MarkdownV2")
 
     await state.update_data(amount=amount)
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="СБП \\(Сбер, Тинькофф и т\\.\\.д\\.\\)", callback_data="withdraw_method:sbp")],
-        [InlineKeyboardButton(text="Qiwi/ЮMoney", callback_data="withdraw_method:other")],
+        [InlineKeyboardButton(text="СБП (Сбер, Тинькофф и т.д.)", callback_data=WithdrawMethodCb(method="sbp").pack())],
+        [InlineKeyboardButton(text="Qiwi/ЮMoney", callback_data=WithdrawMethodCb(method="other").pack())],
         [InlineKeyboardButton(text="❌ Отмена", callback_data="back_main")]
     ])
     
-    await message.reply(f"Сумма: **{amount:,.2f} ₽**\n\nВыберите способ вывода:", reply_markup=kb, parse_mode="MarkdownV2")
+    await message.reply(MSG_WITHDRAW_AMOUNT(amount=amount), reply_markup=kb, parse_mode="MarkdownV2")
     await state.set_state(WithdrawStates.method)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("withdraw_method:"), WithdrawStates.method)
-async def withdraw_method_cb(call: types.CallbackQuery, state: FSMContext):
+@cb_router.route(WithdrawMethodCb, state=WithdrawStates.method)
+async def withdraw_method_cb(call: types.CallbackQuery, callback_data: WithdrawMethodCb, state: FSMContext):
     await call.answer()
-    method = call.data.split(":")[1]
+    method = callback_data.method
     await state.update_data(method=method)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_main")]])
-    prompt = "Введите номер телефона или реквизиты для выбранного метода вывода \\(например, `\\+79991234567`\\):"
-    
-    await call.message.edit_text(prompt, reply_markup=kb, parse_mode="MarkdownV2")
+    kb = cancel_kb("back_main")
+    await call.message.edit_text(MSG_WITHDRAW_DETAILS(), reply_markup=kb, parse_mode="MarkdownV2")
     await state.set_state(WithdrawStates.details)
 
 @dp.message(WithdrawStates.details)
 async def withdraw_details(message: types.Message, state: FSMContext, bot: Bot):
     uid = message.from_user.id
-    # Экранируем ввод пользователя, чтобы не сломать Markdown
-    details = escape_markdown_v2(message.text.strip())
+    # Реквизиты храним как ввёл пользователь; экранируются при выводе
+    requisites = message.text.strip()
     
     data = await state.get_data()
     # Берем из FSM только сумму и метод. Баланс из FSM брать НЕЛЬЗЯ (он мог устареть).
@@ -1343,10 +3454,11 @@ async def withdraw_details(message: types.Message, state: FSMContext, bot: Bot):
         await state.clear()
         return await message.reply("❌ Ошибка сессии. Попробуйте начать вывод заново.")
 
-    async with aiosqlite.connect(DB_PATH) as db:
-        # 1. Получаем АКТУАЛЬНЫЙ баланс из БД прямо сейчас
-        async with db.execute("SELECT balance FROM users WHERE user_id = ?", (uid,)) as cursor:
-            row = await cursor.fetchone()
+    async with db_connect() as db:
+        # 1. Получаем АКТУАЛЬНЫЙ баланс из БД прямо сейчас, сразу с блокировкой записи (два вывода не спишут один баланс)
+        await db.execute("BEGIN IMMEDIATE")
+        cursor = await db.execute("SELECT balance FROM users WHERE user_id = ?", (uid,))
+        row = await cursor.fetchone()
             
         if not row:
             await state.clear()
@@ -1358,10 +3470,7 @@ async def withdraw_details(message: types.Message, state: FSMContext, bot: Bot):
         if current_real_balance < amount:
             await state.clear()
             return await message.reply(
-                f"❌ **Ошибка вывода**\n"
-                f"Ваш актуальный баланс: **{current_real_balance:,.2f} ₽**\n"
-                f"Вы пытаетесь вывести: **{amount:,.2f} ₽**\n"
-                f"Недостаточно средств.",
+                MSG_WITHDRAW_INSUFFICIENT(balance=current_real_balance, amount=amount),
                 parse_mode="MarkdownV2"
             )
 
@@ -1373,10 +3482,11 @@ async def withdraw_details(message: types.Message, state: FSMContext, bot: Bot):
             await db.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, uid))
             
             cursor = await db.execute(
-                "INSERT INTO orders(user_id, type, amount, price, status, details, provider) VALUES(?,?,?,?,?,?,?)",
-                (uid, 'withdraw_rub', int(amount * 100), amount, 'pending', f"Method: {method}, Details: {details}", 'withdraw')
+                "INSERT INTO orders(user_id, type, amount, price, status, method, requisites_enc, provider) VALUES(?,?,?,?,?,?,?,?)",
+                (uid, 'withdraw_rub', int(amount * 100), amount, 'pending', method, encrypt_requisites(requisites), 'withdraw')
             )
             order_id = cursor.lastrowid
+            await add_transaction(db, uid, "withdraw", -amount, order_id=order_id)
             
             # Фиксируем изменения
             await db.commit()
@@ -1390,22 +3500,14 @@ async def withdraw_details(message: types.Message, state: FSMContext, bot: Bot):
     await log_event(uid, "WITHDRAW_REQUEST", f"Order: {order_id}, Amount: {amount:.2f}")
     
     await message.reply(
-        f"✅ **Заявка на вывод принята!**\n"
-        f"Сумма: **{amount:,.2f} ₽**\n"
-        f"Ваш новый баланс: **{new_balance:,.2f} ₽**\n"
-        "Ожидайте обработки администратором.",
-        reply_markup=profile_kb(uid),
+        MSG_WITHDRAW_ACCEPTED(amount=amount, new_balance=new_balance),
+        reply_markup=profile_kb(),
         parse_mode="MarkdownV2"
     )
     
     # Уведомление администраторов
-    admin_msg = (
-        f"🔔 **Новый вывод средств ожидает обработки!**\n"
-        f"ID заявки: `#{order_id}`\n"
-        f"Пользователь: [User {uid}](tg://user?id={uid})\n"
-        f"Сумма: **{amount:,.2f} ₽**\n"
-        f"Метод: `{method.upper()}`\n"
-        f"Реквизиты: `{details}`"
+    admin_msg = MSG_WITHDRAW_ADMIN(
+        order_id=order_id, user=md_user(uid), amount=amount, method=md_code(method.upper()), requisites=md_code(requisites)
     )
     
     for admin in ADMIN_IDS:
@@ -1417,109 +3519,196 @@ async def withdraw_details(message: types.Message, state: FSMContext, bot: Bot):
     await state.clear()
 
 # --- Admin Handlers ---
-@dp.callback_query(F.data == "back_admin")
+@cb_router.route("back_admin")
 async def back_admin_cb(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer()
     await call.message.edit_text("🛠 Админ-панель", reply_markup=admin_main_kb())
 
-# --- Admin Disputes/Deals ---
-@dp.callback_query(F.data == "adm_deals_dispute")
-async def adm_deals_dispute_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id): 
-        return await call.answer("Доступ запрещён.", show_alert=True)
-    
-    await call.answer("Загрузка споров...")
+@dp.message(Command("backup"))
+async def cmd_backup(message: types.Message):
+    """Ручной снапшот БД (только для админов)."""
+    if not is_admin(message.from_user.id): return
+    await message.answer("⏳ Создаю резервную копию БД...")
+    try:
+        path, size, digest = await make_backup()
+    except Exception as e:
+        logger.error(f"Manual backup failed: {e}")
+        return await message.answer(f"❌ Ошибка резервного копирования: {e}")
+    await message.answer(
+        f"💾 Резервная копия готова\n"
+        f"Файл: {os.path.basename(path)}\n"
+        f"Размер: {size / 1024:,.1f} КБ\n"
+        f"SHA-256: {digest}"
+    )
+
+@dp.message(Command("referrals"))
+async def cmd_referrals(message: types.Message, command: CommandObject):
+    """Отчёт по реферальному дереву пользователя: /referrals <user_id> [глубина]."""
+    if not is_admin(message.from_user.id): return
+    args = (command.args or "").split()
+    if not args or not all(a.isdigit() for a in args[:2]):
+        return await message.answer("Использование: /referrals <user_id> [глубина]")
+    root_id = int(args[0])
+    depth = max(1, min(int(args[1]), REFERRAL_TREE_DEPTH_MAX)) if len(args) > 1 else REFERRAL_TREE_DEPTH
+    report = await get_referral_report(root_id, depth)
+    if not report:
+        return await message.answer(f"У пользователя {root_id} нет рефералов.")
+    lines = [f"🌳 Рефералы пользователя {root_id} (до {depth} ур.)", ""]
+    for level, users, payers, turnover in report:
+        lines.append(f"Ур. {level}: {users} польз., покупали {payers}, оборот {turnover:,.2f} ₽")
+    lines.append("")
+    lines.append(f"Всего: {sum(r[1] for r in report)} польз., оборот {sum(r[3] for r in report):,.2f} ₽")
+    await message.answer("\n".join(lines))
 
-    disputes = await get_dispute_deals()
-    text = ["**📦 Споры по P2P Сделкам**\n"]
+# --- Admin Disputes/Deals ---
+def dispute_queue_kb(cases, has_prev: bool, has_next: bool, flt: DisputeQueueCb):
     kb = InlineKeyboardBuilder()
+    for case in cases:
+        lock = "🔒 " if case.assignee_id else ""
+        kb.row(InlineKeyboardButton(text=f"{lock}🔍 Спор #{case.deal_id} · {case.rub_amount:,.0f} ₽",
+                                    callback_data=AdmViewDisputeCb(deal_id=case.deal_id).pack()))
+    nav = []
+    if cases and has_prev:
+        nav.append(InlineKeyboardButton(text="◀️ Раньше", callback_data=flt.model_copy(
+            update={"anchor": cases[0].deal_id, "forward": False}).pack()))
+    if cases and has_next:
+        nav.append(InlineKeyboardButton(text="Дальше ▶️", callback_data=flt.model_copy(
+            update={"anchor": cases[-1].deal_id, "forward": True}).pack()))
+    if nav:
+        kb.row(*nav)
+    first = flt.model_copy(update={"anchor": 0, "forward": True})
+    kb.row(
+        InlineKeyboardButton(text=f"{'✅' if flt.mine else '👤'} Мои",
+                             callback_data=first.model_copy(update={"mine": not flt.mine}).pack()),
+        InlineKeyboardButton(text=f"{'✅' if flt.min_rub else '💰'} от {DISPUTE_BIG_RUB} ₽",
+                             callback_data=first.model_copy(update={"min_rub": 0 if flt.min_rub else DISPUTE_BIG_RUB}).pack()),
+    )
+    if flt.mine or flt.min_rub or flt.seller_id:
+        kb.row(InlineKeyboardButton(text="♻️ Сбросить фильтры", callback_data=DisputeQueueCb().pack()))
+    kb.row(InlineKeyboardButton(text="◀️ Назад в Админ-панель", callback_data="back_admin"))
+    return kb.as_markup()
 
-    if not disputes:
-        # FIXED: Added backslash before the dot
-        text.append("Активных споров нет\\.") 
-    else:
-        for deal_id, buyer_id, seller_id, amount, rub_amount, created_at, dispute_reason, proof_file_id in disputes:
-            
-            # 1. Экранирование строки с датой
-            date_info = escape_markdown_v2(format_date(created_at))
-            
-            # 2. Экранирование строки с суммами
-            amount_info = f"Robux: {amount:,.0f} R | Сумма: {rub_amount:,.2f} ₽"
-            amount_info_escaped = escape_markdown_v2(amount_info)
-            
-            # 3. Экранирование причины
-            dispute_reason_escaped = escape_markdown_v2(dispute_reason)
-            
-            # Добавление строк в текст
-            text.append(f"➖" * 15)
-            # FIXED: Added backslashes before parentheses \( and \)
-            text.append(f"**Спор \\#{deal_id}** \\(от {date_info}\\)") 
-            text.append(amount_info_escaped)
-            text.append(f"Покупатель: [User {buyer_id}](tg://user?id={buyer_id})")
-            text.append(f"Продавец: [User {seller_id}](tg://user?id={seller_id})")
-            text.append(f"Причина: {dispute_reason_escaped}")
-            
-            # Кнопка
-            kb.row(InlineKeyboardButton(text=f"🔍 Спор #{deal_id}", callback_data=f"adm_view_dispute:{deal_id}"))
+async def show_dispute_queue(call: types.CallbackQuery, flt: DisputeQueueCb):
+    """Страница очереди споров: давние сверху, фильтры - в callback_data."""
+    cases, has_prev, has_next = await get_dispute_queue(
+        flt.anchor, flt.forward, call.from_user.id if flt.mine else 0, flt.min_rub, flt.seller_id
+    )
+    text = ["*📦 Очередь споров по P2P сделкам*"]
+    filters = []
+    if flt.mine:
+        filters.append("мои")
+    if flt.min_rub:
+        filters.append(f"от {flt.min_rub} ₽")
+    if flt.seller_id:
+        filters.append(f"продавец {flt.seller_id}")
+    if filters:
+        text.append(escape_markdown_v2(f"Фильтр: {', '.join(filters)}"))
+    text.append("")
+
+    if not cases:
+        text.append("Активных споров нет\\.")
+    for case in cases:
+        text.append(
+            f"*\\#{case.deal_id}* · {escape_markdown_v2(f'{case.rub_amount:,.2f} ₽')} · "
+            f"открыт {escape_markdown_v2(format_date(case.disputed_at))}"
+            + (f" · 🔒 {md_user(case.assignee_id, 'в работе')}" if case.assignee_id else "")
+        )
+        text.append(f"   {escape_markdown_v2((case.reason or 'Причина не указана')[:80])}")
 
-    # Кнопка Назад
-    kb.row(InlineKeyboardButton(text="◀️ Назад в Админ-панель", callback_data="back_admin"))
+    await call.message.edit_text(
+        "\n".join(text),
+        reply_markup=dispute_queue_kb(cases, has_prev, has_next, flt),
+        parse_mode="MarkdownV2"
+    )
 
-    # Отправка сообщения
-    await call.message.edit_text("\n".join(text), reply_markup=kb.as_markup(), parse_mode="MarkdownV2")
+@cb_router.route("adm_deals_dispute")
+async def adm_deals_dispute_cb(call: types.CallbackQuery):
+    if not is_admin(call.from_user.id): 
+        return await call.answer("Доступ запрещён.", show_alert=True)
+    await call.answer("Загрузка споров...")
+    await show_dispute_queue(call, DisputeQueueCb())
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("adm_view_dispute:"))
-async def adm_view_dispute_cb(call: types.CallbackQuery):
+@cb_router.route(DisputeQueueCb)
+async def dispute_queue_cb(call: types.CallbackQuery, callback_data: DisputeQueueCb):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
-    await call.answer("Просмотр спора...")
-
-    deal_id = int(call.data.split(":")[1])
-    deal_data = await get_deal_data(deal_id)
+    await call.answer()
+    await show_dispute_queue(call, callback_data)
 
-    if not deal_data:
+async def show_dispute_case(call: types.CallbackQuery, deal_id: int):
+    """Карточка спора с кнопками закрепления и решения."""
+    case = await get_dispute_case(deal_id)
+    if not case:
         return await call.message.edit_text("Спор не найден.", reply_markup=back_admin_kb())
 
-    _, buyer_id, seller_id, amount, rub_amount, roblox_link, _, status, proof_file_id, created_at, _, _, dispute_reason, _ = deal_data
-
+    admin_id = call.from_user.id
     text = [
-        f"**🛠 Разрешение спора по сделке #{deal_id}**\n",
-        f"Статус: **{status.upper()}**",
-        f"Robux: **{amount:,.0f} R** | Сумма: **{rub_amount:,.2f} ₽**",
-        f"Покупатель: [User {buyer_id}](tg://user?id={buyer_id})",
-        f"Продавец: [User {seller_id}](tg://user?id={seller_id})",
-        f"Ссылка Roblox: {escape_markdown_v2(roblox_link)}",
-        f"Причина спора: {escape_markdown_v2(dispute_reason or 'Не указана')}",
+        f"*🛠 Разрешение спора по сделке \\#{deal_id}*\n",
+        f"Статус: *{escape_markdown_v2(case.status.upper())}*",
+        f"Robux: *{escape_markdown_v2(f'{case.amount:,.0f}')} R* \\| Сумма: *{escape_markdown_v2(f'{case.rub_amount:,.2f}')} ₽*",
+        f"Покупатель: {md_user(case.buyer_id)}",
+        f"Продавец: {md_user(case.seller_id)}",
+        f"Ссылка Roblox: {escape_markdown_v2(case.roblox_link)}",
+        f"Спор открыт: {escape_markdown_v2(format_date(case.disputed_at))}",
+        f"Причина спора: {escape_markdown_v2(case.reason or 'Не указана')}",
         "───────────────────────────"
     ]
 
     kb = InlineKeyboardBuilder()
 
-    if proof_file_id:
-        text.append("📸 **Есть скриншот оплаты/пруф**")
-        kb.row(InlineKeyboardButton(text="🖼 Посмотреть пруф", callback_data=f"adm_show_proof:{deal_id}"))
+    if case.proof_file_id:
+        text.append("📸 *Есть скриншот оплаты/пруф*")
+        kb.row(InlineKeyboardButton(text="🖼 Посмотреть пруф", callback_data=AdmShowProofCb(deal_id=deal_id).pack()))
     else:
-        text.append("❌ **Нет скриншота оплаты/пруфа**")
-
+        text.append("❌ *Нет скриншота оплаты/пруфа*")
+
+    if case.status == 'dispute':
+        if case.assignee_id == admin_id:
+            text.append("🙋 Спор закреплён за вами")
+            kb.row(
+                InlineKeyboardButton(text="✅ Выдать Продавцу", callback_data=AdmResolveDisputeCb(deal_id=deal_id, winner_id=case.seller_id, amount=case.rub_amount).pack()),
+                InlineKeyboardButton(text="❌ Выдать Покупателю", callback_data=AdmResolveDisputeCb(deal_id=deal_id, winner_id=case.buyer_id, amount=case.rub_amount).pack())
+            )
+            kb.row(InlineKeyboardButton(text="↩️ Вернуть в очередь", callback_data=AdmTakeDisputeCb(deal_id=deal_id, take=False).pack()))
+        elif case.assignee_id:
+            text.append(f"🔒 В работе у {md_user(case.assignee_id, 'администратора')}")
+        else:
+            kb.row(InlineKeyboardButton(text="🙋 Взять в работу", callback_data=AdmTakeDisputeCb(deal_id=deal_id, take=True).pack()))
 
-    if status == 'dispute':
-        kb.row(
-            InlineKeyboardButton(text="✅ Выдать Продавцу", callback_data=f"adm_resolve_dispute:{deal_id}:{seller_id}:{rub_amount}"),
-            InlineKeyboardButton(text="❌ Выдать Покупателю", callback_data=f"adm_resolve_dispute:{deal_id}:{buyer_id}:{rub_amount}")
-        )
-    
+    kb.row(InlineKeyboardButton(text="📂 Споры этого продавца", callback_data=DisputeQueueCb(seller_id=case.seller_id).pack()))
     kb.row(InlineKeyboardButton(text="◀️ Назад к спорам", callback_data="adm_deals_dispute"))
 
     await call.message.edit_text("\n".join(text), reply_markup=kb.as_markup(), parse_mode="MarkdownV2")
 
+@cb_router.route(AdmViewDisputeCb)
+async def adm_view_dispute_cb(call: types.CallbackQuery, callback_data: AdmViewDisputeCb):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    await call.answer("Просмотр спора...")
+    await show_dispute_case(call, callback_data.deal_id)
+
+@cb_router.route(AdmTakeDisputeCb)
+async def adm_take_dispute_cb(call: types.CallbackQuery, callback_data: AdmTakeDisputeCb):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    deal_id = callback_data.deal_id
+    if callback_data.take:
+        if not await take_dispute(deal_id, call.from_user.id):
+            await call.answer("Спор уже взят другим администратором или закрыт.", show_alert=True)
+        else:
+            await call.answer("Спор закреплён за вами.")
+            await log_event(call.from_user.id, "DEAL_DISPUTE_TAKE", f"Deal #{deal_id}")
+    else:
+        await release_dispute(deal_id, call.from_user.id)
+        await call.answer("Спор возвращён в очередь.")
+    await show_dispute_case(call, deal_id)
+
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("adm_show_proof:"))
-async def adm_show_proof_cb(call: types.CallbackQuery, bot: Bot):
+@cb_router.route(AdmShowProofCb)
+async def adm_show_proof_cb(call: types.CallbackQuery, callback_data: AdmShowProofCb, bot: Bot):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Отправка пруфа...")
 
-    deal_id = int(call.data.split(":")[1])
+    deal_id = callback_data.deal_id
     deal_data = await get_deal_data(deal_id)
     
     if not deal_data:
@@ -1542,28 +3731,22 @@ async def adm_show_proof_cb(call: types.CallbackQuery, bot: Bot):
         logger.error(f"Error sending proof photo: {e}")
         await call.answer("Ошибка при отправке скриншота.", show_alert=True)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("adm_resolve_dispute:"))
-async def adm_resolve_dispute_cb(call: types.CallbackQuery, bot: Bot):
+@cb_router.route(AdmResolveDisputeCb)
+async def adm_resolve_dispute_cb(call: types.CallbackQuery, callback_data: AdmResolveDisputeCb, bot: Bot):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Разрешение спора...")
 
-    try:
-        _, deal_id_str, winner_id_str, amount_str = call.data.split(":")
-        deal_id = int(deal_id_str)
-        winner_id = int(winner_id_str)
-        amount = float(amount_str)
-    except ValueError:
-        return await call.answer("Некорректные данные в callback.", show_alert=True)
+    deal_id = callback_data.deal_id
+    winner_id = callback_data.winner_id
+    amount = callback_data.amount
     
     admin_id = call.from_user.id
-    deal_data = await get_deal_data(deal_id)
-    if not deal_data or deal_data[8] != 'dispute': # Проверка статуса
-        return await call.message.edit_text(f"Сделка #{deal_id} не найдена или спор уже разрешен.", reply_markup=back_admin_kb())
+    case = await get_dispute_case(deal_id)
+    if not case or not await resolve_deal_dispute(deal_id, winner_id, admin_id, amount):
+        return await call.message.edit_text(f"Сделка #{deal_id} не найдена, спор уже разрешен или закреплён за другим администратором.", reply_markup=back_admin_kb())
 
-    await resolve_deal_dispute(deal_id, winner_id, admin_id, amount)
-    
     # Уведомление сторон
-    buyer_id, seller_id = deal_data[1], deal_data[2]
+    buyer_id, seller_id = case.buyer_id, case.seller_id
     
     winner_msg = f"✅ **Спор по сделке #{deal_id} разрешен!** Администратор принял решение в вашу пользу. Свяжитесь с продавцом/покупателем для завершения сделки."
     loser_msg = f"❌ **Спор по сделке #{deal_id} разрешен!** Администратор принял решение не в вашу пользу. Если вы не согласны, свяжитесь с поддержкой."
@@ -1585,12 +3768,13 @@ async def adm_resolve_dispute_cb(call: types.CallbackQuery, bot: Bot):
     )
 
 # --- Admin Withdraws ---
-@dp.callback_query(F.data == "adm_withdraws")
-async def adm_withdraws_cb(call: types.CallbackQuery):
-    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
-    await call.answer("Загрузка ожидающих выводов...")
-    
-    withdrawals = await get_pending_withdrawals(limit=30)
+async def show_withdrawals(call: types.CallbackQuery, state: FSMContext):
+    """Список ожидающих выводов с выбором заявок для пакетной выплаты (выбор хранится в FSM)."""
+    data = await state.get_data()
+    method_filter = data.get("wd_method", "")
+    withdrawals = await get_pending_withdrawals(limit=30, method=method_filter)
+    totals = await get_pending_withdrawal_totals()
+    selected = set(data.get("wd_selected", []))
     # ИСПРАВЛЕНО: Экранированы скобки ( и ) в заголовке
     text = ["**💸 Ожидающие выводы средств \\(RUB\\)**\n"]
     kb = InlineKeyboardBuilder()
@@ -1599,7 +3783,12 @@ async def adm_withdraws_cb(call: types.CallbackQuery):
         # ИСПРАВЛЕНО: Экранирована точка в конце
         text.append("Активных заявок на вывод нет\\.")
     else:
-        for order_id, user_id, amount, details, created_at in withdrawals:
+        if totals:
+            text.append(" \\| ".join(
+                f"{md_code(m.upper() if m else '?')}: {count} / {escape_markdown_v2(f'{total:,.2f}')} ₽"
+                for m, count, total in totals
+            ))
+        for order_id, user_id, amount, method, requisites, created_at in withdrawals:
             text.append(f"➖" * 15)
             
             # ИСПРАВЛЕНО: Экранирование данных перед вставкой
@@ -1609,56 +3798,183 @@ async def adm_withdraws_cb(call: types.CallbackQuery):
             # ИСПРАВЛЕНО: Экранированы #, ( и )
             text.append(f"**Заявка \\#{order_id}** \\(от {date_esc}\\)")
             text.append(f"Сумма: **{amount_esc} ₽**")
-            text.append(f"Пользователь: [User {user_id}](tg://user?id={user_id})")
-            
-            # Обработка реквизитов
-            match = re.search(r"Method: (\w+), Details: (.*)", details)
-            if match:
-                method, details_str = match.groups()
-                # Для блоков кода (backticks) экранируем только ` и \
-                safe_method = method.upper().replace('\\', '\\\\').replace('`', '\\`')
-                safe_details = details_str.replace('\\', '\\\\').replace('`', '\\`')
-                
-                text.append(f"Метод: `{safe_method}`")
-                text.append(f"Реквизиты: `{safe_details}`")
-            else:
-                # Если формат не совпал, выводим как есть с полным экранированием
-                text.append(f"Info: {escape_markdown_v2(details)}")
+            text.append(f"Пользователь: {md_user(user_id)}")
+
+            text.append(f"Метод: {md_code((method or '?').upper())}")
+            text.append(f"Реквизиты: {md_code(requisites)}")
 
-            kb.row(InlineKeyboardButton(text=f"✅ Обработать #{order_id}", callback_data=f"adm_complete_withdraw:{order_id}"))
+            mark = "☑️" if order_id in selected else "⬜"
+            kb.row(
+                InlineKeyboardButton(text=f"{mark} #{order_id} · {amount:,.2f} ₽", callback_data=AdmWithdrawSelectCb(order_id=order_id).pack()),
+                InlineKeyboardButton(text="✅ Обработать", callback_data=AdmCompleteWithdrawCb(order_id=order_id).pack())
+            )
+        kb.row(
+            InlineKeyboardButton(text=f"☑️ Выбрать все (до {WITHDRAW_BATCH_MAX})", callback_data="adm_wd_all"),
+            InlineKeyboardButton(text="🧹 Снять выбор", callback_data="adm_wd_none")
+        )
+    if len(totals) > 1 or method_filter:
+        kb.row(*[
+            InlineKeyboardButton(text=f"{'✅ ' if m == method_filter else ''}{(m or 'все').upper()}",
+                                 callback_data=AdmWithdrawMethodCb(method=m).pack())
+            for m in ["", *(m for m, _, _ in totals if m)]
+        ])
 
+    if selected:
+        text.append(f"\nВыбрано заявок: *{len(selected)}*")
+        kb.row(
+            InlineKeyboardButton(text=f"✅ Выполнить выбранные ({len(selected)})", callback_data="adm_wd_approve"),
+            InlineKeyboardButton(text="📄 CSV для выплат", callback_data="adm_wd_csv")
+        )
     kb.row(InlineKeyboardButton(text="◀️ Назад в Админ-панель", callback_data="back_admin"))
 
     await call.message.edit_text("\n".join(text), reply_markup=kb.as_markup(), parse_mode="MarkdownV2")
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("adm_complete_withdraw:"))
-async def adm_complete_withdraw_cb(call: types.CallbackQuery, bot: Bot):
+@cb_router.route("adm_withdraws")
+async def adm_withdraws_cb(call: types.CallbackQuery, state: FSMContext):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    await call.answer("Загрузка ожидающих выводов...")
+    await show_withdrawals(call, state)
+
+@cb_router.route(AdmWithdrawSelectCb)
+async def adm_withdraw_select_cb(call: types.CallbackQuery, callback_data: AdmWithdrawSelectCb, state: FSMContext):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    selected = set((await state.get_data()).get("wd_selected", []))
+    selected ^= {callback_data.order_id}
+    if len(selected) > WITHDRAW_BATCH_MAX:
+        return await call.answer(f"Не больше {WITHDRAW_BATCH_MAX} заявок за раз.", show_alert=True)
+    await state.update_data(wd_selected=sorted(selected))
+    await call.answer()
+    await show_withdrawals(call, state)
+
+@cb_router.route(AdmWithdrawMethodCb)
+async def adm_withdraw_method_cb(call: types.CallbackQuery, callback_data: AdmWithdrawMethodCb, state: FSMContext):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    await state.update_data(wd_method=callback_data.method)
+    await call.answer()
+    await show_withdrawals(call, state)
+
+@cb_router.route("adm_wd_all")
+async def adm_withdraw_select_all_cb(call: types.CallbackQuery, state: FSMContext):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    order_ids = await get_pending_withdrawal_ids(method=(await state.get_data()).get("wd_method", ""))
+    await state.update_data(wd_selected=order_ids)
+    await call.answer(f"Выбрано заявок: {len(order_ids)}")
+    await show_withdrawals(call, state)
+
+@cb_router.route("adm_wd_none")
+async def adm_withdraw_select_none_cb(call: types.CallbackQuery, state: FSMContext):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    await state.update_data(wd_selected=[])
+    await call.answer("Выбор снят.")
+    await show_withdrawals(call, state)
+
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def csv_safe_cell(value):
+    """Экранирует ячейку от CSV-инъекции: Excel исполняет строки, начинающиеся с =, +, -, @."""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def build_payout_csvs(rows) -> Dict[str, Tuple[int, bytes]]:
+    """CSV для выплат, по файлу на метод: {метод: (кол-во заявок, csv)}.
+    Колонки: order_id, user_id, amount_rub, requisites, created_at."""
+    by_method: Dict[str, list] = {}
+    for order_id, user_id, amount, method, requisites, created_at in rows:
+        by_method.setdefault(method or "unknown", []).append(
+            (order_id, user_id, f"{amount:.2f}", csv_safe_cell(requisites), csv_safe_cell(created_at))
+        )
+    files = {}
+    for method, items in sorted(by_method.items()):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(("order_id", "user_id", "amount_rub", "requisites", "created_at"))
+        writer.writerows(items)
+        # utf-8-sig - чтобы Excel правильно открыл кириллицу
+        files[method] = (len(items), buf.getvalue().encode("utf-8-sig"))
+    return files
+
+@cb_router.route("adm_wd_csv")
+async def adm_withdraw_csv_cb(call: types.CallbackQuery, state: FSMContext, bot: Bot):
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    rows = await get_withdrawals_by_ids((await state.get_data()).get("wd_selected", []))
+    if not rows:
+        return await call.answer("Нет выбранных ожидающих заявок.", show_alert=True)
+    await call.answer("Формирую CSV...")
+    stamp = datetime.now().strftime("%Y%m%d_%H%M")
+    for method, (count, data) in build_payout_csvs(rows).items():
+        await bot.send_document(
+            call.from_user.id,
+            BufferedInputFile(data, filename=f"payouts_{method}_{stamp}.csv"),
+            caption=f"💸 {method.upper()}: {count} заявок"
+        )
+
+@cb_router.route("adm_wd_approve")
+async def adm_withdraw_approve_cb(call: types.CallbackQuery, state: FSMContext):
+    """Подтверждение пакетной выплаты."""
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    rows = await get_withdrawals_by_ids((await state.get_data()).get("wd_selected", []))
+    if not rows:
+        return await call.answer("Нет выбранных ожидающих заявок.", show_alert=True)
+    await call.answer()
+    total = sum(r[2] for r in rows)
+    await call.message.edit_text(
+        f"*Пакетная выплата*\n"
+        f"Заявок: *{len(rows)}*\n"
+        f"Сумма: *{escape_markdown_v2(f'{total:,.2f}')} ₽*\n\n"
+        f"Все выбранные заявки будут помечены выполненными, пользователи получат уведомления\\. "
+        f"Средства отправляются вручную по CSV\\.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Подтвердить", callback_data="adm_wd_approve_go")],
+            [InlineKeyboardButton(text="◀️ К ожидающим выводам", callback_data="adm_withdraws")]
+        ]),
+        parse_mode="MarkdownV2"
+    )
+
+@cb_router.route("adm_wd_approve_go")
+async def adm_withdraw_approve_go_cb(call: types.CallbackQuery, state: FSMContext, bot: Bot):
+    """Закрывает выбранные заявки одной транзакцией и уведомляет пользователей пакетно."""
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    await call.answer("Обработка выводов...")
+    done = await complete_withdrawals((await state.get_data()).get("wd_selected", []), call.from_user.id)
+    await state.update_data(wd_selected=[])
+    if not done:
+        return await call.message.edit_text("Выбранные заявки уже обработаны.", reply_markup=back_admin_kb())
+
+    total = sum(amount for _, _, amount in done)
+    await call.message.edit_text(f"⏳ Заявок выполнено: {len(done)} на {total:,.2f} ₽. Уведомляю пользователей...")
+    result = await send_bulk(bot, [
+        (user_id, MSG_WITHDRAW_COMPLETED(order_id=order_id, amount=amount)) for order_id, user_id, amount in done
+    ])
+    await call.message.edit_text(
+        f"✅ *Пакетная выплата проведена*\n"
+        f"Заявок: *{len(done)}* на *{escape_markdown_v2(f'{total:,.2f}')} ₽*\n"
+        f"Уведомлено: *{result.sent}*, заблокировали бота: *{result.blocked}*, ошибок: *{result.failed}*\n"
+        f"Средства должны быть отправлены вручную\\.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="◀️ К ожидающим выводам", callback_data="adm_withdraws")]]),
+        parse_mode="MarkdownV2"
+    )
+
+@cb_router.route(AdmCompleteWithdrawCb)
+async def adm_complete_withdraw_cb(call: types.CallbackQuery, callback_data: AdmCompleteWithdrawCb, bot: Bot):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Обработка вывода...")
     
-    order_id = int(call.data.split(":")[1])
-    order_data = await get_order_data(order_id)
-    
-    if not order_data:
-        return await call.message.edit_text("Заявка не найдена.", reply_markup=back_admin_kb())
-        
-    o_id, user_id, typ, amount_int, price, status, details, created_at = order_data[0], order_data[1], order_data[2], order_data[3], order_data[4], order_data[5], order_data[6], order_data[7]
-    amount_rub = price
-    
-    if status != 'pending':
-        return await call.message.edit_text(f"Заявка #{order_id} уже обработана (Статус: {status.upper()}).", reply_markup=back_admin_kb())
-
-    # Меняем статус
-    await update_order_status(order_id, 'completed')
-    await log_event(user_id, "WITHDRAW_COMPLETED", f"Order: {order_id}, Admin: {call.from_user.id}")
+    order_id = callback_data.order_id
+    # Тот же условный UPDATE, что и в пакетной выплате: при двойном нажатии или гонке админов заявка закроется один раз
+    done = await complete_withdrawals([order_id], call.from_user.id)
+    if not done:
+        order_data = await get_order_data(order_id)
+        if not order_data:
+            return await call.message.edit_text("Заявка не найдена.", reply_markup=back_admin_kb())
+        return await call.message.edit_text(f"Заявка #{order_id} уже обработана (Статус: {order_data[5].upper()}).", reply_markup=back_admin_kb())
+    _, user_id, amount_rub = done[0]
 
     # Уведомление пользователя
     try:
         await bot.send_message(
             user_id,
-            f"✅ **Ваша заявка на вывод #{order_id} выполнена!**\n"
-            f"Сумма: **{amount_rub:,.2f} ₽**\n"
-            f"Проверьте свои реквизиты.",
+            MSG_WITHDRAW_COMPLETED(order_id=order_id, amount=amount_rub),
             parse_mode="MarkdownV2"
         )
     except TelegramForbiddenError:
@@ -1672,12 +3988,12 @@ async def adm_complete_withdraw_cb(call: types.CallbackQuery, bot: Bot):
     )
 
 # --- Admin User Management ---
-@dp.callback_query(F.data == "adm_users")
+@cb_router.route("adm_users")
 async def adm_users_cb(call: types.CallbackQuery, state: FSMContext):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer()
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]])
+    kb = cancel_kb("back_admin")
     await call.message.edit_text(
         "👤 **Управление пользователями**\n"
         "Введите **ID** пользователя, чей баланс хотите изменить:",
@@ -1701,7 +4017,7 @@ async def adm_user_id_entered(message: types.Message, state: FSMContext):
     
     await state.update_data(target_user_id=target_id, old_balance=balance)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]])
+    kb = cancel_kb("back_admin")
     await message.reply(
         f"**Управление пользователем `{target_id}`**\n"
         f"Username: @{username}\n"
@@ -1726,7 +4042,7 @@ async def adm_new_balance_entered(message: types.Message, state: FSMContext, bot
     target_id = data['target_user_id']
     old_balance = data['old_balance']
     
-    await update_user_balance(target_id, new_balance)
+    await update_user_balance(target_id, new_balance, admin_id=message.from_user.id)
     await log_event(target_id, "ADMIN_BALANCE_CHANGE", f"Admin {message.from_user.id} changed balance from {old_balance:.2f} to {new_balance:.2f}")
 
     # Уведомление пользователя
@@ -1750,7 +4066,7 @@ async def adm_new_balance_entered(message: types.Message, state: FSMContext, bot
     await state.clear()
 
 # --- Admin Stats ---
-@dp.callback_query(F.data == "adm_stats")
+@cb_router.route("adm_stats")
 async def adm_stats_cb(call: types.CallbackQuery):
     """Показывает меню статистики."""
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
@@ -1761,37 +4077,61 @@ async def adm_stats_cb(call: types.CallbackQuery):
         reply_markup=admin_stats_kb()
     )
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("stats_period:"))
-async def stats_period_cb(call: types.CallbackQuery):
+@cb_router.route(StatsPeriodCb)
+async def stats_period_cb(call: types.CallbackQuery, callback_data: StatsPeriodCb):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Загрузка статистики...")
     
-    try:
-        days = int(call.data.split(":")[1])
-    except ValueError:
-        return await call.answer("Некорректный период.", show_alert=True)
+    days = callback_data.days
 
     new_users, robux_purchased, rub_turnover = await get_stats_by_period(days)
     
-    text = (
-        f"📊 **Статистика за последние {days} дней**\n"
-        "───────────────────────────\n"
-        f"👤 Новых пользователей: **{new_users:,}**\n"
-        f"📦 Robux куплено: **{robux_purchased:,.0f} R**\n"
-        f"💰 Оборот (RUB): **{rub_turnover:,.2f} ₽**"
-    )
+    text = MSG_STATS_PERIOD(days=days, new_users=new_users, robux=robux_purchased, rub=rub_turnover)
 
     await call.message.edit_text(text, reply_markup=admin_stats_kb(), parse_mode="MarkdownV2")
 
 
+@cb_router.route(AnalyticsPeriodCb)
+async def analytics_period_cb(call: types.CallbackQuery, callback_data: AnalyticsPeriodCb):
+    """Воронка покупок, конверсия и топ продавцов за период."""
+    if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
+    await call.answer("Загрузка аналитики...")
+
+    days = callback_data.days
+    funnel, top_sellers, (n_done, p50, p90, p99) = await get_analytics(days)
+    *stages, rub_completed = funnel
+    labels = ("Просмотры объявлений", "Сделки созданы", "Оплачены", "Пруф загружен", "Завершены")
+
+    text = [f"📈 *Аналитика за {days} дн\\.*", "", "*Воронка:*"]
+    prev = None
+    for label, value in zip(labels, stages):
+        conv = f" ({value / prev:.0%})" if prev else ""
+        text.append(escape_markdown_v2(f"{label}: {value:,}{conv}"))
+        prev = value
+    text.append(escape_markdown_v2(f"Оборот завершённых: {rub_completed:,.2f} ₽"))
+
+    text += ["", "*Время до завершения \\(мин\\.\\):*"]
+    text.append(escape_markdown_v2(f"n={n_done}, p50={p50:.0f}, p90={p90:.0f}, p99={p99:.0f}"))
+
+    text += ["", "*Топ продавцов:*"]
+    if not top_sellers:
+        text.append("Нет данных\\.")
+    for seller_id, username, created, completed, rub in top_sellers:
+        name = f"@{username}" if username else f"ID {seller_id}"
+        conv = completed / created if created else 0
+        text.append(escape_markdown_v2(f"{name}: {completed}/{created} ({conv:.0%}), {rub:,.2f} ₽"))
+
+    await call.message.edit_text("\n".join(text), reply_markup=admin_analytics_kb(), parse_mode="MarkdownV2")
+
+
 # --- Admin Broadcast ---
-@dp.callback_query(F.data == "adm_broadcast")
+@cb_router.route("adm_broadcast")
 async def broadcast_start_cb(call: types.CallbackQuery, state: FSMContext):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer()
     await state.clear()
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]])
+    kb = cancel_kb("back_admin")
     await call.message.edit_text(
         "💌 **Массовая рассылка**\n"
         "Введите текст сообщения для рассылки (поддерживается Markdown):",
@@ -1822,7 +4162,7 @@ async def broadcast_text(message: types.Message, state: FSMContext):
     )
     await state.set_state(BroadcastStates.confirm)
 
-@dp.callback_query(F.data == "broadcast_confirm", BroadcastStates.confirm)
+@cb_router.route("broadcast_confirm", state=BroadcastStates.confirm)
 async def broadcast_confirm_cb(call: types.CallbackQuery, state: FSMContext, bot: Bot):
     """Выполняет рассылку."""
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
@@ -1831,26 +4171,16 @@ async def broadcast_confirm_cb(call: types.CallbackQuery, state: FSMContext, bot
     data = await state.get_data()
     text = data['text']
     user_ids = await get_all_user_ids()
-    sent_count = 0
-    blocked_count = 0
     
     await call.message.edit_text(f"⏳ **Рассылка запущена...** (0/{len(user_ids)})")
-    
-    for uid in user_ids:
-        await asyncio.sleep(0.1) # Задержка для предотвращения троттлинга
+
+    async def progress(done: int, total: int):
         try:
-            await bot.send_message(uid, text, parse_mode="MarkdownV2")
-            sent_count += 1
-        except TelegramForbiddenError:
-            blocked_count += 1
-        except Exception:
-            pass
-            
-        if (sent_count + blocked_count) % 50 == 0:
-            try:
-                await call.message.edit_text(f"⏳ **Рассылка в процессе...** ({sent_count}/{len(user_ids)}) Отправлено.")
-            except TelegramBadRequest:
-                pass # Сообщение не изменилось
+            await call.message.edit_text(f"⏳ **Рассылка в процессе...** ({done}/{total}) Отправлено.")
+        except TelegramBadRequest:
+            pass # Сообщение не изменилось
+
+    sent_count, blocked_count, _ = await send_bulk(bot, [(uid, text) for uid in user_ids], progress=progress)
 
     await log_event(call.from_user.id, "BROADCAST_SENT", f"Total: {len(user_ids)}, Sent: {sent_count}, Blocked: {blocked_count}")
     await state.clear()
@@ -1866,19 +4196,19 @@ async def broadcast_confirm_cb(call: types.CallbackQuery, state: FSMContext, bot
 
 
 # --- Admin Coupon Management ---
-@dp.callback_query(F.data == "adm_coupons")
+@cb_router.route("adm_coupons")
 async def adm_coupons_cb(call: types.CallbackQuery):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer()
     await call.message.edit_text("🎫 **Управление Купонами**", reply_markup=admin_coupons_kb())
 
-@dp.callback_query(F.data == "coupon_create")
+@cb_router.route("coupon_create")
 async def coupon_create_start(call: types.CallbackQuery, state: FSMContext):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer()
     await state.clear()
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]])
+    kb = cancel_kb("back_admin")
     await call.message.edit_text("Введите **КОД** купона (только латинские буквы и цифры, без пробелов):", reply_markup=kb)
     await state.set_state(AdminCouponStates.enter_code)
 
@@ -1896,25 +4226,25 @@ async def coupon_enter_code(message: types.Message, state: FSMContext):
     await state.update_data(code=code)
     
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Процент (%)", callback_data="coupon_type:percent")],
-        [InlineKeyboardButton(text="Фикс. сумма (₽)", callback_data="coupon_type:fixed")],
+        [InlineKeyboardButton(text="Процент (%)", callback_data=CouponTypeCb(c_type="percent").pack())],
+        [InlineKeyboardButton(text="Фикс. сумма (₽)", callback_data=CouponTypeCb(c_type="fixed").pack())],
         [InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]
     ])
     await message.reply("Выберите **тип** скидки:", reply_markup=kb)
     await state.set_state(AdminCouponStates.enter_type)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("coupon_type:"), AdminCouponStates.enter_type)
-async def coupon_enter_type(call: types.CallbackQuery, state: FSMContext):
+@cb_router.route(CouponTypeCb, state=AdminCouponStates.enter_type)
+async def coupon_enter_type(call: types.CallbackQuery, callback_data: CouponTypeCb, state: FSMContext):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer()
-    c_type = call.data.split(":")[1]
+    c_type = callback_data.c_type
     await state.update_data(type=c_type)
     
     prompt = "Введите **процент** скидки (например, `10`):"
     if c_type == 'fixed':
         prompt = "Введите **фиксированную сумму** скидки в рублях (например, `100.50`):"
         
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]])
+    kb = cancel_kb("back_admin")
     await call.message.edit_text(prompt, reply_markup=kb)
     await state.set_state(AdminCouponStates.enter_value)
 
@@ -1930,7 +4260,7 @@ async def coupon_enter_value(message: types.Message, state: FSMContext):
         
     await state.update_data(value=value)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]])
+    kb = cancel_kb("back_admin")
     await message.reply("Введите **лимит использований** (0 для бесконечного):", reply_markup=kb)
     await state.set_state(AdminCouponStates.enter_limit)
 
@@ -1946,7 +4276,7 @@ async def coupon_enter_limit(message: types.Message, state: FSMContext):
         
     await state.update_data(uses_limit=limit)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_admin")]])
+    kb = cancel_kb("back_admin")
     await message.reply("Введите **минимальное количество Robux** для активации (0 для без ограничений):", reply_markup=kb)
     await state.set_state(AdminCouponStates.enter_min_amount)
 
@@ -1986,7 +4316,7 @@ async def coupon_enter_min_amount(message: types.Message, state: FSMContext):
     await message.reply(text, reply_markup=kb, parse_mode="MarkdownV2")
     await state.set_state(AdminCouponStates.confirm)
 
-@dp.callback_query(F.data == "coupon_confirm", AdminCouponStates.confirm)
+@cb_router.route("coupon_confirm", state=AdminCouponStates.confirm)
 async def coupon_confirm_cb(call: types.CallbackQuery, state: FSMContext):
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Создание купона...")
@@ -2014,7 +4344,7 @@ async def coupon_confirm_cb(call: types.CallbackQuery, state: FSMContext):
         )
     await state.clear()
 
-@dp.callback_query(F.data == "coupon_list")
+@cb_router.route("coupon_list")
 async def coupon_list_cb(call: types.CallbackQuery):
     """Показывает список всех купонов."""
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
@@ -2039,24 +4369,21 @@ async def coupon_list_cb(call: types.CallbackQuery):
             text.append(f"{status} **{code}** ({value_str})")
             text.append(f"Использовано: {uses_count}/{limit_str}")
 
-            kb_builder.row(InlineKeyboardButton(text=f"⚙️ Упр. {code}", callback_data=f"coupon_view:{c_id}"))
+            kb_builder.row(InlineKeyboardButton(text=f"⚙️ Упр. {code}", callback_data=CouponViewCb(coupon_id=c_id).pack()))
 
     kb_builder.row(InlineKeyboardButton(text="◀️ Назад в Админ-панель", callback_data="back_admin"))
 
     await call.message.edit_text("\n".join(text), reply_markup=kb_builder.as_markup(), parse_mode="MarkdownV2")
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("coupon_view:"))
-async def coupon_view_cb(call: types.CallbackQuery):
+@cb_router.route(CouponViewCb)
+async def coupon_view_cb(call: types.CallbackQuery, callback_data: CouponViewCb):
     """Показывает детали купона и кнопки управления."""
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Просмотр купона...")
     
-    try:
-        coupon_id = int(call.data.split(":")[1])
-    except ValueError:
-        return await call.answer("Некорректный ID купона.", show_alert=True)
+    coupon_id = callback_data.coupon_id
         
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT id, code, type, value, uses_limit, min_amount, is_active, created_at FROM coupons WHERE id = ?", (coupon_id,))
         coupon_data = await cur.fetchone()
         
@@ -2089,55 +4416,52 @@ async def coupon_view_cb(call: types.CallbackQuery):
     # Кнопка переключения активности
     new_status = 0 if is_active else 1
     toggle_text = "🔴 Деактивировать" if is_active else "🟢 Активировать"
-    kb.row(InlineKeyboardButton(text=toggle_text, callback_data=f"coupon_toggle:{c_id}:{new_status}"))
+    kb.row(InlineKeyboardButton(text=toggle_text, callback_data=CouponToggleCb(coupon_id=c_id, new_status=new_status).pack()))
     
     # Кнопка удаления
-    kb.row(InlineKeyboardButton(text="🗑️ Удалить купон", callback_data=f"coupon_delete:{c_id}"))
+    kb.row(InlineKeyboardButton(text="🗑️ Удалить купон", callback_data=CouponDeleteCb(coupon_id=c_id).pack()))
 
     kb.row(InlineKeyboardButton(text="◀️ Назад к списку", callback_data="coupon_list"))
 
     await call.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="MarkdownV2")
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("coupon_toggle:"))
-async def coupon_toggle_cb(call: types.CallbackQuery):
+@cb_router.route(CouponToggleCb)
+async def coupon_toggle_cb(call: types.CallbackQuery, callback_data: CouponToggleCb):
     """Переключает статус активности купона."""
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Изменение статуса...")
     
-    try:
-        _, c_id_str, new_status_str = call.data.split(":")
-        coupon_id = int(c_id_str)
-        new_status = int(new_status_str)
-    except ValueError:
-        return await call.answer("Некорректные данные в callback.", show_alert=True)
+    coupon_id = callback_data.coupon_id
+    new_status = callback_data.new_status
         
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         await db.execute("UPDATE coupons SET is_active = ? WHERE id = ?", (new_status, coupon_id))
         await db.commit()
+    coupon_index.invalidate()
     await log_event(call.from_user.id, "COUPON_TOGGLE", f"ID: {coupon_id}, Status: {new_status}")
     
     # Обновляем сообщение (вызываем coupon_view_cb для повторного отображения)
-    call.data = f"coupon_view:{coupon_id}"
-    await coupon_view_cb(call)
+    await coupon_view_cb(call, CouponViewCb(coupon_id=coupon_id))
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("coupon_delete:"))
-async def coupon_delete_cb(call: types.CallbackQuery):
+@cb_router.route(CouponDeleteCb)
+async def coupon_delete_cb(call: types.CallbackQuery, callback_data: CouponDeleteCb):
     """Удаляет купон."""
     if not is_admin(call.from_user.id): return await call.answer("Доступ запрещён.", show_alert=True)
     await call.answer("Удаление купона...")
     
-    coupon_id = int(call.data.split(":")[1])
-    async with aiosqlite.connect(DB_PATH) as db:
+    coupon_id = callback_data.coupon_id
+    async with db_connect() as db:
         await db.execute("DELETE FROM coupons WHERE id = ?", (coupon_id,))
         await db.execute("DELETE FROM coupon_uses WHERE coupon_id = ?", (coupon_id,))
         await db.commit()
+    coupon_index.invalidate()
     
     await log_event(call.from_user.id, "COUPON_DELETE", f"ID: {coupon_id}")
     await call.message.edit_text("✅ Купон успешно удален.", reply_markup=admin_coupons_kb())
 
 
 # --- User Coupon Activation ---
-@dp.callback_query(F.data == "user_coupon_activate")
+@cb_router.route("user_coupon_activate")
 async def user_coupon_activate_start(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
     await state.clear()
@@ -2147,13 +4471,8 @@ async def user_coupon_activate_start(call: types.CallbackQuery, state: FSMContex
 
     if active_coupon_id:
         # Получаем код текущего активного купона
-        async with aiosqlite.connect(DB_PATH) as db:
-            cur = await db.execute(
-                "SELECT code FROM coupons WHERE id = ?",
-                (active_coupon_id,)
-            )
-            row = await cur.fetchone()
-            coupon_code = row[0] if row else "???"
+        row = await get_coupon_data(active_coupon_id)
+        coupon_code = row[1] if row else "???"
 
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="❌ Отменить активный купон", callback_data="user_coupon_deactivate")],
@@ -2176,21 +4495,8 @@ async def user_coupon_activate_start(call: types.CallbackQuery, state: FSMContex
     )
     await state.set_state(UserCouponStates.enter_code)
 
-async def get_latest_transactions(user_id: int, limit: int = 10) -> list[tuple]:
-    """Получает последние транзакции/события пользователя из таблицы logs."""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # ИСПРАВЛЕНО: 'created_at' заменено на 'timestamp', так как в таблице logs колонка называется timestamp
-        query = """
-            SELECT event_type, details, timestamp 
-            FROM logs 
-            WHERE user_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        """
-        cursor = await db.execute(query, (user_id, limit))
-        return await cursor.fetchall()
-    
-@dp.callback_query(F.data == "user_coupon_deactivate")
+    
+@cb_router.route("user_coupon_deactivate")
 async def user_coupon_deactivate_cb(call: types.CallbackQuery, state: FSMContext):
     await call.answer("Купон деактивирован.")
     await set_user_active_coupon(call.from_user.id, None)
@@ -2235,12 +4541,12 @@ async def user_coupon_enter_code(message: types.Message, state: FSMContext):
     await state.clear() # Сбрасываем FSM
 
 # --- Sell Flow (Ad Management) ---
-@dp.callback_query(F.data == "sell_create_ad")
+@cb_router.route("sell_create_ad")
 async def sell_create_ad_cb(call: types.CallbackQuery, state: FSMContext):
     """Начинает процесс создания объявления."""
     await call.answer()
     await state.clear()
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="back_main")]])
+    kb = cancel_kb("back_main")
     await call.message.edit_text(
         "Введите **заголовок/название** объявления (например, 'Продажа через фанпэй'):", 
         reply_markup=kb, 
@@ -2325,7 +4631,7 @@ async def sell_ad_description(message: types.Message, state: FSMContext):
     await message.reply(text, reply_markup=kb, parse_mode="MarkdownV2")
     await state.set_state(CreateAdStates.confirm)
 
-@dp.callback_query(F.data == "ad_confirm", CreateAdStates.confirm)
+@cb_router.route("ad_confirm", state=CreateAdStates.confirm)
 async def sell_ad_confirm_cb(call: types.CallbackQuery, state: FSMContext):
     await call.answer("Публикация объявления...")
     uid = call.from_user.id
@@ -2349,7 +4655,7 @@ async def sell_ad_confirm_cb(call: types.CallbackQuery, state: FSMContext):
     await log_event(uid, "AD_CREATE", f"Ad ID: {ad_id}, Rate: {data['rate']}")
     await state.clear()
 
-@dp.callback_query(F.data == "sell_my_ads")
+@cb_router.route("sell_my_ads")
 async def sell_my_ads_cb(call: types.CallbackQuery):
     """Показывает список объявлений пользователя и кнопки управления."""
     await call.answer("Загрузка ваших объявлений...")
@@ -2373,25 +4679,21 @@ async def sell_my_ads_cb(call: types.CallbackQuery):
         new_status = 0 if active else 1
         
         kb_builder.row(
-            InlineKeyboardButton(text=action_btn_text, callback_data=f"ad_toggle:{ad_id}:{new_status}"),
-            InlineKeyboardButton(text="🗑️ Удалить", callback_data=f"ad_delete:{ad_id}")
+            InlineKeyboardButton(text=action_btn_text, callback_data=AdToggleCb(ad_id=ad_id, new_status=new_status).pack()),
+            InlineKeyboardButton(text="🗑️ Удалить", callback_data=AdDeleteCb(ad_id=ad_id).pack())
         )
         
     kb_builder.row(InlineKeyboardButton(text="◀️ Назад", callback_data="menu_sell"))
 
     await call.message.edit_text("\n".join(text), reply_markup=kb_builder.as_markup(), parse_mode="MarkdownV2")
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("ad_toggle:"))
-async def ad_toggle_cb(call: types.CallbackQuery):
+@cb_router.route(AdToggleCb)
+async def ad_toggle_cb(call: types.CallbackQuery, callback_data: AdToggleCb):
     """Переключает статус активности объявления."""
     await call.answer()
     uid = call.from_user.id
-    try:
-        _, ad_id_str, new_status_str = call.data.split(":")
-        ad_id = int(ad_id_str)
-        new_status = int(new_status_str)
-    except ValueError:
-        return await call.answer("Некорректные данные в callback.", show_alert=True)
+    ad_id = callback_data.ad_id
+    new_status = callback_data.new_status
         
     ad_data = await get_ad_data(ad_id)
     if not ad_data or ad_data[1] != uid:
@@ -2403,12 +4705,12 @@ async def ad_toggle_cb(call: types.CallbackQuery):
     # Обновляем список объявлений
     await sell_my_ads_cb(call)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("ad_delete:"))
-async def ad_delete_cb(call: types.CallbackQuery):
+@cb_router.route(AdDeleteCb)
+async def ad_delete_cb(call: types.CallbackQuery, callback_data: AdDeleteCb):
     """Удаляет объявление."""
     await call.answer()
     uid = call.from_user.id
-    ad_id = int(call.data.split(":")[1])
+    ad_id = callback_data.ad_id
     
     ad_data = await get_ad_data(ad_id)
     if not ad_data or ad_data[1] != uid:
@@ -2416,7 +4718,7 @@ async def ad_delete_cb(call: types.CallbackQuery):
 
     # Здесь должна быть логика удаления из DB, но мы просто деактивируем для безопасности
     # Реализация удаления:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         await db.execute("DELETE FROM ads WHERE id = ?", (ad_id,))
         await db.commit()
         
@@ -2426,53 +4728,24 @@ async def ad_delete_cb(call: types.CallbackQuery):
     # Обновляем список объявлений
     await sell_my_ads_cb(call)
 
-@dp.callback_query(F.data == "sell_history")
+@cb_router.route("sell_history")
 async def sell_history_cb(call: types.CallbackQuery):
     """Показывает историю продаж (завершенных сделок) продавца."""
     await call.answer("Загрузка истории продаж...")
-    uid = call.from_user.id
-    
-    deals = await get_deals_by_user(uid, is_seller=True, limit=10)
-    
-    text = ["**📜 Ваша история продаж (P2P):**\n"]
-    if not deals:
-        text.append("У вас пока нет продаж.")
-    else:
-        for d_id, amount, rub_amount, status, created_at, buyer_id, seller_id in deals:
-            # Показываем только завершенные
-            if status == 'completed':
-                text.append(f"➖" * 15)
-                text.append(f"**Сделка #{d_id}** (от {format_date(created_at)})")
-                text.append(f"Продано: **{amount:,.0f} R** | Заработок: **{rub_amount:,.2f} ₽**")
-                text.append(f"Покупатель: [User {buyer_id}](tg://user?id={buyer_id})")
-
-    await call.message.edit_text("\n".join(text), reply_markup=sell_menu_kb(), parse_mode="MarkdownV2")
+    await show_history(call, "sell")
 
-@dp.callback_query(F.data == "sell_profile")
+@cb_router.route("sell_profile")
 async def sell_profile_cb(call: types.CallbackQuery):
     """Показывает анкету продавца."""
     await call.answer("Загрузка анкеты...")
     uid = call.from_user.id
     
-    user_data = await get_user_data(uid)
-    username = user_data[0]
-    
-    avg_rating, review_count = await get_user_rating_avg(uid)
-    total_sales_count, total_rub_earned = await get_user_sales_stats(uid)
-    
-    rating_str = "Нет оценок"
-    if review_count > 0:
-        rating_str = f"**{avg_rating:.1f}** ⭐"
-    
-    text = (
-        f"👤 **Ваша анкета продавца**\n"
-        f"───────────────────────────\n"
-        f"Username: @{username}\n"
-        f"ID: `{uid}`\n"
-        f"⭐ Рейтинг: {rating_str} из 5\n"
-        f"📝 Всего отзывов: **{review_count}**\n"
-        f"📦 Всего завершенных продаж: **{total_sales_count}**\n"
-        f"💰 Общий заработок (RUB): **{total_rub_earned:,.2f} ₽**\n"
+    snap = await get_profile_snapshot(uid)
+
+    rating = Md(f"{md_bold(f'{snap.rating_avg:.1f}')} ⭐") if snap.review_count > 0 else "Нет оценок"
+    text = MSG_SELLER_PROFILE(
+        username=f"@{snap.username}" if snap.username else "—", uid=uid, rating=rating,
+        review_count=snap.review_count, sales_count=snap.sales_count, sales_rub=snap.sales_rub
     )
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -2482,7 +4755,7 @@ async def sell_profile_cb(call: types.CallbackQuery):
     ])
     await call.message.edit_text(text, reply_markup=kb, parse_mode="MarkdownV2")
 
-@dp.callback_query(F.data == "sell_reviews")
+@cb_router.route("sell_reviews")
 async def sell_reviews_cb(call: types.CallbackQuery):
     """Показывает последние отзывы для продавца."""
     await call.answer("Загрузка отзывов...")
@@ -2511,7 +4784,7 @@ async def sell_reviews_cb(call: types.CallbackQuery):
 
 # robloxxnadfix.py (предположительно около строки 2290)
 
-@dp.callback_query(F.data == "buy_list_ads")
+@cb_router.route("buy_list_ads")
 async def buy_list_ads_cb(call: types.CallbackQuery):  # ОПРЕДЕЛЯЕМ call и async
     """Показывает список активных объявлений."""
     
@@ -2571,7 +4844,7 @@ async def buy_list_ads_cb(call: types.CallbackQuery):  # ОПРЕДЕЛЯЕМ ca
             f"💳 Методы: {escaped_methods}"
         )
         
-        kb_builder.row(InlineKeyboardButton(text=f"Купить у #{ad_id}", callback_data=f"buy_select_ad:{ad_id}"))
+        kb_builder.row(InlineKeyboardButton(text=f"Купить у #{ad_id}", callback_data=BuySelectAdCb(ad_id=ad_id).pack()))
 
     # КОНЕЦ ЦИКЛА
     
@@ -2583,11 +4856,11 @@ async def buy_list_ads_cb(call: types.CallbackQuery):  # ОПРЕДЕЛЯЕМ ca
 
 # КОНЕЦ ФУНКЦИИ
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("buy_select_ad:"))
-async def buy_select_ad_cb(call: types.CallbackQuery, state: FSMContext):
+@cb_router.route(BuySelectAdCb)
+async def buy_select_ad_cb(call: types.CallbackQuery, callback_data: BuySelectAdCb, state: FSMContext):
     """Начинает процесс покупки Robux через P2P сделку."""
     await call.answer("Вы выбрали объявление...")
-    ad_id = int(call.data.split(":")[1])
+    ad_id = callback_data.ad_id
     ad_data = await get_ad_data(ad_id)
     uid = call.from_user.id
     
@@ -2601,13 +4874,15 @@ async def buy_select_ad_cb(call: types.CallbackQuery, state: FSMContext):
 
     if seller_id == uid:
         return await call.message.edit_text("Вы не можете создать сделку с самим собой.", reply_markup=buy_menu_kb())
+
+    record_ad_view(seller_id)
         
     # Проверяем активный купон
     user_data = await get_user_data(uid)
     active_coupon_id = user_data[4]
     coupon_data = None
     if active_coupon_id:
-        coupon_data = await get_coupon(active_coupon_id)
+        coupon_data = await get_coupon_data(active_coupon_id)
         
     await state.clear()
     await state.update_data(
@@ -2638,7 +4913,7 @@ async def buy_select_ad_cb(call: types.CallbackQuery, state: FSMContext):
         "Введите **количество Robux**, которое вы хотите приобрести:"
     )
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="menu_buy")]])
+    kb = cancel_kb("menu_buy")
     await call.message.edit_text(text, reply_markup=kb, parse_mode="MarkdownV2")
     await state.set_state(CreateDealStates.enter_amount)
 
@@ -2706,7 +4981,7 @@ async def buy_enter_amount(message: types.Message, state: FSMContext):
         "Введите **ссылку на ваш профиль/аккаунт Roblox** для выдачи Robux:"
     )
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="menu_buy")]])
+    kb = cancel_kb("menu_buy")
     await message.reply(text, reply_markup=kb, parse_mode="MarkdownV2")
     await state.set_state(CreateDealStates.enter_roblox_link)
 
@@ -2747,7 +5022,7 @@ async def buy_enter_roblox_link(message: types.Message, state: FSMContext):
     await message.reply(text, reply_markup=kb, parse_mode="MarkdownV2")
     await state.set_state(CreateDealStates.confirm)
 
-@dp.callback_query(F.data == "deal_confirm_pay", CreateDealStates.confirm)
+@cb_router.route("deal_confirm_pay", state=CreateDealStates.confirm)
 async def deal_confirm_pay_cb(call: types.CallbackQuery, state: FSMContext, bot: Bot):
     """Создает сделку, генерирует платеж YooKassa и отправляет ссылку."""
     if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY or not YOOINSTALLED:
@@ -2781,6 +5056,13 @@ async def deal_confirm_pay_cb(call: types.CallbackQuery, state: FSMContext, bot:
         coupon_id=coupon_id, 
         coupon_code=coupon_code
     )
+    if deal_id_temp is None:
+        # Слот купона заняли, пока пользователь оформлял сделку
+        await set_user_active_coupon(buyer_id, None)
+        return await call.message.edit_text(
+            "❌ Купон больше недоступен (лимит исчерпан или уже использован). Оформите сделку заново.",
+            reply_markup=buy_menu_kb()
+        )
     
     description = f"P2P Robux Deal #{deal_id_temp} - {amount} R"
     
@@ -2789,9 +5071,7 @@ async def deal_confirm_pay_cb(call: types.CallbackQuery, state: FSMContext, bot:
     except Exception as e:
         logger.error(f"Error getting bot info: {e}")
         # Если не удалось получить инфо о боте, удаляем сделку и выходим
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("DELETE FROM deals WHERE id = ?", (deal_id_temp,))
-            await db.commit()
+        await cancel_deal(deal_id_temp, delete=True)
         return await call.message.edit_text("⚠️ Произошла ошибка при получении данных бота. Попробуйте снова.", reply_markup=buy_menu_kb())
 
     try:
@@ -2816,20 +5096,22 @@ async def deal_confirm_pay_cb(call: types.CallbackQuery, state: FSMContext, bot:
         confirmation_url = payment.confirmation.confirmation_url
         payment_id = payment.id
 
-        # Обновляем сделку фактическим payment_id и статусом
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("UPDATE deals SET payment_id = ?, status = 'pending_payment' WHERE id = ?", (payment_id, deal_id_temp))
+        # Обновляем сделку фактическим payment_id, пока она ещё ждёт оплаты (её могли отменить, пока создавался платёж)
+        async with db_connect() as db:
+            cur = await db.execute(
+                "UPDATE deals SET payment_id = ? WHERE id = ? AND status = 'pending_payment'",
+                (payment_id, deal_id_temp)
+            )
             await db.commit()
+        if cur.rowcount == 0:
+            logger.warning(f"Deal {deal_id_temp} left pending_payment before payment {payment_id} was attached")
+            return await call.message.edit_text("❌ Сделка уже отменена. Оформите сделку заново.", reply_markup=buy_menu_kb())
         
-        text = (
-            f"**Оплата сделки P2P №{deal_id_temp}**\n"
-            f"Сумма: **{rub:,.2f} ₽**\n"
-            "Нажмите на кнопку ниже, чтобы перейти к оплате. У вас есть 15 минут."
-        )
+        text = MSG_DEAL_PAYMENT(deal_id=deal_id_temp, rub=rub, minutes=DEAL_PAYMENT_TIMEOUT_MIN)
         
         kb = InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text=f"💳 Оплатить {rub:,.2f} ₽", url=confirmation_url)],
-            [InlineKeyboardButton(text="🔄 Проверить оплату", callback_data=f"deal_check_payment:{deal_id_temp}:{payment_id}")],
+            [InlineKeyboardButton(text="🔄 Проверить оплату", callback_data=DealCheckPaymentCb(deal_id=deal_id_temp, payment_id=payment_id).pack())],
             [InlineKeyboardButton(text="❌ Отмена", callback_data="menu_buy")]
         ])
         
@@ -2839,22 +5121,17 @@ async def deal_confirm_pay_cb(call: types.CallbackQuery, state: FSMContext, bot:
     except Exception as e:
         logger.error(f"YooKassa payment creation failed: {e}")
         # Удаляем сделку
-        async with aiosqlite.connect(DB_PATH) as db:
-            await db.execute("DELETE FROM deals WHERE id = ?", (deal_id_temp,))
-            await db.commit()
+        await cancel_deal(deal_id_temp, delete=True)
         await call.message.edit_text("❌ Не удалось создать платеж. Попробуйте позже.", reply_markup=buy_menu_kb())
 
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("deal_check_payment:"))
-async def deal_check_payment_cb(call: types.CallbackQuery, bot: Bot):
+@cb_router.route(DealCheckPaymentCb)
+async def deal_check_payment_cb(call: types.CallbackQuery, callback_data: DealCheckPaymentCb, bot: Bot):
     """Повторная проверка статуса платежа через YooKassa API."""
     await call.answer("Проверка статуса платежа...")
     
-    try:
-        _, deal_id_str, payment_id = call.data.split(":")
-        deal_id = int(deal_id_str)
-    except ValueError:
-        return await call.answer("Некорректные данные.", show_alert=True)
+    deal_id = callback_data.deal_id
+    payment_id = callback_data.payment_id
         
     deal_data = await get_deal_data(deal_id)
     if not deal_data:
@@ -2868,8 +5145,7 @@ async def deal_check_payment_cb(call: types.CallbackQuery, bot: Bot):
             # Ручное выполнение логики webhook
             await handle_yookassa_success(deal_id, yoo_payment.json())
             await call.message.edit_text(
-                f"✅ **Сделка P2P №{deal_id} оплачена!**\n"
-                f"Ожидайте выдачи робуксов продавцом. Вам нужно загрузить скриншот оплаты.",
+                MSG_DEAL_CHECK_PAID(deal_id=deal_id),
                 reply_markup=deal_proof_kb(deal_id),
                 parse_mode="MarkdownV2"
             )
@@ -2877,23 +5153,22 @@ async def deal_check_payment_cb(call: types.CallbackQuery, bot: Bot):
             await call.answer("Платеж еще в обработке. Попробуйте через минуту.")
         else: # canceled, waiting_for_capture, etc.
             await call.message.edit_text(
-                f"❌ Платеж по сделке №{deal_id} имеет статус: **{yoo_payment.status}**\n"
-                "Попробуйте создать новую сделку.",
+                MSG_DEAL_CHECK_FAILED(deal_id=deal_id, status=yoo_payment.status),
                 reply_markup=buy_menu_kb(),
                 parse_mode="MarkdownV2"
             )
-            # Очищаем сделку (или помечаем как отмененную)
-            await update_deal_status(deal_id, 'cancelled')
+            # Помечаем сделку отменённой и освобождаем купон
+            await cancel_deal(deal_id)
             
     except Exception as e:
         logger.error(f"Error checking payment status: {e}")
         await call.answer("Ошибка при проверке статуса. Попробуйте позже.", show_alert=True)
 
 # --- Proof Upload Flow (Buyer) ---
-@dp.callback_query(lambda c: c.data and c.data.startswith("deal_upload_proof:"))
-async def deal_upload_proof_start_cb(call: types.CallbackQuery, state: FSMContext):
+@cb_router.route(DealUploadProofCb)
+async def deal_upload_proof_start_cb(call: types.CallbackQuery, callback_data: DealUploadProofCb, state: FSMContext):
     await call.answer()
-    deal_id = int(call.data.split(":")[1])
+    deal_id = callback_data.deal_id
     deal_data = await get_deal_data(deal_id)
     
     if not deal_data or deal_data[1] != call.from_user.id: # Проверка, что покупатель
@@ -2906,10 +5181,9 @@ async def deal_upload_proof_start_cb(call: types.CallbackQuery, state: FSMContex
     await state.clear()
     await state.update_data(deal_id=deal_id)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="menu_buy")]])
+    kb = cancel_kb("menu_buy")
     await call.message.edit_text(
-        f"📸 **Загрузка скриншота оплаты по сделке #{deal_id}**\n\n"
-        "Отправьте мне **одним сообщением** скриншот (фото) или документ, подтверждающий оплату.",
+        MSG_PROOF_REQUEST(deal_id=deal_id),
         reply_markup=kb,
         parse_mode="MarkdownV2"
     )
@@ -2936,8 +5210,7 @@ async def deal_upload_proof_process(message: types.Message, state: FSMContext, b
     
     # 2. Уведомление покупателя
     await message.reply(
-        f"✅ **Скриншот по сделке #{deal_id} загружен!**\n\n"
-        "Продавец уведомлен. Ожидайте выдачи Robux.",
+        MSG_PROOF_UPLOADED_BUYER(deal_id=deal_id),
         reply_markup=deal_actions_buyer_kb(deal_id, 'paid_waiting_proof'),
         parse_mode="MarkdownV2"
     )
@@ -2948,12 +5221,7 @@ async def deal_upload_proof_process(message: types.Message, state: FSMContext, b
         seller_id = deal_data[2]
         roblox_link = deal_data[6]
         
-        seller_msg = (
-            f"🔔 **Покупатель загрузил скриншот!**\n"
-            f"Сделка P2P №{deal_id} (Покупатель: [User {uid}](tg://user?id={uid}))\n"
-            f"Аккаунт: {escape_markdown_v2(roblox_link)}\n\n"
-            "**Ваше действие:** Проверьте оплату и выдайте Robux."
-        )
+        seller_msg = MSG_PROOF_UPLOADED_SELLER(deal_id=deal_id, buyer=md_user(uid), roblox_link=roblox_link)
         
         try:
             # Отправляем фото продавцу
@@ -2972,10 +5240,10 @@ async def deal_upload_proof_process(message: types.Message, state: FSMContext, b
     await state.clear()
 
 # --- Dispute Flow (Buyer) ---
-@dp.callback_query(lambda c: c.data and c.data.startswith("deal_dispute:"))
-async def deal_dispute_start_cb(call: types.CallbackQuery, state: FSMContext):
+@cb_router.route(DealDisputeCb)
+async def deal_dispute_start_cb(call: types.CallbackQuery, callback_data: DealDisputeCb, state: FSMContext):
     await call.answer()
-    deal_id = int(call.data.split(":")[1])
+    deal_id = callback_data.deal_id
     deal_data = await get_deal_data(deal_id)
     uid = call.from_user.id
     
@@ -2989,7 +5257,7 @@ async def deal_dispute_start_cb(call: types.CallbackQuery, state: FSMContext):
     await state.clear()
     await state.update_data(deal_id=deal_id)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="menu_buy")]])
+    kb = cancel_kb("menu_buy")
     await call.message.edit_text(
         f"⚠️ **Открытие спора по сделке #{deal_id}**\n\n"
         "Кратко опишите причину открытия спора (например, 'Продавец не выдает Robux'):",
@@ -3051,17 +5319,14 @@ async def deal_dispute_process(message: types.Message, state: FSMContext, bot: B
 
 
 # --- Deal Completion Flow (Seller) ---
-@dp.callback_query(lambda c: c.data and c.data.startswith("deal_complete_seller:"))
-async def deal_complete_seller_cb(call: types.CallbackQuery, bot: Bot):
+# Кнопка "Подтвердить выдачу (Спор)" ведёт в тот же обработчик
+@cb_router.route(DealCompleteSellerCb)
+@cb_router.route(DealCompleteSellerDisputeCb)
+async def deal_complete_seller_cb(call: types.CallbackQuery, callback_data: DealCompleteSellerCb, bot: Bot):
     """Подтверждение выдачи робуксов продавцом."""
     await call.answer()
     
-    try:
-        _, deal_id_str = call.data.split(":")[:2]
-        deal_id = int(deal_id_str)
-    except ValueError:
-        return await call.answer("Некорректные данные.", show_alert=True)
-        
+    deal_id = callback_data.deal_id
     uid = call.from_user.id
     deal_data = await get_deal_data(deal_id)
     
@@ -3072,32 +5337,28 @@ async def deal_complete_seller_cb(call: types.CallbackQuery, bot: Bot):
     if status != 'pending_proof' and status != 'dispute':
         return await call.answer("Сделку можно завершить только после загрузки пруфа покупателем или в статусе 'Спор'.", show_alert=True)
 
-    # 1. Обновляем статус сделки
-    await update_deal_status(deal_id, 'completed')
+    # 1. Обновляем статус сделки (условно: повторное нажатие не завершит её дважды)
+    if not await complete_deal(deal_id):
+        return await call.answer("Сделка уже завершена.", show_alert=True)
     await log_event(uid, "DEAL_COMPLETED", f"Deal: {deal_id}, Seller confirmed")
     
     # 2. Уведомление продавца
     await call.message.edit_text(
-        f"✅ **Сделка #{deal_id} успешно завершена!**\n"
-        "Спасибо за работу.",
+        MSG_DEAL_COMPLETED_SELLER(deal_id=deal_id),
         reply_markup=deal_actions_seller_kb(deal_id, 'completed'),
         parse_mode="MarkdownV2"
     )
 
     # 3. Уведомление покупателя
     buyer_id = deal_data[1]
-    buyer_msg = (
-        f"✅ **Сделка P2P №{deal_id} завершена!**\n"
-        f"Продавец подтвердил выдачу Robux.\n\n"
-        "Пожалуйста, **оставьте отзыв** о продавце, нажав на кнопку ниже."
-    )
+    buyer_msg = MSG_DEAL_COMPLETED_BUYER(deal_id=deal_id)
     try:
         await bot.send_message(buyer_id, buyer_msg, parse_mode="MarkdownV2", reply_markup=deal_actions_buyer_kb(deal_id, 'completed'))
     except TelegramForbiddenError:
         pass
         
     # 4. Уведомление админов
-    admin_msg = f"🎉 **Сделка #{deal_id} (P2P) завершена!** Продавец [User {uid}](tg://user?id={uid}) подтвердил выдачу."
+    admin_msg = MSG_DEAL_COMPLETED_ADMIN(deal_id=deal_id, seller=md_user(uid))
     for admin in ADMIN_IDS:
         try:
             await bot.send_message(admin, admin_msg, parse_mode="MarkdownV2")
@@ -3106,10 +5367,10 @@ async def deal_complete_seller_cb(call: types.CallbackQuery, bot: Bot):
 
 
 # --- Review Flow (Buyer) ---
-@dp.callback_query(lambda c: c.data and c.data.startswith("deal_review:"))
-async def review_start_cb(call: types.CallbackQuery, state: FSMContext):
+@cb_router.route(DealReviewCb)
+async def review_start_cb(call: types.CallbackQuery, callback_data: DealReviewCb, state: FSMContext):
     await call.answer()
-    deal_id = int(call.data.split(":")[1])
+    deal_id = callback_data.deal_id
     deal_data = await get_deal_data(deal_id)
     uid = call.from_user.id
     
@@ -3119,7 +5380,7 @@ async def review_start_cb(call: types.CallbackQuery, state: FSMContext):
     seller_id = deal_data[2]
     
     # 1. Проверяем, был ли уже отзыв
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_connect() as db:
         cur = await db.execute("SELECT id FROM reviews WHERE deal_id = ?", (deal_id,))
         if await cur.fetchone():
             return await call.answer("Вы уже оставили отзыв по этой сделке.", show_alert=True)
@@ -3129,7 +5390,7 @@ async def review_start_cb(call: types.CallbackQuery, state: FSMContext):
     
     kb_builder = InlineKeyboardBuilder()
     for rating in range(1, 6):
-        kb_builder.add(InlineKeyboardButton(text="⭐" * rating, callback_data=f"review_rating:{rating}"))
+        kb_builder.add(InlineKeyboardButton(text="⭐" * rating, callback_data=ReviewRatingCb(rating=rating).pack()))
     kb_builder.adjust(5)
     
     await call.message.edit_text(
@@ -3140,14 +5401,14 @@ async def review_start_cb(call: types.CallbackQuery, state: FSMContext):
     )
     await state.set_state(LeaveReviewStates.rating)
 
-@dp.callback_query(lambda c: c.data and c.data.startswith("review_rating:"), LeaveReviewStates.rating)
-async def review_rating_cb(call: types.CallbackQuery, state: FSMContext):
+@cb_router.route(ReviewRatingCb, state=LeaveReviewStates.rating)
+async def review_rating_cb(call: types.CallbackQuery, callback_data: ReviewRatingCb, state: FSMContext):
     """Получает рейтинг и просит комментарий."""
     await call.answer()
-    rating = int(call.data.split(":")[1])
+    rating = callback_data.rating
     await state.update_data(rating=rating)
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="❌ Отмена", callback_data="menu_buy")]])
+    kb = cancel_kb("menu_buy")
     await call.message.edit_text(
         f"**Отзыв о продавце**\n"
         f"Шаг 2/2: Ваша оценка: **{'⭐' * rating}**\n\n"
@@ -3173,7 +5434,7 @@ async def review_comment(message: types.Message, state: FSMContext, bot: Bot):
     # 2. Уведомление покупателя
     await message.reply(
         "✅ **Спасибо!** Ваш отзыв успешно оставлен.",
-        reply_markup=back_main_kb(is_admin(uid)),
+        reply_markup=back_main_kb(),
         parse_mode="MarkdownV2"
     )
     
@@ -3193,20 +5454,286 @@ async def review_comment(message: types.Message, state: FSMContext, bot: Bot):
 
 
 # --- Фоновый мониторинг сделок (Placeholder) ---
+async def expire_unpaid_deals():
+    """Отменяет сделки без оплаты дольше DEAL_PAYMENT_TIMEOUT_MIN (с финальной сверкой статуса в YooKassa)."""
+    for deal_id, buyer_id, payment_id in await get_expired_unpaid_deals():
+        if YOOINSTALLED and payment_id and payment_id != "Placeholder":
+            try:
+                yoo_payment = await asyncio.to_thread(Payment.find_one, payment_id)
+            except Exception as e:
+                logger.warning(f"Could not check payment {payment_id} for deal {deal_id}: {e}")
+                continue
+            if yoo_payment.status == 'succeeded':
+                await handle_yookassa_success(deal_id, yoo_payment.json())
+                continue
+            if yoo_payment.status in ('pending', 'waiting_for_capture'):
+                continue
+        if await cancel_deal(deal_id):
+            await log_event(buyer_id, "DEAL_EXPIRED", f"Deal: {deal_id}")
+            try:
+                await bot.send_message(buyer_id, f"⌛ Сделка №{deal_id} отменена: истекло время оплаты.")
+            except (TelegramForbiddenError, TelegramBadRequest):
+                pass
+
+
 async def deals_monitoring_loop():
-    """Фоновый цикл для мониторинга сделок, если это требуется (сейчас только заглушка)"""
-    # В этой версии мониторинг не требуется, так как статус меняется через YooKassa webhook
-    # или вручную администратором/продавцом.
-    
-    # Для демонстрации работы фона
+    """Фоновый цикл мониторинга сделок: истечение неоплаченных сделок и освобождение купонов"""
     while True:
-        await asyncio.sleep(3600) # Ждем 1 час
-        # Тут можно добавить логику проверки просроченных сделок, но пока не нужно.
+        await asyncio.sleep(300)
+        try:
+            await expire_unpaid_deals()
+        except Exception as e:
+            logger.error(f"Deals monitoring failed: {e}")
+
+
+async def run_telegram_webhook():
+    """Запуск бота в webhook-режиме: апдейты приходят на aiohttp-сервер и разбираются пулом воркеров."""
+    update_intake.start(bot)
+    await start_webhook_server()
+    try:
+        await set_bot_commands()
+        await bot.set_webhook(
+            TG_WEBHOOK_URL,
+            secret_token=TG_WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logger.info(f"🤖 Bot webhook set to {TG_WEBHOOK_URL}")
+        await asyncio.Event().wait()
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+        print("🚫 Bot stopped by user.")
+    except Exception as e:
+        logger.error(f"Webhook mode error: {e}")
+    finally:
+        await update_intake.stop()
+        await flush_ad_views()
+        await bot.session.close()
+
+
+# --- Шардирование по user_id (фронт + воркеры) ---
+def update_user_id(update: types.Update) -> int:
+    """Определяет пользователя апдейта (для липкой маршрутизации)."""
+    try:
+        event = update.event
+    except Exception:
+        return 0
+    user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    if user:
+        return user.id
+    chat = getattr(event, "chat", None)
+    return chat.id if chat else 0
+
+def shard_socket_path(index: int) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f"robux_bot_shard_{index}.sock")
+
+def shard_metrics_path(index: int) -> str:
+    return os.path.join(SHARD_SOCKET_DIR, f"robux_bot_shard_{index}.metrics.sock")
+
+class ShardRouter:
+    """Запускает воркер-процессы и пересылает им апдейты (одна строка JSON на апдейт)."""
+
+    def __init__(self, count: int):
+        self.count = count
+        self.procs: list = [None] * count
+        self.writers: list = [None] * count
+        self.locks = [asyncio.Lock() for _ in range(count)]
+        self.watchers: list = []
+        self.stopping = False
+
+    async def _spawn(self, index: int):
+        env = dict(os.environ, SHARD_ROLE="worker", SHARD_INDEX=str(index))
+        self.procs[index] = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        # Ждём, пока воркер поднимет сокет
+        for _ in range(100):
+            try:
+                _, self.writers[index] = await asyncio.open_unix_connection(shard_socket_path(index))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise RuntimeError(f"Shard worker {index} did not open its socket")
+        logger.info(f"Shard worker {index} started (pid {self.procs[index].pid})")
+
+    async def _watch(self, index: int):
+        while not self.stopping:
+            await self.procs[index].wait()
+            if self.stopping:
+                return
+            logger.error(f"Shard worker {index} exited with code {self.procs[index].returncode}, restarting")
+            async with self.locks[index]:
+                self.writers[index] = None
+            delay = 1
+            while not self.stopping:
+                try:
+                    async with self.locks[index]:
+                        await self._spawn(index)
+                    break
+                except (RuntimeError, OSError) as e:
+                    # Воркер не поднялся — пробуем снова с нарастающей паузой, наблюдатель не должен умирать
+                    logger.error(f"Shard worker {index} restart failed: {e}, retrying in {delay}s")
+                    proc = self.procs[index]
+                    if proc and proc.returncode is None:
+                        proc.kill()
+                        await proc.wait()
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+
+    async def start(self):
+        for index in range(self.count):
+            await self._spawn(index)
+            self.watchers.append(asyncio.create_task(self._watch(index)))
+
+    async def route(self, update: types.Update):
+        index = hash(update_user_id(update)) % self.count
+        line = update.model_dump_json(by_alias=True, exclude_none=True).encode("utf-8") + b"\n"
+        async with self.locks[index]:
+            writer = self.writers[index]
+            if writer is None:
+                logger.error(f"Shard {index} unavailable, update {update.update_id} dropped")
+                return
+            try:
+                writer.write(line)
+                await writer.drain()
+            except (ConnectionError, OSError) as e:
+                # Воркер упал: дальше апдейты шарда отбрасываются, пока наблюдатель его не перезапустит
+                self.writers[index] = None
+                writer.close()
+                logger.error(f"Shard {index} connection lost ({e}), update {update.update_id} dropped")
+
+    async def stop(self):
+        self.stopping = True
+        for task in self.watchers:
+            task.cancel()
+        for writer in self.writers:
+            if writer:
+                writer.close()
+        for proc in self.procs:
+            if proc and proc.returncode is None:
+                proc.terminate()
+                await proc.wait()
+
+async def run_shard_front():
+    """Фронт: получает апдейты (polling или webhook) и раздаёт их воркерам."""
+    router = ShardRouter(SHARD_WORKERS)
+    await router.start()
+    try:
+        await set_bot_commands()
+        if TG_WEBHOOK_ENABLED and WEBHOOK_HOST:
+            # Один воркер очереди сохраняет порядок апдейтов при пересылке
+            update_intake.workers = 1
+            update_intake.handler = router.route
+            update_intake.start(bot)
+            await start_webhook_server()
+            await bot.set_webhook(
+                TG_WEBHOOK_URL,
+                secret_token=TG_WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info(f"🤖 Shard front (webhook) routing to {SHARD_WORKERS} workers")
+            await asyncio.Event().wait()
+        else:
+            if WEBHOOK_HOST:
+                await start_webhook_server()
+            await bot.delete_webhook()
+            logger.info(f"🤖 Shard front (polling) routing to {SHARD_WORKERS} workers")
+            offset = None
+            allowed = dp.resolve_used_update_types()
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed)
+                except Exception as e:
+                    logger.error(f"Shard front polling error: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                for update in updates:
+                    await router.route(update)
+                    offset = update.update_id + 1
+    except (KeyboardInterrupt, SystemExit, asyncio.CancelledError):
+        print("🚫 Bot stopped by user.")
+    finally:
+        if update_intake.tasks:
+            await update_intake.stop()
+        await router.stop()
+        await bot.session.close()
+
+class ShardWorker:
+    """Воркер: принимает апдейты своего шарда и обрабатывает их строго по порядку для каждого пользователя."""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.chains: Dict[int, asyncio.Task] = {}
+
+    async def _process(self, previous: Optional[asyncio.Task], update: types.Update):
+        if previous:
+            await asyncio.wait([previous])
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            logger.exception(f"Shard {self.index}: error while handling update {update.update_id}")
+
+    def _submit(self, update: types.Update):
+        user_id = update_user_id(update)
+        task = asyncio.create_task(self._process(self.chains.get(user_id), update))
+        self.chains[user_id] = task
+
+        def _cleanup(t, uid=user_id):
+            if self.chains.get(uid) is t:
+                del self.chains[uid]
+        task.add_done_callback(_cleanup)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                update = types.Update.model_validate(json.loads(line), context={"bot": bot})
+            except Exception as e:
+                logger.error(f"Shard {self.index}: bad update payload: {e}")
+                continue
+            self._submit(update)
+        writer.close()
+
+    async def _send_metrics(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(json.dumps(metrics.snapshot()).encode("utf-8"))
+        await writer.drain()
+        writer.close()
+
+    async def serve(self):
+        path = shard_socket_path(self.index)
+        metrics_path = shard_metrics_path(self.index)
+        for stale in (path, metrics_path):
+            if os.path.exists(stale):
+                os.unlink(stale)
+        # Отдельный сокет для снапшота метрик: /metrics фронта суммирует их по воркерам
+        metrics_server = await asyncio.start_unix_server(self._send_metrics, metrics_path)
+        server = await asyncio.start_unix_server(self._handle_connection, path, limit=2 ** 20)
+        logger.info(f"Shard worker {self.index} listening on {path}")
+        # Просмотры объявлений копит процесс, обработавший апдейт, - у воркера свой буфер
+        flusher = asyncio.create_task(ad_views_flush_loop())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flusher.cancel()
+            await flush_ad_views()
+            metrics_server.close()
+            for stale in (path, metrics_path):
+                if os.path.exists(stale):
+                    os.unlink(stale)
+            await bot.session.close()
 
 
 async def main():
     """Основная функция запуска бота и фоновых задач."""
     
+    if SHARD_ROLE == "worker":
+        # Воркер шарда только обрабатывает апдейты; БД и фоновые задачи - на фронте
+        try:
+            await ShardWorker(SHARD_INDEX).serve()
+        except asyncio.CancelledError:
+            pass
+        return
+
     # НОВОЕ: Получаем имя пользователя бота внутри главного асинхронного контекста
     try:
         bot_info = await bot.get_me()
@@ -3221,7 +5748,23 @@ async def main():
 
     # Запуск фонового мониторинга сделок
     asyncio.create_task(deals_monitoring_loop())
-    
+    asyncio.create_task(daily_stats_loop())
+    asyncio.create_task(ad_views_flush_loop())
+    if LOG_RETENTION_DAYS > 0:
+        asyncio.create_task(log_retention_loop())
+    if BACKUP_INTERVAL_HOURS > 0:
+        asyncio.create_task(backup_loop())
+    if DEALS_ARCHIVE_DAYS > 0:
+        asyncio.create_task(deals_archive_loop())
+    
+    if SHARD_WORKERS > 1:
+        await run_shard_front()
+        return
+
+    if TG_WEBHOOK_ENABLED and WEBHOOK_HOST:
+        await run_telegram_webhook()
+        return
+
     # Запуск Webhook-сервера, если указан WEBHOOK_HOST
     if WEBHOOK_HOST:
         asyncio.create_task(start_webhook_server())
@@ -3229,12 +5772,15 @@ async def main():
     logger.info("🤖 Bot starting polling...")
     try:
         await set_bot_commands()
-        # Запуск Polling, если Webhook не используется, или просто для надежности, если Webhook настроен
+        # Если раньше был установлен webhook, polling с ним конфликтует
+        await bot.delete_webhook()
         await dp.start_polling(bot)
     except (KeyboardInterrupt, SystemExit):
         print("🚫 Bot stopped by user.")
     except Exception as e:
         logger.error(f"Polling error: {e}")
+    finally:
+        await flush_ad_views()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["RECORD_UPDATES"] = ""
+os.environ["SHARD_ROLE"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import robloxxnadfix2 as bot_module
+
+
+@pytest.fixture
+def coupon_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, "DB_PATH", str(tmp_path / "bot.db"))
+    asyncio.run(bot_module.init_db())
+    return asyncio.run(bot_module.create_or_update_coupon("PROMO", "percent", 10, 3, 0, True))
+
+
+def create_deals(coupon_id, buyers):
+    async def run():
+        return await asyncio.gather(*[
+            bot_module.create_deal(buyer_id, 101, 1, 500, 0.3, 150.0, "link", None, coupon_id, "PROMO")
+            for buyer_id in buyers
+        ])
+    return asyncio.run(run())
+
+
+def test_concurrent_deals_respect_coupon_limit(coupon_db):
+    deals = create_deals(coupon_db, range(200, 220))
+    created = [deal_id for deal_id in deals if deal_id]
+    assert len(created) == 3
+    assert asyncio.run(bot_module.get_coupon_use_count(coupon_db)) == 3
+
+    assert asyncio.run(bot_module.cancel_deal(created[0]))
+    assert asyncio.run(bot_module.get_coupon_use_count(coupon_db)) == 2
+    assert len([deal_id for deal_id in create_deals(coupon_db, range(300, 305)) if deal_id]) == 1
+    assert asyncio.run(bot_module.get_coupon_use_count(coupon_db)) == 3
+
+
+def test_expired_deal_releases_coupon(coupon_db, monkeypatch):
+    async def send_message(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(bot_module.bot, "send_message", send_message)
+    created = [deal_id for deal_id in create_deals(coupon_db, range(200, 203)) if deal_id]
+    assert len(created) == 3
+
+    async def expire_first():
+        async with bot_module.aiosqlite.connect(bot_module.DB_PATH) as db:
+            await db.execute("UPDATE deals SET created_at = '2020-01-01 00:00:00' WHERE id = ?", (created[0],))
+            await db.commit()
+        await bot_module.expire_unpaid_deals()
+
+    asyncio.run(expire_first())
+    assert asyncio.run(bot_module.get_coupon_use_count(coupon_db)) == 2
+    assert len([deal_id for deal_id in create_deals(coupon_db, [300]) if deal_id]) == 1
@@ -0,0 +1,45 @@
+import asyncio
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["RECORD_UPDATES"] = ""
+os.environ["SHARD_ROLE"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import robloxxnadfix2 as bot_module
+
+
+def test_keyset_at_roundtrip():
+    for created_at in ("2024-01-31 23:59:07", "2024-01-31 23:59:07.125"):
+        packed = bot_module.pack_keyset_at(created_at)
+        assert packed.isdigit()
+        assert bot_module.unpack_keyset_at(packed) == created_at
+
+
+async def page_after_archived_anchor(path):
+    async with bot_module.aiosqlite.connect(path) as db:
+        await db.execute("CREATE TABLE deals (id INTEGER PRIMARY KEY, buyer_id INTEGER, created_at TEXT)")
+        await db.executemany(
+            "INSERT INTO deals(id, buyer_id, created_at) VALUES(?, 7, ?)",
+            [(i, f"2024-01-01 10:00:{i:02d}") for i in range(1, 8)],
+        )
+        first, has_older, _ = await bot_module.fetch_keyset_page(
+            db, "deals", "id, created_at", "buyer_id = ?", (7,), limit=3)
+        cursor = bot_module.keyset_cursor(first[-1])
+        # Строка-якорь ушла в архив между нажатиями
+        await db.execute("DELETE FROM deals WHERE id = ?", (cursor[1],))
+        older, _, has_newer = await bot_module.fetch_keyset_page(
+            db, "deals", "id, created_at", "buyer_id = ?", (7,), cursor, True, 3)
+        newer, _, _ = await bot_module.fetch_keyset_page(
+            db, "deals", "id, created_at", "buyer_id = ?", (7,), bot_module.keyset_cursor(older[0]), False, 3)
+    return first, has_older, older, has_newer, newer
+
+
+def test_keyset_page_survives_archived_anchor(tmp_path):
+    first, has_older, older, has_newer, newer = asyncio.run(page_after_archived_anchor(str(tmp_path / "h.db")))
+    assert [row[0] for row in first] == [7, 6, 5]
+    assert has_older
+    assert [row[0] for row in older] == [4, 3, 2]
+    assert has_newer
+    assert [row[0] for row in newer] == [7, 6]
@@ -0,0 +1,38 @@
+import csv
+import io
+import os
+import sys
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["RECORD_UPDATES"] = ""
+os.environ["SHARD_ROLE"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import robloxxnadfix2 as bot_module
+
+
+def read_rows(data: bytes):
+    return list(csv.reader(io.StringIO(data.decode("utf-8-sig"))))
+
+
+def test_formula_cells_are_neutralised():
+    rows = [
+        (1, 10, 100.0, "card", "=HYPERLINK(\"http://evil\")", "2024-01-01 10:00:00"),
+        (2, 11, 50.5, "card", "+79001234567", "2024-01-01 10:00:00"),
+        (3, 12, 10.0, "card", "-1+1", "2024-01-01 10:00:00"),
+        (4, 13, 10.0, "card", "@SUM(A1)", "2024-01-01 10:00:00"),
+        (5, 14, 10.0, "card", "\tcmd", "2024-01-01 10:00:00"),
+        (6, 15, 10.0, "card", "\rcmd", "2024-01-01 10:00:00"),
+    ]
+    count, data = bot_module.build_payout_csvs(rows)["card"]
+    assert count == 6
+    requisites = [row[3] for row in read_rows(data)[1:]]
+    assert requisites == [
+        "'=HYPERLINK(\"http://evil\")", "'+79001234567", "'-1+1", "'@SUM(A1)", "'\tcmd", "'\rcmd",
+    ]
+
+
+def test_plain_cells_are_untouched():
+    rows = [(7, 16, 1234.5, "sbp", "4276 1234 5678 9012", "2024-01-01 10:00:00")]
+    _, data = bot_module.build_payout_csvs(rows)["sbp"]
+    assert read_rows(data)[1] == ["7", "16", "1234.50", "4276 1234 5678 9012", "2024-01-01 10:00:00"]
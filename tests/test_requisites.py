@@ -0,0 +1,71 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ["RECORD_UPDATES"] = ""
+os.environ["SHARD_ROLE"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import robloxxnadfix2 as bot_module
+
+
+def test_requisites_roundtrip(monkeypatch):
+    fernet = pytest.importorskip("cryptography.fernet")
+    monkeypatch.setattr(bot_module, "payout_cipher", fernet.Fernet(fernet.Fernet.generate_key()))
+    value = bot_module.encrypt_requisites("4276 1234 5678 9012")
+    assert value.startswith(bot_module.ENCRYPTED_PREFIX)
+    assert "4276" not in value
+    assert bot_module.decrypt_requisites(value) == "4276 1234 5678 9012"
+
+
+def test_requisites_with_other_key_are_not_revealed(monkeypatch):
+    fernet = pytest.importorskip("cryptography.fernet")
+    monkeypatch.setattr(bot_module, "payout_cipher", fernet.Fernet(fernet.Fernet.generate_key()))
+    value = bot_module.encrypt_requisites("+79001234567")
+    monkeypatch.setattr(bot_module, "payout_cipher", fernet.Fernet(fernet.Fernet.generate_key()))
+    assert bot_module.decrypt_requisites(value) == "🔒 зашифровано (другой ключ)"
+
+
+def test_requisites_without_key_pass_through(monkeypatch):
+    monkeypatch.setattr(bot_module, "payout_cipher", None)
+    assert bot_module.encrypt_requisites("+79001234567") == "+79001234567"
+    assert bot_module.decrypt_requisites("+79001234567") == "+79001234567"
+    assert bot_module.decrypt_requisites(bot_module.ENCRYPTED_PREFIX + "token") == "🔒 зашифровано (нет ключа)"
+
+
+async def run_requisites_migration(path, details):
+    async with bot_module.aiosqlite.connect(path) as db:
+        await db.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, type TEXT, details TEXT)")
+        await db.executemany(
+            "INSERT INTO orders(id, type, details) VALUES(?, ?, ?)",
+            [(order_id, "withdraw_rub", text) for order_id, text in details.items()],
+        )
+        await db.execute("INSERT INTO orders(id, type, details) VALUES(100, 'buy_robux', 'Robux: 100')")
+        await bot_module._migration_withdraw_requisites(db)
+        await db.commit()
+        cur = await db.execute("SELECT id, method, requisites_enc, details FROM orders ORDER BY id")
+        orders = {row[0]: row[1:] for row in await cur.fetchall()}
+        cur = await db.execute("SELECT order_id, details FROM orders_details_backup ORDER BY order_id")
+        backup = dict(await cur.fetchall())
+    return orders, backup
+
+
+def test_withdraw_requisites_migration(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot_module, "payout_cipher", None)
+    details = {
+        1: "Method: CARD, Details: 4276 1234 5678 9012",
+        2: "Method: SBP, Details: \\+7 900 123\\-45\\-67",
+        3: "Method: CARD, Details: line one\nline two",
+        4: "реквизиты без метки",
+    }
+    orders, backup = asyncio.run(run_requisites_migration(str(tmp_path / "m.db"), details))
+    assert orders[1] == ("card", "4276 1234 5678 9012", None)
+    assert orders[2] == ("sbp", "+7 900 123-45-67", None)
+    assert orders[3] == ("card", "line one\nline two", None)
+    # Неразобранная строка остаётся в details
+    assert orders[4] == ("unknown", "реквизиты без метки", "реквизиты без метки")
+    assert orders[100] == (None, None, "Robux: 100")
+    assert backup == details